@@ -0,0 +1,89 @@
+"""Compare the 3D closing of the mask with closing within axial slices.
+
+For every image the time of the closing alone, of preprocessing and of the
+whole registration are measured for the 3D closing, for the closing within
+slices of the whole volume and for the lazy closing per requested slice. The
+transform parameters are compared to the ones with the 3D closing.
+
+    python benchmarks/closing.py MR:tests/data/frame/t1_15T_test_volume.nii.gz CT:...
+"""
+
+import argparse
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+from stereotacticframe.pipeline import RegistrationOptions, calculate_frame_transform
+from stereotacticframe.preprocessor import Preprocessor
+from stereotacticframe.slice_provider import AxialSliceProvider
+
+MODES = {
+    "3D": RegistrationOptions(),
+    "2D, lazy per slice": RegistrationOptions(slice_closing=True),
+}
+
+
+def _closing_seconds(image: sitk.Image, modality: str) -> dict[str, float]:
+    seconds = {}
+    for name, slice_closing in (("3D", False), ("2D, whole volume", True)):
+        preprocessor = Preprocessor(modality, slice_closing=slice_closing)
+        mask = preprocessor.apply_threshold(
+            image, preprocessor.estimate_threshold(image)
+        )
+        start = time.perf_counter()
+        preprocessor.close(mask)
+        seconds[name] = time.perf_counter() - start
+
+    preprocessor = Preprocessor(modality, slice_closing=True)
+    start = time.perf_counter()
+    for k in range(image.GetSize()[2]):
+        preprocessor.close(mask[..., k])
+    seconds["2D, per slice"] = time.perf_counter() - start
+    return seconds
+
+
+def _preprocessing_seconds(image_path: str, modality: str, lazy: bool) -> float:
+    start = time.perf_counter()
+    AxialSliceProvider(
+        image_path, Preprocessor(modality, slice_closing=lazy), lazy_closing=lazy
+    )
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("images", nargs="+", help="MODALITY:path pairs")
+    parser.add_argument("--icp-engine", default="vtk")
+    arguments = parser.parse_args()
+
+    for modality_and_path in arguments.images:
+        modality, image_path = modality_and_path.split(":", 1)
+        image = sitk.DICOMOrient(sitk.ReadImage(image_path), "RAI")
+        print(f"{image_path} ({modality})")
+        for name, seconds in _closing_seconds(image, modality).items():
+            print(f"  closing {name:20s} {seconds:6.2f} s")
+
+        reference = None
+        for name, options in MODES.items():
+            options = options._replace(icp_engine=arguments.icp_engine)
+            preprocessing = _preprocessing_seconds(
+                image_path, modality, options.slice_closing
+            )
+            start = time.perf_counter()
+            result = calculate_frame_transform(image_path, modality, options)
+            total = time.perf_counter() - start
+            parameters = np.asarray(result.transform.GetParameters())
+            if reference is None:
+                reference = parameters
+            difference = np.abs(parameters - reference)
+            print(
+                f"  {name:20s} reading and preprocessing {preprocessing:6.2f} s, "
+                f"total {total:6.2f} s, max error {result.max_error:.3f} mm, "
+                f"rotation diff {difference[:9].max():.2e}, "
+                f"translation diff {difference[9:].max():.3f} mm"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Compare full resolution preprocessing with the multi-resolution modes.
+
+For every image the preprocessing time and the end-to-end time are measured,
+and the parameters of the resulting transform are compared to the ones of
+full resolution preprocessing.
+
+    python benchmarks/preprocessing.py MR:tests/data/frame/t1_15T_test_volume.nii.gz CT:...
+"""
+
+import argparse
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+from stereotacticframe.pipeline import RegistrationOptions, calculate_frame_transform
+from stereotacticframe.preprocessor import Preprocessor
+
+MODES = {
+    "full": RegistrationOptions(),
+    "threshold_shrink=4": RegistrationOptions(threshold_shrink=4),
+    "closing_shrink=2": RegistrationOptions(closing_shrink=2),
+    "both": RegistrationOptions(threshold_shrink=4, closing_shrink=2),
+}
+
+
+def _preprocessing_seconds(image: sitk.Image, modality: str, options) -> float:
+    preprocessor = Preprocessor(
+        modality,
+        threshold_shrink=options.threshold_shrink,
+        closing_shrink=options.closing_shrink,
+    )
+    start = time.perf_counter()
+    preprocessor.process(image)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("images", nargs="+", help="MODALITY:path pairs")
+    parser.add_argument("--icp-engine", default="vtk")
+    arguments = parser.parse_args()
+
+    for modality_and_path in arguments.images:
+        modality, image_path = modality_and_path.split(":", 1)
+        image = sitk.DICOMOrient(sitk.ReadImage(image_path), "RAI")
+        reference = None
+        print(f"{image_path} ({modality})")
+        for name, options in MODES.items():
+            options = options._replace(icp_engine=arguments.icp_engine)
+            preprocessing = _preprocessing_seconds(image, modality, options)
+            start = time.perf_counter()
+            result = calculate_frame_transform(image_path, modality, options)
+            total = time.perf_counter() - start
+            parameters = np.asarray(result.transform.GetParameters())
+            if reference is None:
+                reference = parameters
+            difference = np.abs(parameters - reference)
+            print(
+                f"  {name:20s} preprocessing {preprocessing:6.2f} s, "
+                f"total {total:6.2f} s, max error {result.max_error:.3f} mm, "
+                f"rotation diff {difference[:9].max():.2e}, "
+                f"translation diff {difference[9:].max():.3f} mm"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Accuracy and speed of the sparse slice sampling against a full scan.
+
+For every phantom case (see benchmarks/suite.py) the frame is registered
+while scanning all slices, and while aiming at a number of points per bar.
+The time of the blob detection and of the whole registration, the number of
+scanned slices and points, and the distance to the true pose are printed.
+
+    python benchmarks/sampling.py --cases ct ct-512 --points-per-bar 60 30 15
+"""
+
+from __future__ import annotations
+
+import argparse
+from pathlib import Path
+import tempfile
+import time
+
+import SimpleITK as sitk
+
+from stereotacticframe.phantoms import make_phantom, pose_error
+from stereotacticframe.pipeline import RegistrationOptions, calculate_frame_transform
+from stereotacticframe.profiling import Profile
+
+from suite import CASES
+
+
+def _stage(profile: Profile, name: str) -> dict:
+    return next(
+        (record.to_dict() for record in profile.stages if record.name == name), {}
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cases", nargs="+", default=["ct", "ct-512"])
+    parser.add_argument(
+        "--points-per-bar", nargs="+", type=int, default=[0, 120, 60, 30, 15]
+    )
+    parser.add_argument("--icp-engine", default="numpy")
+    arguments = parser.parse_args()
+
+    for name in arguments.cases:
+        spec = CASES[name]
+        phantom = make_phantom(spec)
+        frame_to_image = phantom.frame_to_image
+        with tempfile.TemporaryDirectory() as directory:
+            image_path = Path(directory).joinpath(f"{name}.mha")
+            sitk.WriteImage(phantom.image, image_path)
+            del phantom
+            print(f"{name} ({spec.modality}, {spec.size[2]} x {spec.spacing[2]} mm)")
+
+            for points_per_bar in arguments.points_per_bar:
+                options = RegistrationOptions(
+                    icp_engine=arguments.icp_engine, points_per_bar=points_per_bar
+                )
+                profile = Profile()
+                start = time.perf_counter()
+                result = calculate_frame_transform(
+                    image_path, spec.modality, options, profile=profile
+                )
+                total = time.perf_counter() - start
+                scan = _stage(profile, "scan slices")
+                detect = _stage(profile, "detect frame")
+                print(
+                    f"  points per bar {points_per_bar or 'all':>4}: "
+                    f"{scan.get('slices', '-'):>4} slices, "
+                    f"{detect.get('points', 0):5d} points, "
+                    f"detection {detect.get('seconds', 0.0):6.2f} s, "
+                    f"total {total:6.2f} s, "
+                    f"pose error {pose_error(result.transform, frame_to_image):.3f} mm"
+                )
+
+
+if __name__ == "__main__":
+    main()
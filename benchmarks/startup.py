@@ -0,0 +1,79 @@
+"""Start-up time of the command line interface per subcommand.
+
+Every subcommand is run with --help in a fresh process, which imports what
+the command line interface imports at load time. The apply command is also
+run on a small image, which imports what applying a transform needs. The
+median wall time of a number of runs is printed, with the heavy modules that
+were imported:
+
+    python benchmarks/startup.py --repeats 10
+"""
+
+from __future__ import annotations
+
+import argparse
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import SimpleITK as sitk
+
+COMMANDS = ["calculate", "calculate-batch", "apply", "apply-many", "serve"]
+HEAVY_MODULES = ("SimpleITK", "numpy", "vtk", "pyvista", "typer")
+
+_CODE = """
+import sys
+from stereotacticframe.cli import app
+try:
+    app(sys.argv[1:])
+except SystemExit:
+    pass
+print(*(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def _run(arguments: list[str], repeats: int) -> tuple[float, str]:
+    code = _CODE.format(heavy=HEAVY_MODULES)
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-c", code, *arguments],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds), result.stdout.splitlines()[-1]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeats", type=int, default=5)
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        transform_path = Path(directory).joinpath("transform.txt")
+        sitk.WriteTransform(sitk.Euler3DTransform(), transform_path)
+        image_path = Path(directory).joinpath("image.mha")
+        sitk.WriteImage(sitk.Image([64, 64, 32], sitk.sitkInt16), image_path)
+        runs = {
+            "--help": ["--help"],
+            **{f"{command} --help": [command, "--help"] for command in COMMANDS},
+            "apply": [
+                "apply",
+                str(image_path),
+                str(transform_path),
+                str(Path(directory).joinpath("output.mha")),
+            ],
+        }
+        for name, run_arguments in runs.items():
+            seconds, modules = _run(run_arguments, arguments.repeats)
+            print(f"{name:<24} {seconds:6.3f} s  {modules}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""Benchmark the frame registration on synthetic phantoms of known pose.
+
+Every case is a phantom (see stereotacticframe.phantoms) that is written to
+disk, and then registered in a fresh process, so that the peak memory of a
+case is its own. The timing of each stage, the end-to-end time, the peak
+memory and the distance of the calculated pose to the true pose are stored
+in a json file per version, which can be compared with an earlier one:
+
+    python benchmarks/suite.py --cases mr ct ct-512
+    python benchmarks/suite.py --compare benchmarks/results/0.5.json
+    python benchmarks/suite.py --option icp_engine=numpy --option slab_size=32
+    python benchmarks/suite.py --cases ct-1024 --option max_memory=4GiB
+"""
+
+from __future__ import annotations
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from importlib import metadata
+import json
+from pathlib import Path
+import subprocess
+import tempfile
+import time
+from typing import Any, Callable
+
+import numpy as np
+import SimpleITK as sitk
+
+from stereotacticframe.memory import parse_size
+from stereotacticframe.phantoms import PhantomSpec, make_phantom, pose_error
+from stereotacticframe.pipeline import RegistrationOptions, calculate_frame_transform
+from stereotacticframe.profiling import Profile, peak_rss_mb
+
+RESULTS_DIR = Path(__file__).parent.joinpath("results")
+
+CASES: dict[str, PhantomSpec] = {
+    "mr": PhantomSpec("MR", (256, 256, 90), (1.0, 1.0, 2.0), noise=5.0),
+    "mr-thick": PhantomSpec("MR", (256, 256, 36), (1.0, 1.0, 5.0), noise=5.0),
+    "ct": PhantomSpec("CT", (256, 256, 180), (1.0, 1.0, 1.0), noise=20.0),
+    "ct-512": PhantomSpec("CT", (512, 512, 300), (0.5, 0.5, 0.6), noise=20.0),
+    # the size of our largest clinical CTs
+    "ct-1024": PhantomSpec("CT", (1024, 1024, 600), (0.25, 0.25, 0.3), noise=20.0),
+}
+DEFAULT_CASES = ["mr", "mr-thick", "ct"]
+
+
+def _version() -> str:
+    version = metadata.version("StereotacticFrame")
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return version
+    return f"{version}+{commit}"
+
+
+def _z_range(value: str) -> tuple[float, float]:
+    bounds = value.split(",")
+    if len(bounds) != 2:
+        raise ValueError("give the range as minimum,maximum [mm]")
+    return float(bounds[0]), float(bounds[1])
+
+
+def _flag(value: str) -> bool:
+    return value.lower() in ("1", "true", "yes")
+
+
+# The options that can not be parsed with the type of their default
+_OPTION_TYPES: dict[str, Callable[[str], Any]] = {
+    "icp_tolerance": float,
+    "series_uid": str,
+    "z_range": _z_range,  # as minimum,maximum
+    "init_transform": Path,
+    "max_memory": parse_size,
+}
+
+
+def _parse_option(option: str) -> tuple[str, Any]:
+    name, _, value = option.partition("=")
+    if name not in RegistrationOptions._fields:
+        raise argparse.ArgumentTypeError(
+            f"Unknown option {name!r}, use one of "
+            + ", ".join(RegistrationOptions._fields)
+        )
+    default = RegistrationOptions._field_defaults[name]
+    parse = _OPTION_TYPES.get(
+        name, _flag if isinstance(default, bool) else type(default)
+    )
+    try:
+        return name, parse(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(f"{name}={value}: {error}") from error
+
+
+def _write_phantom(spec: PhantomSpec, path: Path) -> tuple[list[list[float]], float]:
+    start = time.perf_counter()
+    phantom = make_phantom(spec)
+    sitk.WriteImage(phantom.image, str(path))
+    return phantom.frame_to_image.tolist(), time.perf_counter() - start
+
+
+def _register(
+    path: Path,
+    modality: str,
+    options: RegistrationOptions,
+    frame_to_image: list[list[float]],
+) -> dict[str, Any]:
+    profile = Profile()
+    start = time.perf_counter()
+    result = calculate_frame_transform(path, modality, options, profile=profile)
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "pose_error": pose_error(result.transform, np.asarray(frame_to_image)),
+        "mean_error": float(result.mean_error),
+        "max_error": float(result.max_error),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": profile.to_dict()["stages"],
+    }
+
+
+def run_case(
+    name: str, options: RegistrationOptions, repeat: int, directory: Path
+) -> dict[str, Any]:
+    spec = CASES[name]
+    path = directory.joinpath(f"{name}.mha")
+    # fresh processes, so that the peak memory is the one of the registration
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        frame_to_image, generation_seconds = executor.submit(
+            _write_phantom, spec, path
+        ).result()
+    runs = []
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            runs.append(
+                executor.submit(
+                    _register, path, spec.modality, options, frame_to_image
+                ).result()
+            )
+    path.unlink()
+    fastest = min(runs, key=lambda run: run["seconds"])
+    return {
+        "spec": spec._asdict(),
+        "generation_seconds": generation_seconds,
+        "all_seconds": [run["seconds"] for run in runs],
+        **fastest,
+    }
+
+
+def _compare(results: dict[str, Any], baseline: dict[str, Any]) -> None:
+    print(f"{results['version']} against {baseline['version']}")
+    for name, case in results["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        base = baseline["cases"][name]
+        print(
+            f"  {name:10s} {case['seconds']:7.2f} s ({case['seconds'] / base['seconds']:5.2f}x), "
+            f"pose error {case['pose_error']:.3f} mm (was {base['pose_error']:.3f}), "
+            f"peak {case['peak_rss_mb']:.0f} MB (was {base['peak_rss_mb']:.0f})"
+        )
+        base_stages = {stage["name"]: stage["seconds"] for stage in base["stages"]}
+        for stage in case["stages"]:
+            if stage["name"] in base_stages and base_stages[stage["name"]] > 0:
+                ratio = stage["seconds"] / base_stages[stage["name"]]
+                print(
+                    f"    {stage['name']:28s} {stage['seconds']:7.3f} s ({ratio:5.2f}x)"
+                )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--cases", nargs="+", default=DEFAULT_CASES, choices=CASES)
+    parser.add_argument(
+        "--option",
+        action="append",
+        default=[],
+        type=_parse_option,
+        help="registration option as name=value, see RegistrationOptions",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--output", type=Path, help="defaults to results/<version>.json"
+    )
+    parser.add_argument("--compare", type=Path, help="earlier results to compare to")
+    arguments = parser.parse_args()
+
+    options = RegistrationOptions(**dict(arguments.option))
+    version = _version()
+    results: dict[str, Any] = {
+        "version": version,
+        "options": options._asdict(),
+        "cases": {},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for name in arguments.cases:
+            case = run_case(name, options, arguments.repeat, Path(directory))
+            results["cases"][name] = case
+            print(
+                f"{name:10s} {case['seconds']:7.2f} s, "
+                f"pose error {case['pose_error']:.3f} mm, "
+                f"max detection error {case['max_error']:.3f} mm, "
+                f"peak {case['peak_rss_mb']:.0f} MB"
+            )
+
+    output = arguments.output or RESULTS_DIR.joinpath(f"{version}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as output_file:
+        # default=str for the init_transform path
+        json.dump(results, output_file, indent=2, default=str)
+
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            _compare(results, json.load(baseline_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,66 @@
-from . import blob_detection
-from . import frame_detector
-from . import frame_protocol
-from . import frames
-from . import preprocessor
-from . import slice_provider
-from . import transforms
+"""The submodules are imported on first access, so that e.g. the command line
+interface does not import VTK and pyvista for commands that do not need them."""
+
+from __future__ import annotations
+
+import importlib
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from . import alignment
+    from . import bar_fit
+    from . import batch
+    from . import blob_detection
+    from . import cache
+    from . import dicom
+    from . import frame_detector
+    from . import frame_models
+    from . import frame_protocol
+    from . import frames
+    from . import geometry
+    from . import icp
+    from . import memory
+    from . import phantoms
+    from . import pipeline
+    from . import preprocessor
+    from . import profiling
+    from . import roi
+    from . import sampling
+    from . import server
+    from . import slice_provider
+    from . import transforms
 
 __all__ = [
+    "alignment",
+    "bar_fit",
+    "batch",
     "blob_detection",
+    "cache",
+    "dicom",
     "frame_detector",
+    "frame_models",
     "frame_protocol",
     "frames",
+    "geometry",
+    "icp",
+    "memory",
+    "phantoms",
+    "pipeline",
     "preprocessor",
+    "profiling",
+    "roi",
+    "sampling",
+    "server",
     "slice_provider",
     "transforms",
 ]
+
+
+def __getattr__(name: str) -> Any:
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,114 @@
+"""Schedule of the staged alignment of the detected points to the frame.
+
+Every stage crops the points, after moving them with the result of the
+previous stage, and registers the points that are left to the frame again.
+The crops are in frame space, so they can remove the points that are far
+from the fiducial plates once the points are roughly aligned."""
+
+from __future__ import annotations
+
+import math
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+INF = math.inf
+
+ICP_ENGINES = ("vtk", "numpy")
+# "bars" starts from the pose of the fitted bars, instead of the coarse stages
+INITIAL_POSES = ("icp", "bars")
+
+
+class CropBox(NamedTuple):
+    """Open box in frame space, the points strictly inside are kept"""
+
+    minimum: tuple[float, float, float] = (-INF, -INF, -INF)
+    maximum: tuple[float, float, float] = (INF, INF, INF)
+
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        return np.all(
+            (points > np.asarray(self.minimum)) & (points < np.asarray(self.maximum)),
+            axis=1,
+        )
+
+
+class AlignmentStage(NamedTuple):
+    name: str
+    iterations: int  # cap, the stage stops earlier when it converged
+    # [mm] mean displacement of the landmarks in an iteration at which the
+    # stage has converged. None keeps the default of the ICP engine, which for
+    # VTK is to always run all iterations.
+    tolerance: Optional[float] = None
+    number_of_landmarks: int = 2_000
+    # points inside any of the boxes are kept, in box order; no boxes keeps all
+    crop_boxes: tuple[CropBox, ...] = ()
+    # [mm] only keep the points closer to the frame than this
+    max_distance: Optional[float] = None
+    # skipped when the alignment starts from a prior transform
+    coarse: bool = False
+
+
+AlignmentSchedule = tuple[AlignmentStage, ...]
+
+
+def _lateral_boxes(
+    right: float, left: float, inferior: float = -INF, superior: float = INF
+) -> tuple[CropBox, CropBox]:
+    """The right plate (x < right) and the left plate (x > left) of the frame"""
+    return (
+        CropBox((-INF, -INF, inferior), (right, INF, superior)),
+        CropBox((left, -INF, inferior), (INF, INF, superior)),
+    )
+
+
+DEFAULT_SCHEDULE: AlignmentSchedule = (
+    # One iteration to do centroid alignment
+    AlignmentStage("centroid", iterations=1, coarse=True),
+    # Very liberally clean some points
+    AlignmentStage(
+        "initial",
+        iterations=1_000,
+        crop_boxes=_lateral_boxes(40, 150),
+        coarse=True,
+    ),
+    # Also remove the upper and lower 10 mm
+    AlignmentStage(
+        "refined", iterations=1_000, crop_boxes=_lateral_boxes(10, 180, -110, -10)
+    ),
+    AlignmentStage(
+        "final",
+        iterations=2_000,
+        crop_boxes=_lateral_boxes(10, 180, -110, -10),
+        max_distance=3.0,
+    ),
+)
+
+
+def with_tolerance(schedule: AlignmentSchedule, tolerance: float) -> AlignmentSchedule:
+    return tuple(stage._replace(tolerance=tolerance) for stage in schedule)
+
+
+def refinement(schedule: AlignmentSchedule) -> AlignmentSchedule:
+    """The stages that are left when starting from a prior transform"""
+    return tuple(stage for stage in schedule if not stage.coarse)
+
+
+def select_points(
+    points: np.ndarray,
+    stage: AlignmentStage,
+    distances: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Indices of the points, aligned to frame space, that the stage keeps.
+
+    distances are those of the points to the frame, and are only needed when
+    the stage has a max_distance."""
+    candidates = np.arange(len(points))
+    if stage.max_distance is not None:
+        if distances is None:
+            raise ValueError(f"Stage {stage.name} needs the distances to the frame")
+        candidates = candidates[distances < stage.max_distance]
+    if not stage.crop_boxes:
+        return candidates
+    return np.concatenate(
+        [candidates[box.contains(points[candidates])] for box in stage.crop_boxes]
+    )
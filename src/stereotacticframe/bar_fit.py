@@ -0,0 +1,218 @@
+"""Closed-form initial pose of the frame from the detected bars.
+
+On each lateral plate of the Leksell box the blobs lie on three straight
+bars: a posterior and an anterior rod, and a diagonal from the posterior
+cranial to the anterior caudal node. The points are split into the two
+plates along the left-right axis, and three lines are fitted to each plate
+with RANSAC. The diagonal crosses the rods in two nodes of the plate, and
+the feet of those nodes on the other rod are the other two. The rigid
+transform of these eight nodes onto the frame nodes is solved for every
+labelling of the nodes, and the one that fits with the smallest rotation is
+kept; like the centroid alignment, this assumes a roughly axial frame."""
+
+from __future__ import annotations
+
+import logging
+import math
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from stereotacticframe import icp
+from stereotacticframe.frame_protocol import FrameProtocol
+
+logger = logging.getLogger(__name__)
+
+# Per plate the start and end node of the diagonal, and the other end of the
+# rod through each of them: the right plate (0-3) and the left plate (4-7)
+PLATE_NODES = ((0, 3, 2, 1), (4, 7, 6, 5))
+
+INLIER_DISTANCE = 1.5  # [mm] from a bar
+RANSAC_SAMPLES = 256
+MIN_BAR_POINTS = 5
+MIN_BAR_LENGTH = 40.0  # [mm] covered by the points of a bar
+MIN_AXIAL_COSINE = 0.5  # the rods and diagonals are within 60 degrees of z
+MIN_PARALLEL_COSINE = 0.98  # between the two rods of a plate
+MAX_NODE_RMS = 3.0  # [mm] of the fitted nodes from the frame nodes
+MAX_ROTATION = math.pi / 4
+
+
+class Line(NamedTuple):
+    point: np.ndarray
+    direction: np.ndarray  # unit length
+
+
+def _has_bars(frame: FrameProtocol, modality: str) -> bool:
+    """Whether both plates have their rods and diagonal"""
+    edges = {tuple(sorted(edge)) for edge in frame.get_edges(modality)}
+    return all(
+        tuple(sorted(edge)) in edges
+        for start, end, start_rod_end, end_rod_end in PLATE_NODES
+        for edge in ((start, end), (start, start_rod_end), (end_rod_end, end))
+    )
+
+
+def _split_plates(
+    points: np.ndarray, frame_width: float
+) -> Optional[tuple[np.ndarray, np.ndarray]]:
+    """Points of the right (low x) and left (high x) plate, by 2-means on x"""
+    x = points[:, 0]
+    centers = np.percentile(x, [5, 95])
+    for _ in range(10):
+        left = np.abs(x - centers[1]) < np.abs(x - centers[0])
+        if left.all() or not left.any():
+            return None
+        centers = np.array([x[~left].mean(), x[left].mean()])
+    if centers[1] - centers[0] < frame_width / 2:
+        return None
+    return points[~left], points[left]
+
+
+def _squared_distances(points: np.ndarray, lines: Line) -> np.ndarray:
+    """(N, L) squared distances of the points to the (L, 3) lines,
+    from |p - c|^2 - ((p - c).d)^2"""
+    projections = points @ lines.direction.T - np.einsum(
+        "ij,ij->i", lines.point, lines.direction
+    )
+    squared_offsets = (
+        np.einsum("ij,ij->i", points, points)[:, np.newaxis]
+        - 2 * points @ lines.point.T
+        + np.einsum("ij,ij->i", lines.point, lines.point)
+    )
+    return squared_offsets - projections**2
+
+
+def _refine(points: np.ndarray, inliers: np.ndarray) -> tuple[Line, np.ndarray]:
+    """Principal axis of the inliers, and the inliers of that line"""
+    for _ in range(2):
+        centroid = points[inliers].mean(axis=0)
+        direction = np.linalg.svd(points[inliers] - centroid)[2][0]
+        line = Line(centroid, direction)
+        inliers = (
+            _squared_distances(points, Line(centroid[None], direction[None]))[:, 0]
+            < INLIER_DISTANCE**2
+        )
+        if inliers.sum() < MIN_BAR_POINTS:
+            break
+    return line, inliers
+
+
+def _fit_line(
+    points: np.ndarray, rng: np.random.Generator
+) -> Optional[tuple[Line, np.ndarray]]:
+    """Line through most of the points, and its inliers"""
+    pairs = rng.integers(len(points), size=(RANSAC_SAMPLES, 2))
+    starts = points[pairs[:, 0]]
+    directions = points[pairs[:, 1]] - starts
+    lengths = np.linalg.norm(directions, axis=1)
+    valid = lengths > 0
+    valid[valid] = np.abs(directions[valid, 2]) >= MIN_AXIAL_COSINE * lengths[valid]
+    if not valid.any():
+        return None
+    candidates = Line(starts[valid], directions[valid] / lengths[valid, np.newaxis])
+    counts = (_squared_distances(points, candidates) < INLIER_DISTANCE**2).sum(axis=0)
+    best = int(np.argmax(counts))
+    line, inliers = _refine(
+        points,
+        _squared_distances(
+            points, Line(candidates.point[[best]], candidates.direction[[best]])
+        )[:, 0]
+        < INLIER_DISTANCE**2,
+    )
+    if (
+        inliers.sum() < MIN_BAR_POINTS
+        or np.ptp((points[inliers] - line.point) @ line.direction) < MIN_BAR_LENGTH
+        or abs(line.direction[2]) < MIN_AXIAL_COSINE
+    ):
+        return None
+    return line, inliers
+
+
+def _fit_bars(points: np.ndarray, rng: np.random.Generator) -> Optional[list[Line]]:
+    """The three bars of a plate, each fitted to the points left by the others"""
+    bars = []
+    for _ in range(3):
+        if len(points) < MIN_BAR_POINTS:
+            return None
+        fitted = _fit_line(points, rng)
+        if fitted is None:
+            return None
+        bars.append(fitted[0])
+        points = points[~fitted[1]]
+    return bars
+
+
+def _crossing(first: Line, second: Line) -> np.ndarray:
+    """Midpoint of the closest points of two lines that are not parallel"""
+    w = first.point - second.point
+    b = first.direction @ second.direction
+    d, e = first.direction @ w, second.direction @ w
+    denominator = 1 - b**2
+    t, s = (b * e - d) / denominator, (e - b * d) / denominator
+    return (first.point + t * first.direction + second.point + s * second.direction) / 2
+
+
+def _foot(point: np.ndarray, line: Line) -> np.ndarray:
+    return line.point + ((point - line.point) @ line.direction) * line.direction
+
+
+def _plate_labellings(bars: list[Line]) -> Optional[list[np.ndarray]]:
+    """Both labellings of the (4, 3) nodes of a plate, in PLATE_NODES order"""
+    cosines = {
+        (i, j): abs(bars[i].direction @ bars[j].direction)
+        for i, j in ((0, 1), (0, 2), (1, 2))
+    }
+    rods = max(cosines, key=cosines.__getitem__)
+    if cosines[rods] < MIN_PARALLEL_COSINE:
+        return None
+    first_rod, second_rod = bars[rods[0]], bars[rods[1]]
+    diagonal = bars[3 - sum(rods)]
+    if abs(diagonal.direction @ first_rod.direction) > MIN_PARALLEL_COSINE:
+        return None
+    first = _crossing(diagonal, first_rod)
+    second = _crossing(diagonal, second_rod)
+    return [
+        np.array([first, second, _foot(second, first_rod), _foot(first, second_rod)]),
+        np.array([second, first, _foot(first, second_rod), _foot(second, first_rod)]),
+    ]
+
+
+def _rotation_angle(matrix: np.ndarray) -> float:
+    return math.acos(np.clip((np.trace(matrix[:3, :3]) - 1) / 2, -1.0, 1.0))
+
+
+def fit_frame_pose(
+    points: np.ndarray, frame: FrameProtocol, modality: str, seed: int = 0
+) -> Optional[np.ndarray]:
+    """4x4 matrix that maps the (N, 3) points onto the frame, or None when the
+    bars could not be fitted or the nodes do not fit the frame"""
+    if not _has_bars(frame, modality):
+        logger.debug("The frame does not have the bars of a Leksell box")
+        return None
+    plates = _split_plates(points, frame.dimensions[0])
+    if plates is None:
+        return None
+
+    rng = np.random.default_rng(seed)
+    labellings = []
+    for plate_points in plates:
+        bars = _fit_bars(plate_points, rng)
+        plate_labellings = None if bars is None else _plate_labellings(bars)
+        if plate_labellings is None:
+            return None
+        labellings.append(plate_labellings)
+
+    frame_nodes = np.asarray(frame.nodes, dtype=np.float64)[np.concatenate(PLATE_NODES)]
+    best: Optional[tuple[float, np.ndarray]] = None
+    for right in labellings[0]:
+        for left in labellings[1]:
+            nodes = np.concatenate((right, left))
+            matrix = icp.rigid_transform(nodes, frame_nodes)
+            residuals = icp.transform_points(matrix, nodes) - frame_nodes
+            rms = math.sqrt((residuals**2).sum(axis=1).mean())
+            angle = _rotation_angle(matrix)
+            logger.debug(f"Bar nodes fit with {rms:.2f} mm rms, rotation {angle:.3f}")
+            if rms <= MAX_NODE_RMS and angle <= MAX_ROTATION:
+                if best is None or angle < best[0]:
+                    best = (angle, matrix)
+    return None if best is None else best[1]
@@ -0,0 +1,220 @@
+"""Calculate frame transforms for many images on a pool of processes.
+
+A batch is described by a manifest, which is either a directory of images of
+one modality, or a csv file with image, modality and (optionally) output
+columns. Every case writes its transform and a json summary with its status,
+detection errors and timing next to it. A failing case is recorded as such
+and does not stop the rest of the batch."""
+
+from __future__ import annotations
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import csv
+import json
+import logging
+from pathlib import Path
+import time
+import traceback
+from typing import Any, NamedTuple, Optional
+
+import SimpleITK as sitk
+
+from stereotacticframe.cache import ResultCache
+from stereotacticframe.pipeline import RegistrationOptions, calculate_frame_transform
+
+logger = logging.getLogger(__name__)
+
+IMAGE_SUFFIXES = (".nii", ".nii.gz", ".mha", ".mhd", ".nrrd")
+
+CaseSummary = dict[str, Any]
+
+
+class BatchCase(NamedTuple):
+    image_path: Path
+    modality: str
+    output_transform_path: Path
+
+
+def _image_stem(image_path: Path) -> str:
+    for suffix in IMAGE_SUFFIXES:
+        if image_path.name.endswith(suffix):
+            return image_path.name[: -len(suffix)]
+    return image_path.stem
+
+
+def _default_output(image_path: Path, output_dir: Path) -> Path:
+    return output_dir.joinpath(_image_stem(image_path) + ".txt")
+
+
+def read_manifest(
+    manifest_path: Path, output_dir: Path, modality: Optional[str] = None
+) -> list[BatchCase]:
+    """Cases from a directory of images or from a csv manifest.
+
+    For a directory all images get the given modality. The csv needs image and
+    modality columns and can have an output column; relative paths are
+    relative to the csv file. Without output the transform goes to output_dir."""
+    if manifest_path.is_dir():
+        if modality is None:
+            raise ValueError("A modality is needed for a directory of images")
+        image_paths = sorted(
+            path
+            for path in manifest_path.iterdir()
+            if path.name.endswith(IMAGE_SUFFIXES)
+        )
+        return [
+            BatchCase(path, modality, _default_output(path, output_dir))
+            for path in image_paths
+        ]
+
+    cases = []
+    with open(manifest_path, newline="") as manifest_file:
+        for row in csv.DictReader(manifest_file):
+            image_path = manifest_path.parent.joinpath(row["image"])
+            output = row.get("output")
+            cases.append(
+                BatchCase(
+                    image_path,
+                    row.get("modality") or modality or "",
+                    manifest_path.parent.joinpath(output)
+                    if output
+                    else _default_output(image_path, output_dir),
+                )
+            )
+    return cases
+
+
+def _summary_path(case: BatchCase) -> Path:
+    return case.output_transform_path.with_suffix(".json")
+
+
+def _failed_summary(case: BatchCase, error: str, seconds: float) -> CaseSummary:
+    return {
+        "image": str(case.image_path),
+        "modality": case.modality,
+        "transform": None,
+        "status": "failed",
+        "error": error,
+        "mean_error": None,
+        "max_error": None,
+        "seconds": seconds,
+        "cached": False,
+    }
+
+
+def run_case(
+    case: BatchCase,
+    options: RegistrationOptions,
+    cache: Optional[ResultCache] = None,
+) -> CaseSummary:
+    """Calculate and write the transform of one case, never raises"""
+    start = time.perf_counter()
+    try:
+        result = calculate_frame_transform(
+            case.image_path, case.modality, options, cache=cache
+        )
+        case.output_transform_path.parent.mkdir(parents=True, exist_ok=True)
+        sitk.WriteTransform(result.transform, str(case.output_transform_path))
+        summary = {
+            "image": str(case.image_path),
+            "modality": case.modality,
+            "transform": str(case.output_transform_path),
+            "status": "ok",
+            "error": None,
+            "mean_error": float(result.mean_error),
+            "max_error": float(result.max_error),
+            "seconds": time.perf_counter() - start,
+            "cached": result.cached,
+        }
+    except Exception:
+        summary = _failed_summary(
+            case, traceback.format_exc(), time.perf_counter() - start
+        )
+
+    try:
+        _summary_path(case).parent.mkdir(parents=True, exist_ok=True)
+        with open(_summary_path(case), "w") as summary_file:
+            json.dump(summary, summary_file, indent=2)
+    except OSError:
+        logger.exception(f"Could not write the summary of {case.image_path}")
+    return summary
+
+
+def _summary_of(case: BatchCase, future: Future[CaseSummary]) -> CaseSummary:
+    try:
+        return future.result()
+    except Exception:
+        # e.g. the worker process died, run_case itself never raises
+        return _failed_summary(case, traceback.format_exc(), 0.0)
+
+
+def _run_isolated(
+    cases: list[BatchCase],
+    options: RegistrationOptions,
+    cache: Optional[ResultCache],
+) -> list[CaseSummary]:
+    """Every case in a process of its own, so that a case that kills its
+    process only fails itself"""
+    executors = [ProcessPoolExecutor(max_workers=1) for _ in cases]
+    try:
+        futures = [
+            executor.submit(run_case, case, options, cache)
+            for executor, case in zip(executors, cases)
+        ]
+        return [_summary_of(case, future) for case, future in zip(cases, futures)]
+    finally:
+        for executor in executors:
+            executor.shutdown()
+
+
+def run_batch(
+    cases: list[BatchCase],
+    options: RegistrationOptions = RegistrationOptions(),
+    n_processes: int = 1,
+    cache: Optional[ResultCache] = None,
+) -> list[CaseSummary]:
+    """Run all cases, on n_processes processes, and return their summaries in order.
+
+    A case that kills its worker, e.g. by a segfault or by running out of
+    memory, breaks the pool for all cases that did not finish. The cases
+    that the pool had started then run again in a process each, and the
+    others in a new pool."""
+    if n_processes <= 1:
+        return [run_case(case, options, cache) for case in cases]
+
+    summaries: dict[int, CaseSummary] = {}
+    remaining = list(range(len(cases)))
+    while remaining:
+        broken: list[int] = []
+        with ProcessPoolExecutor(max_workers=n_processes) as executor:
+            futures = {
+                index: executor.submit(run_case, cases[index], options, cache)
+                for index in remaining
+            }
+            for index in remaining:
+                try:
+                    summaries[index] = futures[index].result()
+                except BrokenProcessPool:
+                    broken.append(index)
+                    continue
+                except Exception:
+                    summaries[index] = _failed_summary(
+                        cases[index], traceback.format_exc(), 0.0
+                    )
+                logger.info(f"{cases[index].image_path}: {summaries[index]['status']}")
+        # The pool hands out the cases in order, to at most one more than it
+        # has processes at a time, so the case that broke it is among these
+        suspects, remaining = broken[: n_processes + 1], broken[n_processes + 1 :]
+        if suspects:
+            logger.warning(
+                f"A worker process died, running {len(suspects)} cases again "
+                "in a process each"
+            )
+        for index, summary in zip(
+            suspects,
+            _run_isolated([cases[index] for index in suspects], options, cache),
+        ):
+            summaries[index] = summary
+            logger.info(f"{cases[index].image_path}: {summary['status']}")
+    return [summaries[index] for index in range(len(cases))]
@@ -1,6 +1,12 @@
+from __future__ import annotations
+
 import SimpleITK as sitk
+import numpy as np
 import logging
 
+from stereotacticframe import profiling
+from stereotacticframe.geometry import ImageGeometry
+
 
 def _get_label_statistics(label_img: sitk.Image, img: sitk.Image):
     label_statistics = sitk.LabelIntensityStatisticsImageFilter()
@@ -10,6 +16,9 @@ def _get_label_statistics(label_img: sitk.Image, img: sitk.Image):
 
 modality_thresholds = {"MR": 65, "CT": 750}
 
+MIN_BLOB_AREA = 1.0  # [mm²]
+MAX_BLOB_AREA = 30.0  # [mm²]
+
 
 def detect_blobs(
     img_slice: sitk.Image, mask_slice: sitk.Image, modality: str
@@ -19,7 +28,11 @@ def detect_blobs(
     blobs_list = []
 
     for label_idx in label_statistics.GetLabels():
-        if not 1 < label_statistics.GetPhysicalSize(label_idx) < 30.0:  # [mm²]
+        if (
+            not MIN_BLOB_AREA
+            < label_statistics.GetPhysicalSize(label_idx)
+            < MAX_BLOB_AREA
+        ):
             continue
 
         if not label_statistics.GetMean(label_idx) > modality_thresholds[modality]:
@@ -28,3 +41,136 @@ def detect_blobs(
         blobs_list.append(label_statistics.GetCenterOfGravity(label_idx))
 
     return blobs_list
+
+
+def _label_slices(mask_array: np.ndarray) -> tuple[sitk.Image, np.ndarray]:
+    """Label the 2D connected components of every slice of a (z, y, x) mask at once.
+
+    The slices are stacked on top of each other in one 2D image with an empty
+    row in between, so components can never connect across slices. The labels
+    come out in the same raster order as labeling every slice separately."""
+    n_slices, n_rows, n_columns = mask_array.shape
+    stacked = np.zeros((n_slices, n_rows + 1, n_columns), dtype=np.uint8)
+    stacked[:, :n_rows] = mask_array > 0
+    label_image = sitk.ConnectedComponent(
+        sitk.GetImageFromArray(stacked.reshape(-1, n_columns))
+    )
+    # keep the image alive together with the view on its buffer
+    labels = sitk.GetArrayViewFromImage(label_image).reshape(
+        n_slices, n_rows + 1, n_columns
+    )
+    return label_image, labels
+
+
+def detect_blobs_in_arrays(
+    image_array: np.ndarray,
+    mask_array: np.ndarray,
+    geometry: ImageGeometry,
+    modality: str,
+) -> np.ndarray:
+    """Detect blobs in all axial slices of a (z, y, x) volume in one pass.
+
+    Applies the same area and intensity criteria as detect_blobs and returns an
+    (N, 3) array of blob centers, ordered by slice, with the physical z
+    coordinate of their slice as third column."""
+    with profiling.stage("label slices", accumulate=True) as record:
+        _label_image, labels = _label_slices(mask_array)
+        record.set(slices=len(mask_array))
+
+    pixel_area = geometry.spacing[0] * geometry.spacing[1]
+    areas = np.bincount(labels.ravel()) * pixel_area
+    candidates = (MIN_BLOB_AREA < areas) & (areas < MAX_BLOB_AREA)
+    candidates[0] = False  # background
+    if not candidates.any():
+        return np.empty((0, 3))
+
+    z, y, x = np.nonzero(candidates[labels])
+    candidate_labels, inverse = np.unique(labels[z, y, x], return_inverse=True)
+    intensities = image_array[z, y, x].astype(np.float64)
+
+    counts = np.bincount(inverse)
+    intensity_sums = np.bincount(inverse, weights=intensities)
+    keep = intensity_sums / counts > modality_thresholds[modality]
+
+    center_x = np.bincount(inverse, weights=intensities * x)[keep]
+    center_y = np.bincount(inverse, weights=intensities * y)[keep]
+    slice_indices = np.zeros(len(candidate_labels))
+    slice_indices[inverse] = z
+    slice_indices = slice_indices[keep]
+    intensity_sums = intensity_sums[keep]
+
+    centers = geometry.index_to_physical(
+        np.column_stack(
+            (
+                center_x / intensity_sums,
+                center_y / intensity_sums,
+                slice_indices,
+            )
+        )
+    )
+    slice_origins = geometry.index_to_physical(
+        np.column_stack(
+            (np.zeros_like(slice_indices), np.zeros_like(slice_indices), slice_indices)
+        )
+    )
+    # the z coordinate of a blob is the z coordinate of its slice
+    centers[:, 2] = slice_origins[:, 2]
+    return centers
+
+
+def detect_blobs_in_volume(
+    image: sitk.Image, mask: sitk.Image, modality: str
+) -> np.ndarray:
+    return detect_blobs_in_arrays(
+        sitk.GetArrayViewFromImage(image),
+        sitk.GetArrayViewFromImage(mask),
+        ImageGeometry.from_image(image),
+        modality,
+    )
+
+
+class VolumeBlobDetector:
+    """Blob detector that labels every axial slice of a volume at once.
+
+    It can be used wherever a per slice blob detector is expected, the
+    FrameDetector switches to detect_volume when the slice provider can hand
+    out the whole volume."""
+
+    def __call__(
+        self, img_slice: sitk.Image, mask_slice: sitk.Image, modality: str
+    ) -> list[tuple[float, float]]:
+        return detect_blobs(img_slice, mask_slice, modality)
+
+    def detect_volume(
+        self,
+        image_array: np.ndarray,
+        mask_array: np.ndarray,
+        geometry: ImageGeometry,
+        modality: str,
+    ) -> np.ndarray:
+        return detect_blobs_in_arrays(image_array, mask_array, geometry, modality)
+
+
+class ArrayBlobDetector:
+    """Blob detector for numpy views on single axial slices.
+
+    The FrameDetector hands it the views of a provider with get_array_pair,
+    so no image is made per slice. As a plain blob detector it falls back to
+    detect_blobs."""
+
+    def __call__(
+        self, img_slice: sitk.Image, mask_slice: sitk.Image, modality: str
+    ) -> list[tuple[float, float]]:
+        return detect_blobs(img_slice, mask_slice, modality)
+
+    def detect_arrays(
+        self,
+        image_slice: np.ndarray,
+        mask_slice: np.ndarray,
+        geometry: ImageGeometry,
+        modality: str,
+    ) -> np.ndarray:
+        """(N, 3) blob centers of a (y, x) slice, whose origin is in geometry"""
+        return detect_blobs_in_arrays(
+            image_slice[np.newaxis], mask_slice[np.newaxis], geometry, modality
+        )
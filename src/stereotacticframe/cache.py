@@ -0,0 +1,160 @@
+"""On-disk cache of calculated frame transforms.
+
+Results are keyed by a hash of the image content, the modality, the frame
+type, the registration options and the package version, so a changed image or
+a new release never returns a stale transform. When the cache grows beyond
+max_bytes, the least recently used results are removed."""
+
+from __future__ import annotations
+
+import hashlib
+from importlib import metadata
+import json
+import os
+from pathlib import Path
+import tempfile
+from typing import Any, Optional
+
+import SimpleITK as sitk
+
+from stereotacticframe.frame_protocol import FrameProtocol
+
+DEFAULT_MAX_BYTES = 256 * 2**20
+_CHUNK_SIZE = 2**20
+
+
+def _package_version() -> str:
+    try:
+        return metadata.version("StereotacticFrame")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def _hash_path(digest: Any, path: Path) -> None:
+    """Hash the content of a file, or of all files in a directory"""
+    paths = (
+        sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+    )
+    for file_path in paths:
+        digest.update(
+            str(file_path.relative_to(path)).encode() if path.is_dir() else b""
+        )
+        with open(file_path, "rb") as file:
+            for chunk in iter(lambda: file.read(_CHUNK_SIZE), b""):
+                digest.update(chunk)
+
+
+def _write_atomically(path: Path, write: Any) -> None:
+    """write(temporary_path) and move the result into place in one step"""
+    file_descriptor, temporary_path = tempfile.mkstemp(
+        dir=path.parent, suffix=path.suffix
+    )
+    os.close(file_descriptor)
+    try:
+        write(temporary_path)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+class ResultCache:
+    def __init__(self, directory: Path, max_bytes: int = DEFAULT_MAX_BYTES):
+        self._directory: Path = Path(directory)
+        self._max_bytes: int = max_bytes
+        self._directory.mkdir(parents=True, exist_ok=True)
+
+    def key(
+        self, image_path: Path, modality: str, frame: FrameProtocol, options: Any = None
+    ) -> str:
+        digest = hashlib.sha256()
+        _hash_path(digest, Path(image_path))
+        for part in (
+            modality,
+            f"{type(frame).__module__}.{type(frame).__qualname__}",
+            repr(options),
+            _package_version(),
+        ):
+            digest.update(b"\0" + part.encode())
+        return digest.hexdigest()
+
+    def _transform_path(self, key: str) -> Path:
+        return self._directory.joinpath(key + ".txt")
+
+    def _metrics_path(self, key: str) -> Path:
+        return self._directory.joinpath(key + ".json")
+
+    def get(self, key: str) -> Optional[tuple[sitk.Transform, dict[str, float]]]:
+        """Cached transform and metrics, or None on a miss"""
+        transform_path, metrics_path = (
+            self._transform_path(key),
+            self._metrics_path(key),
+        )
+        try:
+            with open(metrics_path) as metrics_file:
+                metrics = json.load(metrics_file)
+            transform = sitk.ReadTransform(str(transform_path))
+            # mark as recently used
+            os.utime(transform_path)
+            os.utime(metrics_path)
+        except (OSError, RuntimeError, ValueError):
+            return None
+        return transform, metrics
+
+    def put(
+        self, key: str, transform: sitk.Transform, metrics: dict[str, float]
+    ) -> None:
+        _write_atomically(
+            self._transform_path(key),
+            lambda path: sitk.WriteTransform(transform, path),
+        )
+
+        def write_metrics(path: str) -> None:
+            with open(path, "w") as metrics_file:
+                json.dump(metrics, metrics_file)
+
+        # metrics last, get only trusts entries that have them
+        _write_atomically(self._metrics_path(key), write_metrics)
+        self._evict()
+
+    def size(self) -> int:
+        return sum(stat.st_size for _, stat in self._entry_stats())
+
+    def clear(self) -> None:
+        for path in self._entry_files():
+            path.unlink(missing_ok=True)
+
+    def _entry_files(self) -> list[Path]:
+        return [
+            path
+            for path in self._directory.iterdir()
+            if path.suffix in (".txt", ".json") and len(path.stem) == 64
+        ]
+
+    def _entry_stats(self) -> list[tuple[Path, os.stat_result]]:
+        """The entry files that are still there, other processes that share the
+        directory can remove any of them in the meantime"""
+        stats = []
+        for path in self._entry_files():
+            try:
+                stats.append((path, path.stat()))
+            except FileNotFoundError:
+                continue
+        return stats
+
+    def _evict(self) -> None:
+        """Remove the least recently used entries until the cache fits"""
+        entries: dict[str, list[tuple[Path, os.stat_result]]] = {}
+        for path, stat in self._entry_stats():
+            entries.setdefault(path.stem, []).append((path, stat))
+
+        def last_used(key: str) -> float:
+            return max(stat.st_mtime for _, stat in entries[key])
+
+        total = sum(stat.st_size for files in entries.values() for _, stat in files)
+        for key in sorted(entries, key=last_used):
+            if total <= self._max_bytes:
+                break
+            for path, stat in entries[key]:
+                total -= stat.st_size
+                path.unlink(missing_ok=True)
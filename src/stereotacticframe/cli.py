@@ -1,18 +1,53 @@
 import typer
 
+from enum import Enum
 import SimpleITK as sitk
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Tuple
+import json
 import logging
 
+from stereotacticframe.alignment import ICP_ENGINES, INITIAL_POSES
 from stereotacticframe.frames import LeksellFrame
-from stereotacticframe.frame_detector import FrameDetector
-from stereotacticframe.slice_provider import AxialSliceProvider
-from stereotacticframe.blob_detection import detect_blobs
-from stereotacticframe.preprocessor import Preprocessor
-from stereotacticframe.transforms import apply_transform
+from stereotacticframe.cache import DEFAULT_MAX_BYTES, ResultCache
+from stereotacticframe.dicom import read_image
+from stereotacticframe.memory import parse_size
+from stereotacticframe import profiling
+from stereotacticframe.transforms import (
+    apply_transform,
+    apply_transform_streamed,
+    apply_transform_to_files,
+)
 
 app = typer.Typer()
+logger = logging.getLogger(__name__)
+
+# Choices, so typer rejects other values before any image is read
+IcpEngine = Enum("IcpEngine", {name: name for name in ICP_ENGINES}, type=str)
+InitialPose = Enum("InitialPose", {name: name for name in INITIAL_POSES}, type=str)
+
+
+def _result_cache(
+    cache_dir: Optional[Path], no_cache: bool, clear_cache: bool, cache_max_mb: int
+) -> Optional[ResultCache]:
+    """The cache is opt-in with cache_dir, no_cache bypasses it"""
+    if cache_dir is None:
+        return None
+    cache = ResultCache(cache_dir, cache_max_mb * 2**20)
+    if clear_cache:
+        cache.clear()
+    if no_cache:
+        return None
+    return cache
+
+
+def _max_memory(max_memory: Optional[str]) -> int:
+    if max_memory is None:
+        return 0
+    try:
+        return parse_size(max_memory)
+    except ValueError as error:
+        raise typer.BadParameter(str(error)) from error
 
 
 @app.command()
@@ -23,6 +58,26 @@ def calculate(
     log_dir: Optional[Path],
     logging_on: bool = False,
     visualization: bool = False,
+    slab_size: int = 0,
+    n_workers: int = 1,
+    icp_engine: IcpEngine = IcpEngine.vtk,
+    crop_to_frame: bool = False,
+    threshold_shrink: int = 1,
+    closing_shrink: int = 1,
+    slice_closing: bool = False,
+    icp_tolerance: Optional[float] = None,
+    series_uid: Optional[str] = None,
+    z_range: Optional[Tuple[float, float]] = None,
+    z_stride: float = 0.0,
+    points_per_bar: int = 0,
+    init_transform: Optional[Path] = None,
+    initial_pose: InitialPose = InitialPose.icp,
+    max_memory: Optional[str] = None,
+    cache_dir: Optional[Path] = None,
+    no_cache: bool = False,
+    clear_cache: bool = False,
+    cache_max_mb: int = DEFAULT_MAX_BYTES // 2**20,
+    profile: Optional[Path] = None,
 ) -> None:
     if log_dir:
         fh = logging.FileHandler(log_dir)
@@ -32,36 +87,196 @@ def calculate(
     if logging_on:
         logging.root.setLevel(logging.DEBUG)
 
-    # This could be generalized to any frame with a frame option
-    frame = LeksellFrame()
+    # imported here, since importing VTK and pyvista takes longer than most
+    # apply commands, which do not need them
+    from stereotacticframe.pipeline import (
+        RegistrationOptions,
+        calculate_frame_transform,
+    )
 
-    preprocessor = Preprocessor(modality)
+    options = RegistrationOptions(
+        visualization,
+        slab_size,
+        n_workers,
+        icp_engine.value,
+        crop_to_frame,
+        threshold_shrink,
+        closing_shrink,
+        slice_closing,
+        icp_tolerance,
+        series_uid,
+        z_range,
+        z_stride,
+        points_per_bar,
+        init_transform,
+        initial_pose.value,
+        _max_memory(max_memory),
+    )
+    cache = _result_cache(cache_dir, no_cache, clear_cache, cache_max_mb)
+    stage_profile = profiling.Profile() if profile else None
+    result = calculate_frame_transform(
+        input_image_path, modality, options, cache=cache, profile=stage_profile
+    )
+    if result.cached:
+        logger.info("Using the cached transform")
+    elif not result.warm_started and (
+        init_transform or initial_pose is InitialPose.bars
+    ):
+        logger.info("The initial pose did not fit, used the full alignment")
 
-    provider = AxialSliceProvider(input_image_path, preprocessor)
+    if not output_transform_path:
+        output_transform_path = Path("./output.txt")
 
-    # bit anoying that I have to give modality as input for preprocessor and for framedetector
-    detector = FrameDetector(frame, provider, detect_blobs, modality, visualization)
+    with profiling.activate(stage_profile), profiling.stage("write transform"):
+        sitk.WriteTransform(result.transform, output_transform_path)
 
-    detector.detect_frame()
+    if stage_profile is not None and profile is not None:
+        stage_profile.write_json(profile)
 
-    transform = detector.get_transform_to_frame_space()
+    peak = profiling.peak_rss_mb()
+    if peak is not None and options.max_memory > 0:
+        budget = options.max_memory / 2**20
+        message = f"Peak memory {peak:.0f} MB, of a {budget:.0f} MB budget"
+        if peak > budget:
+            logger.warning(message)
+        else:
+            logger.info(message)
+    elif peak is not None:
+        logger.info(f"Peak memory {peak:.0f} MB")
 
-    if not output_transform_path:
-        output_transform_path = Path("./output.txt")
 
-    sitk.WriteTransform(transform, output_transform_path)
+@app.command("calculate-batch")
+def calculate_batch(
+    manifest_path: Path,
+    output_dir: Path,
+    modality: Optional[str] = None,
+    n_processes: int = 1,
+    slab_size: int = 0,
+    n_workers: int = 1,
+    icp_engine: IcpEngine = IcpEngine.vtk,
+    crop_to_frame: bool = False,
+    threshold_shrink: int = 1,
+    closing_shrink: int = 1,
+    slice_closing: bool = False,
+    icp_tolerance: Optional[float] = None,
+    z_stride: float = 0.0,
+    points_per_bar: int = 0,
+    initial_pose: InitialPose = InitialPose.icp,
+    max_memory: Optional[str] = None,
+    cache_dir: Optional[Path] = None,
+    no_cache: bool = False,
+    clear_cache: bool = False,
+    cache_max_mb: int = DEFAULT_MAX_BYTES // 2**20,
+) -> None:
+    """Calculate the transforms of a directory of images or of a csv manifest"""
+    from stereotacticframe.batch import read_manifest, run_batch
+    from stereotacticframe.pipeline import RegistrationOptions
+
+    cases = read_manifest(manifest_path, output_dir, modality)
+    options = RegistrationOptions(
+        False,
+        slab_size,
+        n_workers,
+        icp_engine.value,
+        crop_to_frame,
+        threshold_shrink,
+        closing_shrink,
+        slice_closing,
+        icp_tolerance,
+        z_stride=z_stride,
+        points_per_bar=points_per_bar,
+        initial_pose=initial_pose.value,
+        max_memory=_max_memory(max_memory),
+    )
+    cache = _result_cache(cache_dir, no_cache, clear_cache, cache_max_mb)
+    summaries = run_batch(cases, options, n_processes, cache)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(output_dir.joinpath("summary.json"), "w") as summary_file:
+        json.dump(summaries, summary_file, indent=2)
+
+    n_failed = sum(summary["status"] != "ok" for summary in summaries)
+    logger.info(f"{len(summaries) - n_failed} of {len(summaries)} cases succeeded")
+    if n_failed:
+        raise typer.Exit(code=1)
 
 
 @app.command()
-def apply(image_path: Path, transform_path: Path, output_image_path: Path):
+def apply(
+    image_path: Path,
+    transform_path: Path,
+    output_image_path: Path,
+    slab_size: int = 0,
+    series_uid: Optional[str] = None,
+):
+    if slab_size > 0 and (series_uid is not None or image_path.is_dir()):
+        raise typer.BadParameter(
+            "A DICOM series can not be streamed, leave out --slab-size"
+        )
     frame = LeksellFrame()
-
-    image = sitk.ReadImage(image_path)
     transform = sitk.ReadTransform(transform_path)
 
+    if slab_size > 0:
+        # Bounded memory, the output has to be a .mha file
+        apply_transform_streamed(
+            image_path, transform, output_image_path, frame, slab_size=slab_size
+        )
+        return
+
+    image = read_image(image_path, series_uid)
     sitk.WriteImage(apply_transform(image, transform, frame), output_image_path)
 
 
+@app.command("apply-many")
+def apply_many(
+    transform_path: Path,
+    output_dir: Path,
+    image_paths: List[Path],
+    n_workers: int = 4,
+) -> None:
+    """Put many images in frame space, they are written to output_dir by name"""
+    output_paths = [output_dir.joinpath(path.name) for path in image_paths]
+    if len(set(output_paths)) < len(output_paths):
+        raise typer.BadParameter("The images should have different file names")
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    apply_transform_to_files(
+        image_paths,
+        sitk.ReadTransform(transform_path),
+        output_paths,
+        LeksellFrame(),
+        n_workers=n_workers,
+    )
+
+
+@app.command()
+def serve(
+    socket: Optional[Path] = None,
+    spool: Optional[Path] = None,
+    n_processes: int = 1,
+    poll_interval: float = 0.5,
+    cache_dir: Optional[Path] = None,
+    cache_max_mb: int = DEFAULT_MAX_BYTES // 2**20,
+) -> None:
+    """Run calculate and apply jobs from a Unix socket or a spool directory"""
+    if (socket is None) == (spool is None):
+        raise typer.BadParameter("Give either --socket or --spool")
+    from stereotacticframe import server
+
+    cache = _result_cache(cache_dir, False, False, cache_max_mb)
+    with server.job_executor(n_processes) as executor:
+        try:
+            if socket is not None:
+                with server.JobServer(socket, executor, cache) as job_server:
+                    logger.info(f"Serving jobs on {socket}")
+                    job_server.serve_forever()
+            elif spool is not None:
+                logger.info(f"Running the jobs in {spool}")
+                server.serve_spool(spool, executor, cache, poll_interval)
+        except KeyboardInterrupt:
+            logger.info("Stopped serving")
+
+
 def main() -> None:
     logging.basicConfig(level=logging.INFO)
     app()
@@ -0,0 +1,147 @@
+"""Reading a DICOM series straight from its directory.
+
+The files of one series are selected by series instance uid, and sorted along
+the slice normal by GDCM. With more than one worker the slices are decoded
+concurrently into one buffer. With a z_range, the headers are read first and
+only the slices that overlap that range of patient z coordinates are
+decoded, e.g. only the part of the scan that holds the frame."""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import SimpleITK as sitk
+
+logger = logging.getLogger(__name__)
+
+ZRange = tuple[float, float]  # [mm] minimum and maximum patient z (LPS)
+
+
+def series_uids(directory: Path) -> list[str]:
+    return list(sitk.ImageSeriesReader.GetGDCMSeriesIDs(str(directory)))
+
+
+def series_file_names(directory: Path, series_uid: Optional[str] = None) -> list[str]:
+    """Files of the series, sorted along the slice normal.
+
+    Without a series_uid the directory should hold a single series."""
+    uids = series_uids(directory)
+    if not uids:
+        raise ValueError(f"No DICOM series found in {directory}")
+    if series_uid is None:
+        if len(uids) > 1:
+            raise ValueError(
+                f"{directory} holds {len(uids)} series, select one of {uids}"
+            )
+        series_uid = uids[0]
+    elif series_uid not in uids:
+        raise ValueError(f"Series {series_uid} not found in {directory}")
+    return list(
+        sitk.ImageSeriesReader.GetGDCMSeriesFileNames(str(directory), series_uid)
+    )
+
+
+def _slice_reader(file_name: str) -> sitk.ImageFileReader:
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO("GDCMImageIO")  # skips guessing the format of every file
+    reader.SetFileName(file_name)
+    return reader
+
+
+def _z_extent(file_name: str) -> ZRange:
+    """Patient z range covered by a slice, which can be tilted"""
+    reader = _slice_reader(file_name)
+    reader.ReadImageInformation()
+    direction = np.asarray(reader.GetDirection()).reshape(3, 3)
+    size, spacing = reader.GetSize(), reader.GetSpacing()
+    corner_z = [
+        reader.GetOrigin()[2]
+        + direction[2, 0] * i * spacing[0]
+        + direction[2, 1] * j * spacing[1]
+        for i in (0, size[0] - 1)
+        for j in (0, size[1] - 1)
+    ]
+    return min(corner_z), max(corner_z)
+
+
+def _in_z_range(
+    file_names: list[str], z_range: ZRange, executor: ThreadPoolExecutor
+) -> list[str]:
+    minimum, maximum = z_range
+    return [
+        file_name
+        for file_name, (lower, upper) in zip(
+            file_names, executor.map(_z_extent, file_names)
+        )
+        if upper >= minimum and lower <= maximum
+    ]
+
+
+def _read_slices(file_names: list[str], executor: ThreadPoolExecutor) -> sitk.Image:
+    """Decodes the slices concurrently, with the geometry of a series read"""
+    first = _slice_reader(file_names[0]).Execute()
+    array = np.empty(
+        (len(file_names), *sitk.GetArrayViewFromImage(first).shape[1:]),
+        dtype=sitk.GetArrayViewFromImage(first).dtype,
+    )
+    array[0] = sitk.GetArrayViewFromImage(first)[0]
+
+    def decode(index: int) -> tuple[float, ...]:
+        reader = _slice_reader(file_names[index])
+        # the same pixel type as the first slice, like a series reader
+        reader.SetOutputPixelType(first.GetPixelID())
+        axial_slice = reader.Execute()
+        array[index] = sitk.GetArrayViewFromImage(axial_slice)[0]
+        return axial_slice.GetOrigin()
+
+    origins = [first.GetOrigin(), *executor.map(decode, range(1, len(file_names)))]
+
+    image = sitk.GetImageFromArray(array)
+    image.SetOrigin(first.GetOrigin())
+    image.SetDirection(first.GetDirection())
+    spacing = list(first.GetSpacing())
+    if len(origins) > 1:
+        normal = np.asarray(first.GetDirection()).reshape(3, 3)[:, 2]
+        distances = np.diff(np.asarray(origins) @ normal)
+        spacing[2] = float(distances.sum() / len(distances))
+        if np.ptp(distances) > 0.01 * abs(spacing[2]):
+            logger.warning("The slices are not evenly spaced, using the mean spacing")
+    image.SetSpacing(spacing)
+    return image
+
+
+def read_series(
+    directory: Path,
+    series_uid: Optional[str] = None,
+    z_range: Optional[ZRange] = None,
+    n_workers: int = 1,
+) -> sitk.Image:
+    file_names = series_file_names(directory, series_uid)
+    with ThreadPoolExecutor(max(1, n_workers)) as executor:
+        if z_range is not None:
+            file_names = _in_z_range(file_names, z_range, executor)
+            if not file_names:
+                raise ValueError(f"No slices of the series in z range {z_range}")
+        logger.debug(f"Decoding {len(file_names)} slices with {n_workers} workers")
+        if n_workers > 1:
+            return _read_slices(file_names, executor)
+    # a single series read is faster than decoding the slices one by one
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(file_names)
+    return reader.Execute()
+
+
+def read_image(
+    image_path: Path,
+    series_uid: Optional[str] = None,
+    z_range: Optional[ZRange] = None,
+    n_workers: int = 1,
+) -> sitk.Image:
+    """Reads an image file, or the DICOM series in a directory"""
+    if Path(image_path).is_dir():
+        return read_series(Path(image_path), series_uid, z_range, n_workers)
+    return sitk.ReadImage(image_path)
@@ -1,16 +1,35 @@
 from __future__ import annotations
 
-from typing import Protocol, Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Protocol, Callable, Optional, runtime_checkable
 import SimpleITK as sitk
 import numpy as np
 import pyvista as pv
-from vtk import vtkIterativeClosestPointTransform, vtkMatrix4x4
+from vtk import vtkCellLocator, vtkIterativeClosestPointTransform
 import logging
 
+from stereotacticframe import icp, profiling
+from stereotacticframe.alignment import (
+    DEFAULT_SCHEDULE,
+    ICP_ENGINES,
+    INITIAL_POSES,
+    AlignmentSchedule,
+    AlignmentStage,
+    refinement,
+    select_points,
+)
+from stereotacticframe.bar_fit import fit_frame_pose
+from stereotacticframe.frame_models import frame_model
 from stereotacticframe.frame_protocol import FrameProtocol
+from stereotacticframe.geometry import ImageGeometry
+from stereotacticframe.sampling import SliceDetector, SliceSampling, sparse_scan
 
 logger = logging.getLogger(__name__)
 
+# [mm] above this mean distance of the points to the frame, an alignment that
+# started from a prior transform is redone with the full schedule
+WARM_START_MAX_MEAN_ERROR = 0.5
+
 
 class SliceProviderProtocol(Protocol):
     def next_image_mask_pair(self) -> tuple[sitk.Image, sitk.Image]: ...
@@ -20,6 +39,31 @@ class SliceProviderProtocol(Protocol):
     def get_current_z_coordinate(self) -> float: ...
 
 
+@runtime_checkable
+class RandomAccessSliceProviderProtocol(Protocol):
+    def get_number_of_slices(self) -> int: ...
+
+    def get_image_mask_pair(self, index: int) -> tuple[sitk.Image, sitk.Image]: ...
+
+    def get_z_coordinate(self, index: int) -> float: ...
+
+
+@runtime_checkable
+class VolumeProviderProtocol(Protocol):
+    def get_volume_arrays(self) -> tuple[np.ndarray, np.ndarray, ImageGeometry]: ...
+
+
+@runtime_checkable
+class ArraySliceProviderProtocol(Protocol):
+    def get_number_of_slices(self) -> int: ...
+
+    def get_array_pair(
+        self, index: int
+    ) -> tuple[np.ndarray, np.ndarray, ImageGeometry]: ...
+
+    def get_z_coordinate(self, index: int) -> float: ...
+
+
 class PreprocessorProtocol(Protocol):
     def process(self, image: sitk.Image) -> sitk.Image: ...
 
@@ -33,15 +77,46 @@ BlobDetectorType = Callable[
 ]
 
 
-def _create_lines(
-    edges: list[tuple[int, int]], nodes: list[tuple[float, float, float]]
-) -> pv.PolyData:
-    line_mesh = pv.PolyData()
-    for edge in edges:
-        point0 = nodes[edge[0]]
-        point1 = nodes[edge[1]]
-        line_mesh += pv.Line(point0, point1)  # type: ignore
-    return line_mesh  # type: ignore
+@runtime_checkable
+class VolumeBlobDetectorProtocol(Protocol):
+    def __call__(
+        self, img_slice: featureImage, mask_slice: maskImage, modality: modality
+    ) -> list[tuple[float, float]]: ...
+
+    def detect_volume(
+        self,
+        image_array: np.ndarray,
+        mask_array: np.ndarray,
+        geometry: ImageGeometry,
+        modality: modality,
+    ) -> np.ndarray: ...
+
+
+@runtime_checkable
+class ArrayBlobDetectorProtocol(Protocol):
+    def __call__(
+        self, img_slice: featureImage, mask_slice: maskImage, modality: modality
+    ) -> list[tuple[float, float]]: ...
+
+    def detect_arrays(
+        self,
+        image_slice: np.ndarray,
+        mask_slice: np.ndarray,
+        geometry: ImageGeometry,
+        modality: modality,
+    ) -> np.ndarray: ...
+
+
+def _with_z(blobs: list[tuple[float, float]], z_coordinate: float) -> np.ndarray:
+    """(N, 3) points of the 2D blobs of a slice at z_coordinate"""
+    points = np.empty((len(blobs), 3))
+    points[:, :2] = np.asarray(blobs, dtype=np.float64).reshape(-1, 2)
+    points[:, 2] = z_coordinate
+    return points
+
+
+def _point_array(points: np.ndarray) -> np.ndarray:
+    return np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 3)
 
 
 def _iterative_closest_point(
@@ -50,12 +125,22 @@ def _iterative_closest_point(
     iterations: int,
     number_of_landmarks: int = 2_000,
     start_by_mathing_centroids: bool = True,
+    tolerance: float = 0.0,
+    locator: Optional[vtkCellLocator] = None,
 ) -> vtkIterativeClosestPointTransform:
     icp = vtkIterativeClosestPointTransform()
     icp.SetSource(source)
     icp.SetTarget(target)
+    if locator is not None:
+        # a locator that was built on the target is not built again
+        icp.SetLocator(locator)
     icp.SetMaximumNumberOfIterations(iterations)
     icp.SetMaximumNumberOfLandmarks(number_of_landmarks)
+    if tolerance > 0:
+        # Stop when the mean displacement of the landmarks drops below tolerance
+        icp.CheckMeanDistanceOn()
+        icp.SetMeanDistanceModeToAbsoluteValue()
+        icp.SetMaximumMeanDistance(tolerance)
     icp.StartByMatchingCentroidsOff()
     if start_by_mathing_centroids:
         icp.StartByMatchingCentroidsOn()
@@ -64,19 +149,31 @@ def _iterative_closest_point(
     return icp
 
 
-def _transform4x4_to_sitk_affine(vtk_matrix: vtkMatrix4x4) -> sitk.Transform:
+def _transform4x4_to_sitk_affine(matrix: np.ndarray) -> sitk.Transform:
     dimension = 3  # dimension is always 3 in a 4x4 transform
     affine = sitk.AffineTransform(dimension)
     parameters = list(affine.GetParameters())
     for i in range(dimension):
         for j in range(dimension):
-            parameters[i * dimension + j] = vtk_matrix.GetElement(i, j)
+            parameters[i * dimension + j] = matrix[i, j]
     for i in range(3):
-        parameters[i + dimension * dimension] = vtk_matrix.GetElement(i, dimension)
+        parameters[i + dimension * dimension] = matrix[i, dimension]
     affine.SetParameters(parameters)
     return affine
 
 
+def _sitk_to_transform4x4(transform: sitk.Transform) -> np.ndarray:
+    """4x4 matrix of an affine transform, from where it maps the unit vectors"""
+    origin = np.asarray(transform.TransformPoint((0.0, 0.0, 0.0)))
+    matrix = np.eye(4)
+    for axis in range(3):
+        unit = [0.0, 0.0, 0.0]
+        unit[axis] = 1.0
+        matrix[:3, axis] = np.asarray(transform.TransformPoint(unit)) - origin
+    matrix[:3, 3] = origin
+    return matrix
+
+
 def calculate_frame_extent_3d(
     frame_dimensions: tuple[float, float, float],
     voxel_spacing: tuple[float, float, float],
@@ -100,168 +197,303 @@ class FrameDetector:
         blob_detector: BlobDetectorType,
         modality: str,
         visualization: bool = False,
+        n_workers: int = 1,
+        icp_engine: str = "vtk",
+        schedule: AlignmentSchedule = DEFAULT_SCHEDULE,
+        profile: Optional[profiling.Profile] = None,
+        sampling: SliceSampling = SliceSampling(),
+        initial_transform: Optional[sitk.Transform] = None,
+        initial_pose: str = "icp",
     ):
+        if icp_engine not in ICP_ENGINES:
+            raise ValueError(f"ICP engine should be one of {ICP_ENGINES}")
+        if initial_pose not in INITIAL_POSES:
+            raise ValueError(f"Initial pose should be one of {INITIAL_POSES}")
         self._frame = frame
         self._slice_provider = slice_provider
         self._blob_detector = blob_detector
-        self._point_cloud: pv.PolyData | None = None
+        self._points: np.ndarray | None = None  # (N, 3) in image space
         self._sitk_transform: sitk.Transform | None = None
-        self._frame_object: pv.PolyData = _create_lines(
-            frame.get_edges(modality), frame.nodes
-        )
+        self._frame_model = frame_model(frame, modality)
         self._modality = modality
         self._visualization = visualization
+        self._n_workers = n_workers
+        self._icp_engine = icp_engine
+        self._schedule = schedule
+        self._stage_iterations: list[tuple[str, int]] = []
+        self._profile = profile
+        self._sampling = sampling
+        # the transforms map frame space to image space, the alignment the reverse
+        self._initial_matrix: Optional[np.ndarray] = (
+            None
+            if initial_transform is None
+            else np.linalg.inv(_sitk_to_transform4x4(initial_transform))
+        )
+        self._initial_pose = initial_pose
+        self._warm_started: bool = False
+        self._mean_error: float = float("nan")
+        self._max_error: float = float("nan")
 
     # Quite a bit of cohesion here, not sure if it's a problem, since it has to come together somewhere
     def detect_frame(self) -> None:
+        with (
+            profiling.activate(self._profile),
+            profiling.stage("detect frame") as record,
+        ):
+            self._detect_frame()
+            record.set(points=len(self._points))  # type: ignore
+
+    def _detect_frame(self) -> None:
+        if isinstance(self._blob_detector, VolumeBlobDetectorProtocol) and isinstance(
+            self._slice_provider, VolumeProviderProtocol
+        ):
+            image_array, mask_array, geometry = self._slice_provider.get_volume_arrays()
+            with profiling.stage("detect blobs in volume"):
+                self._points = _point_array(
+                    self._blob_detector.detect_volume(
+                        image_array, mask_array, geometry, self._modality
+                    )
+                )
+            return
+
+        if isinstance(self._blob_detector, ArrayBlobDetectorProtocol) and isinstance(
+            self._slice_provider, ArraySliceProviderProtocol
+        ):
+            self._points = _point_array(self._scan(self._detect_blobs_in_arrays))
+            return
+
+        if (self._n_workers > 1 or self._sampling != SliceSampling()) and isinstance(
+            self._slice_provider, RandomAccessSliceProviderProtocol
+        ):
+            self._points = _point_array(self._scan(self._detect_blobs_in_slice))
+            return
+
+        if self._sampling != SliceSampling():
+            logger.info("The slices are provided in order only, scanning all of them")
         blobs_list = []
         while not self._slice_provider.is_empty():
             next_img_slice, next_mask_slice = (
                 self._slice_provider.next_image_mask_pair()
             )
-            blobs_list += [
-                two_d_point + (self._slice_provider.get_current_z_coordinate(),)
-                for two_d_point in self._blob_detector(
+            with profiling.stage("detect blobs in slice", accumulate=True):
+                blobs = self._blob_detector(
                     next_img_slice, next_mask_slice, self._modality
                 )
-            ]
-        self._point_cloud = pv.PolyData(np.asarray(blobs_list))
+            blobs_list.append(
+                _with_z(blobs, self._slice_provider.get_current_z_coordinate())
+            )
+        self._points = _point_array(np.concatenate([np.empty((0, 3)), *blobs_list]))
+
+    def _detect_blobs_in_slice(self, index: int) -> np.ndarray:
+        provider: RandomAccessSliceProviderProtocol = self._slice_provider  # type: ignore
+        img_slice, mask_slice = provider.get_image_mask_pair(index)
+        z_coordinate = provider.get_z_coordinate(index)
+        with profiling.stage("detect blobs in slice", accumulate=True):
+            blobs = self._blob_detector(img_slice, mask_slice, self._modality)
+        return _with_z(blobs, z_coordinate)
+
+    def _detect_blobs_in_arrays(self, index: int) -> np.ndarray:
+        provider: ArraySliceProviderProtocol = self._slice_provider  # type: ignore
+        blob_detector: ArrayBlobDetectorProtocol = self._blob_detector  # type: ignore
+        image_slice, mask_slice, geometry = provider.get_array_pair(index)
+        with profiling.stage("detect blobs in slice", accumulate=True):
+            return blob_detector.detect_arrays(
+                image_slice, mask_slice, geometry, self._modality
+            )
+
+    def _scan(self, detect_slice: SliceDetector) -> np.ndarray:
+        """Detect blobs in the slices on a thread pool, SimpleITK releases the GIL.
+
+        map returns the results in slice order, so the point cloud is
+        identical to the one of the serial scan. With a sparse sampling only
+        part of the slices is scanned, see stereotacticframe.sampling."""
+        provider: RandomAccessSliceProviderProtocol = self._slice_provider  # type: ignore
+        n_slices = provider.get_number_of_slices()
+        stride = 1
+        if n_slices > 1 and self._sampling != SliceSampling():
+            slice_spacing = abs(
+                provider.get_z_coordinate(1) - provider.get_z_coordinate(0)
+            )
+            stride = self._sampling.stride(slice_spacing, self._frame.dimensions[2])
+        with (
+            profiling.stage("scan slices") as record,
+            ThreadPoolExecutor(max_workers=self._n_workers) as executor,
+        ):
+            blobs, n_scanned = sparse_scan(n_slices, stride, detect_slice, executor.map)
+            record.set(stride=stride, slices=n_scanned)
+        logger.debug(f"Scanned {n_scanned} of {n_slices} slices, stride {stride}")
+        return blobs
 
     def _plot_cloud_and_frame(
         self, cloud: pv.PolyData, msg: Optional[str] = None
     ) -> None:
         pl = pv.Plotter()
         pl.add_mesh(cloud)
-        pl.add_mesh(self._frame_object)
+        pl.add_mesh(self._frame_model.mesh)
         pl.show(title=msg)
 
-    def get_transform_to_frame_space(self) -> sitk.Transform:
-        if self._point_cloud is None:
-            raise ValueError(
-                "Detect frame was not run or there is a problem with detect frame."
+    def _register(
+        self, points: np.ndarray, stage: AlignmentStage, match_centroids: bool = True
+    ) -> tuple[np.ndarray, int]:
+        """4x4 matrix that registers the points to the frame, and iterations used"""
+        if self._icp_engine == "numpy":
+            tolerance = (
+                {} if stage.tolerance is None else {"tolerance": stage.tolerance}
             )
-
-        point_cloud = self._point_cloud.copy()
-        # Run 1 iteration to do centroid allignment
-        centroid_transform = _iterative_closest_point(
-            point_cloud, self._frame_object, iterations=1
-        )
-
-        centroid_matrix = centroid_transform.GetMatrix()
-        centroid_inverse_matrix = centroid_matrix.NewInstance()
-        centroid_inverse_matrix.DeepCopy(centroid_matrix)
-        centroid_inverse_matrix.Invert()
-
-        point_cloud.transform(centroid_matrix)
-
-        # Very liberally clean some points
-        new_points = point_cloud.points
-
-        right_points = new_points[new_points[..., 0] < 40]  # Keep only right points
-        left_points = new_points[new_points[..., 0] > 150]  # Keep only left points
-
-        new_cloud = pv.PolyData(right_points) + pv.PolyData(left_points)
-
-        if self._visualization:
-            self._plot_cloud_and_frame(new_cloud, "Centroid allignment")
-
-        new_cloud.transform(centroid_inverse_matrix)
-
-        initial_transform = _iterative_closest_point(
-            new_cloud, self._frame_object, 1_000
-        )
-        point_cloud = self._point_cloud.copy()
-
-        initial_matrix = initial_transform.GetMatrix()
-        initial_inverse_matrix = initial_matrix.NewInstance()
-        initial_inverse_matrix.DeepCopy(initial_matrix)
-        initial_inverse_matrix.Invert()
-        new_cloud.transform(initial_inverse_matrix)
-
-        point_cloud.transform(initial_matrix)
-
-        if self._visualization:
-            self._plot_cloud_and_frame(point_cloud, "Initial allignment")
-
-        # Remove upper 20mm and lower 20mm
-        new_points = point_cloud.points
-        new_points = new_points[new_points[..., 2] > -110]  # Remove top 10 mm
-        new_points = new_points[new_points[..., 2] < -10]  # Remove bottom 10 mm
-
-        right_points = new_points[new_points[..., 0] < 10]  # Keep only right points
-        left_points = new_points[new_points[..., 0] > 180]  # Keep only left points
-        new_cloud = pv.PolyData(right_points) + pv.PolyData(left_points)
-
-        new_cloud.transform(initial_inverse_matrix)
-
-        refined_transform = _iterative_closest_point(
-            new_cloud, self._frame_object, iterations=1_000
-        )
-        refined_matrix = refined_transform.GetMatrix()
-        refined_inverse_matrix = refined_matrix.NewInstance()
-        refined_inverse_matrix.DeepCopy(refined_matrix)
-        refined_inverse_matrix.Invert()
-
-        point_cloud = self._point_cloud.copy()
-        point_cloud.transform(refined_matrix)
-
-        new_cloud.transform(refined_matrix)
-
-        if self._visualization:
-            self._plot_cloud_and_frame(new_cloud, "Refined allignment")
-
-        closest_points = self._calculate_closest_points_in_frame_to(
-            point_cloud.points.copy()
+            return icp.iterative_closest_point(
+                points,
+                self._frame_model.starts,
+                self._frame_model.ends,
+                iterations=stage.iterations,
+                number_of_landmarks=stage.number_of_landmarks,
+                start_by_matching_centroids=match_centroids,
+                **tolerance,
+            )
+        icp_transform = _iterative_closest_point(
+            pv.PolyData(points),
+            self._frame_model.mesh,
+            stage.iterations,
+            stage.number_of_landmarks,
+            match_centroids,
+            tolerance=stage.tolerance or 0.0,
+            locator=self._frame_model.locator,
         )
-
-        exact_distance = np.linalg.norm(point_cloud.points - closest_points, axis=1)
-
-        new_points = point_cloud.points
-        new_points = new_points[np.nonzero(exact_distance < 3.0)]
-        new_points = new_points[new_points[..., 2] > -110]  # Remove top 10 mm
-        new_points = new_points[new_points[..., 2] < -10]  # Remove bottom 10 mm
-        right_points = new_points[new_points[..., 0] < 10]  # Keep only right points
-        left_points = new_points[new_points[..., 0] > 180]  # Keep only left points
-        new_cloud = pv.PolyData(right_points) + pv.PolyData(left_points)
-
-        new_cloud.transform(refined_inverse_matrix)
-
-        final_transform = _iterative_closest_point(
-            new_cloud, self._frame_object, iterations=2_000
+        return (
+            pv.array_from_vtkmatrix(icp_transform.GetMatrix()),
+            icp_transform.GetNumberOfIterations(),
         )
 
-        final_matrix = final_transform.GetMatrix()
-        final_inverse_matrix = final_matrix.NewInstance()
-        final_inverse_matrix.DeepCopy(final_matrix)
-        final_inverse_matrix.Invert()
-        new_cloud.transform(final_matrix)
-
-        if self._visualization:
-            self._plot_cloud_and_frame(new_cloud, "Final allignment")
+    def get_transform_to_frame_space(self) -> sitk.Transform:
+        with profiling.activate(self._profile):
+            return self._get_transform_to_frame_space()
 
-        point_cloud = self._point_cloud.copy()
-        point_cloud.transform(final_matrix)
+    def _get_transform_to_frame_space(self) -> sitk.Transform:
+        if self._points is None:
+            raise ValueError(
+                "Detect frame was not run or there is a problem with detect frame."
+            )
 
-        closest_points_in_frame = self._calculate_closest_points_in_frame_to(
-            new_cloud.points
-        )
-        self._set_mean_max(closest_points_in_frame, new_cloud.points)
+        points = self._points
+        self._warm_started = False
+        initial_matrix = self._initial_matrix
+        if initial_matrix is None and self._initial_pose == "bars":
+            with profiling.stage("fit bars") as record:
+                initial_matrix = fit_frame_pose(points, self._frame, self._modality)
+                record.set(found=initial_matrix is not None)
+            if initial_matrix is None:
+                logger.info("Could not fit the bars, aligning with the full schedule")
+        if initial_matrix is not None:
+            with profiling.stage("warm start") as record:
+                matrix = self._align(points, refinement(self._schedule), initial_matrix)
+                self._warm_started = self._mean_error <= WARM_START_MAX_MEAN_ERROR
+                record.set(mean_error=float(self._mean_error), used=self._warm_started)
+            if not self._warm_started:
+                logger.info(
+                    f"Mean error of {self._mean_error:.2f} mm from the initial "
+                    "pose is too high, aligning with the full schedule"
+                )
+        if not self._warm_started:
+            matrix = self._align(points, self._schedule)
 
         logger.info(f"Mean detection error: {self._mean_error}")
         logger.info(f"Max detection error: {self._max_error}")
 
-        final_itk_transform = _transform4x4_to_sitk_affine(final_matrix)
+        final_itk_transform = _transform4x4_to_sitk_affine(matrix)
         return final_itk_transform.GetInverse()
 
-    def _calculate_closest_points_in_frame_to(
-        self, points: pv.NumpyArray
-    ) -> pv.NumpyArray:
-        _, closest_points = self._frame_object.find_closest_cell(
-            points, return_closest_point=True
+    def _align(
+        self,
+        points: np.ndarray,
+        schedule: AlignmentSchedule,
+        initial_matrix: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """4x4 matrix that aligns the points to the frame, stage by stage.
+
+        Without an initial matrix, every stage selects points after aligning
+        them with the previous stage, and registers those points, in image
+        space, from scratch. With one, every stage registers the aligned
+        points, and the step is composed with the previous matrix, starting
+        with the initial matrix."""
+        matrix = np.eye(4) if initial_matrix is None else initial_matrix
+        selected_points = points
+        self._stage_iterations = []
+        for stage in schedule:
+            aligned_points = icp.transform_points(matrix, points)
+            distances = None
+            if stage.max_distance is not None:
+                distances = np.linalg.norm(
+                    aligned_points
+                    - self._calculate_closest_points_in_frame_to(aligned_points),
+                    axis=1,
+                )
+            selected = select_points(aligned_points, stage, distances)
+            selected_points = points[selected]
+            if initial_matrix is not None and len(selected_points) < 3:
+                # the initial matrix does not put the points near the frame
+                self._mean_error = self._max_error = float("inf")
+                return matrix
+            with profiling.stage(f"{stage.name} alignment") as record:
+                if initial_matrix is None:
+                    matrix, iterations = self._register(selected_points, stage)
+                else:
+                    step, iterations = self._register(
+                        aligned_points[selected], stage, match_centroids=False
+                    )
+                    matrix = step @ matrix
+                record.set(points=len(selected_points), iterations=iterations)
+            self._stage_iterations.append((stage.name, iterations))
+            logger.info(
+                f"{stage.name.capitalize()} alignment of {len(selected_points)} points used "
+                f"{iterations} of {stage.iterations} iterations"
+            )
+
+            if self._visualization:
+                self._plot_cloud_and_frame(
+                    pv.PolyData(icp.transform_points(matrix, selected_points)),
+                    f"{stage.name.capitalize()} alignment",
+                )
+
+        final_points = icp.transform_points(matrix, selected_points)
+        closest_points_in_frame = self._calculate_closest_points_in_frame_to(
+            final_points
         )
-        return closest_points
+        self._set_mean_max(closest_points_in_frame, final_points)
+        return matrix
 
-    def _set_mean_max(self, points: pv.NumpyArray, poly_points: pv.NumpyArray) -> None:
+    def _calculate_closest_points_in_frame_to(self, points: np.ndarray) -> np.ndarray:
+        if self._icp_engine == "numpy":
+            return icp.closest_points_on_segments(
+                points, self._frame_model.starts, self._frame_model.ends
+            )
+        return self._frame_model.locate_closest_points(points)
+
+    @property
+    def profile(self) -> Optional[profiling.Profile]:
+        """Timing, counts and peak memory of the stages, when profiling"""
+        return self._profile
+
+    @property
+    def stage_iterations(self) -> list[tuple[str, int]]:
+        """Name and used iterations of each stage of the last alignment"""
+        return list(self._stage_iterations)
+
+    @property
+    def warm_started(self) -> bool:
+        """Whether the last alignment skipped the coarse stages, starting from
+        the initial transform or from the fitted bars"""
+        return self._warm_started
+
+    @property
+    def mean_error(self) -> float:
+        """Mean distance [mm] of the final points to the frame"""
+        return self._mean_error
+
+    @property
+    def max_error(self) -> float:
+        """Max distance [mm] of the final points to the frame"""
+        return self._max_error
+
+    def _set_mean_max(self, points: np.ndarray, poly_points: np.ndarray) -> None:
         distances = np.linalg.norm(points - poly_points, axis=1)
         self._mean_error = distances.mean()
         self._max_error = distances.max()
@@ -0,0 +1,89 @@
+"""Registry of the frame geometry that the alignment needs, per process.
+
+The model of a frame for a modality holds the start and end points of its
+edges, a line mesh of them and a cell locator on that mesh. It is built the
+first time a frame of that class is aligned in that modality, and then shared
+by all detectors in the process, e.g. all cases of a batch worker or all jobs
+of a server. Any class that follows FrameProtocol gets its models this way;
+the geometry of a frame class is assumed to be the same for all instances."""
+
+from __future__ import annotations
+
+import threading
+from typing import NamedTuple
+
+import numpy as np
+import pyvista as pv
+from vtk import reference, vtkCellLocator, vtkGenericCell
+
+from stereotacticframe import icp
+from stereotacticframe.frame_protocol import FrameProtocol
+
+
+class FrameModel(NamedTuple):
+    starts: np.ndarray  # (E, 3) read-only
+    ends: np.ndarray  # (E, 3) read-only
+    mesh: pv.PolyData
+    # built once, as the VTK ICP configures its own, so the ICP can reuse it
+    locator: vtkCellLocator
+
+    def locate_closest_points(self, points: np.ndarray) -> np.ndarray:
+        """Closest point on the mesh for each of the (N, 3) points"""
+        cell = vtkGenericCell()  # per call, so calls can run concurrently
+        cell_id, sub_id, distance = reference(0), reference(0), reference(0.0)
+        closest_points = np.empty((len(points), 3))
+        closest_point = [0.0, 0.0, 0.0]
+        for index, point in enumerate(points):
+            self.locator.FindClosestPoint(
+                point, closest_point, cell, cell_id, sub_id, distance
+            )
+            closest_points[index] = closest_point
+        return closest_points
+
+
+def _create_lines(
+    edges: list[tuple[int, int]], nodes: list[tuple[float, float, float]]
+) -> pv.PolyData:
+    """One line cell per edge, on the nodes that the edges use"""
+    used_nodes, node_indices = np.unique(
+        np.asarray(edges, dtype=np.int64), return_inverse=True
+    )
+    # every cell is [number of points, first point, second point]
+    lines = np.column_stack(
+        (np.full(len(edges), 2), node_indices.reshape(len(edges), 2))
+    )
+    return pv.PolyData(
+        np.asarray(nodes, dtype=np.float64)[used_nodes], lines=lines.ravel()
+    )
+
+
+def _build(frame: FrameProtocol, modality: str) -> FrameModel:
+    edges, nodes = frame.get_edges(modality), frame.nodes
+    starts, ends = icp.frame_segments(edges, nodes)
+    starts.flags.writeable = False
+    ends.flags.writeable = False
+    mesh = _create_lines(edges, nodes)
+    locator = vtkCellLocator()
+    locator.SetDataSet(mesh)
+    locator.SetNumberOfCellsPerBucket(1)
+    locator.BuildLocator()
+    return FrameModel(starts, ends, mesh, locator)
+
+
+_models: dict[tuple[type, str], FrameModel] = {}
+_lock = threading.Lock()
+
+
+def frame_model(frame: FrameProtocol, modality: str) -> FrameModel:
+    """The model of the frame class in the modality, built on first use"""
+    key = (type(frame), modality)
+    with _lock:
+        if key not in _models:
+            _models[key] = _build(frame, modality)
+        return _models[key]
+
+
+def clear_frame_models() -> None:
+    """Forget the built models, e.g. after changing the geometry of a class"""
+    with _lock:
+        _models.clear()
@@ -0,0 +1,30 @@
+from __future__ import annotations
+
+from typing import NamedTuple
+import SimpleITK as sitk
+import numpy as np
+
+
+def dominant_axis(direction: tuple[float, ...], physical_axis: int) -> int:
+    """Index axis that is closest to the given physical axis"""
+    return int(np.argmax(np.abs(np.asarray(direction).reshape(3, 3)[physical_axis])))
+
+
+class ImageGeometry(NamedTuple):
+    """Physical metadata of a 3D image, in itk (i, j, k) order."""
+
+    origin: tuple[float, float, float]
+    spacing: tuple[float, float, float]
+    direction: tuple[float, ...]
+
+    @classmethod
+    def from_image(cls, image: sitk.Image) -> ImageGeometry:
+        return cls(image.GetOrigin(), image.GetSpacing(), image.GetDirection())
+
+    def direction_matrix(self) -> np.ndarray:
+        return np.asarray(self.direction, dtype=np.float64).reshape(3, 3)
+
+    def index_to_physical(self, indices: np.ndarray) -> np.ndarray:
+        """Map (N, 3) continuous (i, j, k) indices to (N, 3) physical points."""
+        scaled = np.asarray(indices, dtype=np.float64) * np.asarray(self.spacing)
+        return np.asarray(self.origin) + scaled @ self.direction_matrix().T
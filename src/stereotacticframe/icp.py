@@ -0,0 +1,109 @@
+"""Iterative closest point registration of points to a frame of line segments.
+
+The frame models are only a handful of straight edges, so the closest point on
+the frame can be computed exactly and for all points at once, instead of
+going through a VTK cell locator."""
+
+from __future__ import annotations
+
+import numpy as np
+
+
+def frame_segments(
+    edges: list[tuple[int, int]], nodes: list[tuple[float, float, float]]
+) -> tuple[np.ndarray, np.ndarray]:
+    """Start and end points, both (E, 3), of the edges of a frame"""
+    node_array = np.asarray(nodes, dtype=np.float64)
+    edge_array = np.asarray(edges, dtype=np.intp)
+    return node_array[edge_array[:, 0]], node_array[edge_array[:, 1]]
+
+
+def closest_points_on_segments(
+    points: np.ndarray, starts: np.ndarray, ends: np.ndarray
+) -> np.ndarray:
+    """Closest point on any of the segments for each of the (N, 3) points"""
+    points = np.asarray(points, dtype=np.float64)
+    directions = ends - starts  # (E, 3)
+    lengths_squared = np.einsum("ij,ij->i", directions, directions)
+    # Only (N, E) arrays, from dot products of the points with the segments,
+    # (p - s).d = p.d - s.d and
+    # |p - s - f d|^2 = |p - s|^2 - f (2 (p - s).d - f |d|^2)
+    projections = points @ directions.T - np.einsum("ij,ij->i", starts, directions)
+    fractions = np.clip(projections / lengths_squared, 0.0, 1.0)
+    squared_distances = (
+        np.einsum("ij,ij->i", points, points)[:, np.newaxis]
+        - 2 * points @ starts.T
+        + np.einsum("ij,ij->i", starts, starts)
+    )
+    squared_distances -= fractions * (2 * projections - fractions * lengths_squared)
+    closest_segment = np.argmin(squared_distances, axis=1)
+    closest_fractions = fractions[np.arange(len(points)), closest_segment]
+    return (
+        starts[closest_segment]
+        + closest_fractions[:, np.newaxis] * directions[closest_segment]
+    )
+
+
+def rigid_transform(source: np.ndarray, target: np.ndarray) -> np.ndarray:
+    """Least squares rigid 4x4 transform from source to target points (Kabsch)"""
+    source_centroid = source.mean(axis=0)
+    target_centroid = target.mean(axis=0)
+    covariance = (source - source_centroid).T @ (target - target_centroid)
+    u, _, vt = np.linalg.svd(covariance)
+    # Make sure the result is a rotation and not a reflection
+    correction = np.eye(3)
+    correction[2, 2] = np.sign(np.linalg.det(vt.T @ u.T))
+    rotation = vt.T @ correction @ u.T
+
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotation
+    matrix[:3, 3] = target_centroid - rotation @ source_centroid
+    return matrix
+
+
+def transform_points(matrix: np.ndarray, points: np.ndarray) -> np.ndarray:
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def _landmarks(points: np.ndarray, number_of_landmarks: int) -> np.ndarray:
+    """Evenly strided subset of the points, the way VTK selects its landmarks"""
+    step = max(1, len(points) // number_of_landmarks)
+    return points[::step][: len(points) // step]
+
+
+def iterative_closest_point(
+    source: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    iterations: int,
+    number_of_landmarks: int = 2_000,
+    start_by_matching_centroids: bool = True,
+    tolerance: float = 1e-6,
+) -> tuple[np.ndarray, int]:
+    """Rigidly register the (N, 3) source points to the segments.
+
+    Stops after iterations, or earlier when the mean displacement of the
+    landmarks in one iteration drops below tolerance [mm]. Returns the 4x4
+    matrix that maps the source points onto the segments and the number of
+    iterations that were used."""
+    landmarks = _landmarks(np.asarray(source, dtype=np.float64), number_of_landmarks)
+    matrix = np.eye(4)
+
+    if start_by_matching_centroids:
+        target_centroid = np.unique(np.concatenate((starts, ends)), axis=0).mean(axis=0)
+        # like VTK, use the centroid of all points and not only of the landmarks
+        matrix[:3, 3] = target_centroid - np.asarray(source).mean(axis=0)
+
+    moved = transform_points(matrix, landmarks)
+    iteration = 0
+    while iteration < iterations:
+        iteration += 1
+        step = rigid_transform(moved, closest_points_on_segments(moved, starts, ends))
+        matrix = step @ matrix
+        new_moved = transform_points(step, moved)
+        mean_displacement = np.linalg.norm(new_moved - moved, axis=1).mean()
+        moved = new_moved
+        if mean_displacement <= tolerance:
+            break
+
+    return matrix, iteration
@@ -0,0 +1,202 @@
+"""Keeping a registration within a memory budget.
+
+The budget is checked before the image is read, against an estimate from its
+header: the bytes of the image plus those of the copies that preprocessing
+makes of it, per voxel, on top of what the process used before its first
+plan. Within a budget the intensities are stored compactly, see
+compact_intensities, and the masks stay uint8. When the whole image would not
+fit, the plan streams it in slabs of as many axial slices as do fit."""
+
+from __future__ import annotations
+
+import logging
+from pathlib import Path
+import re
+from typing import NamedTuple, Optional
+
+import numpy as np
+import SimpleITK as sitk
+
+from stereotacticframe import profiling
+from stereotacticframe.dicom import series_file_names
+
+logger = logging.getLogger(__name__)
+
+_UNITS: dict[str, int] = {
+    "": 1,
+    "B": 1,
+    "K": 1000,
+    "KB": 1000,
+    "KIB": 2**10,
+    "M": 1000**2,
+    "MB": 1000**2,
+    "MIB": 2**20,
+    "G": 1000**3,
+    "GB": 1000**3,
+    "GIB": 2**30,
+}
+
+# Bytes per voxel that preprocessing needs next to the image: the clamped
+# copy of a CT, the thresholded mask, and the padded buffers of the closing.
+# Measured on phantoms, with some margin.
+CT_WORK_BYTES = 8
+MR_WORK_BYTES = 7
+# Of the rest of the registration, like the detected points and the ICP
+REGISTRATION_BYTES = 16 * 2**20
+# The threshold of a streamed image is estimated on this many sampled slices
+THRESHOLD_SAMPLE_SIZE = 64
+
+INTEGER_PIXEL_TYPES = {
+    sitk.sitkUInt8,
+    sitk.sitkInt8,
+    sitk.sitkUInt16,
+    sitk.sitkInt16,
+    sitk.sitkUInt32,
+    sitk.sitkInt32,
+    sitk.sitkUInt64,
+    sitk.sitkInt64,
+}
+_INT16 = np.iinfo(np.int16)
+
+
+def parse_size(text: str) -> int:
+    """Bytes in a size like 1GiB, 512MB or 800M, or a plain number of bytes"""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d*)?)\s*([a-zA-Z]*)\s*", text)
+    if match is None or match.group(2).upper() not in _UNITS:
+        raise ValueError(f"Not a size: {text!r}, use e.g. 1GiB or 512MB")
+    return int(float(match.group(1)) * _UNITS[match.group(2).upper()])
+
+
+class ImageInformation(NamedTuple):
+    size: tuple[int, int, int]
+    pixel_bytes: int
+    integer: bool  # whether the pixels are of an integer type
+
+
+def _file_information(file_name: str) -> sitk.ImageFileReader:
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_name)
+    reader.ReadImageInformation()
+    return reader
+
+
+def image_information(
+    image_path: Path, series_uid: Optional[str] = None
+) -> ImageInformation:
+    """From the header of the image, or of the first file of a DICOM series"""
+    if Path(image_path).is_dir():
+        file_names = series_file_names(image_path, series_uid)
+        reader = _file_information(file_names[0])
+        size = (*reader.GetSize()[:2], len(file_names))
+    else:
+        reader = _file_information(str(image_path))
+        size = reader.GetSize()
+    pixel_id = reader.GetPixelID()
+    pixel_bytes = sitk.Image(
+        [1] * reader.GetDimension(), pixel_id
+    ).GetSizeOfPixelComponent()
+    return ImageInformation(
+        size,  # type: ignore
+        pixel_bytes * reader.GetNumberOfComponents(),
+        pixel_id in INTEGER_PIXEL_TYPES,
+    )
+
+
+def bytes_per_voxel(information: ImageInformation, modality: str) -> int:
+    """Of the image and the preprocessing together, with compact intensities"""
+    work_bytes = CT_WORK_BYTES if modality == "CT" else MR_WORK_BYTES
+    # a compact CT is clamped to int16 instead of float32
+    if modality == "CT" and information.integer:
+        work_bytes -= 2
+    # float64 is stored as float32, wider integers as int16 when they fit
+    return min(information.pixel_bytes, 4) + work_bytes
+
+
+class MemoryPlan(NamedTuple):
+    estimate: int  # [bytes] of the whole image in memory, on top of the baseline
+    available: int  # [bytes] of the budget that the baseline leaves
+    slab_size: int  # axial slices to stream at a time, 0 reads the whole image
+
+
+_baseline: Optional[float] = None
+
+
+def _baseline_bytes() -> float:
+    """What the process used when it first planned, e.g. for the imported
+    libraries. Taken once, so that in a server or batch worker the memory
+    that earlier cases left behind does not shrink the budget of later ones."""
+    global _baseline
+    if _baseline is None:
+        rss = profiling.current_rss_mb()
+        if rss is None:
+            rss = profiling.peak_rss_mb() or 0.0
+        _baseline = rss * 2**20
+    return _baseline
+
+
+def plan_memory(
+    image_path: Path,
+    modality: str,
+    max_memory: int,
+    halo: int,
+    series_uid: Optional[str] = None,
+) -> MemoryPlan:
+    """Whether the image fits in max_memory [bytes] as a whole, and otherwise
+    the largest slab that does. halo is the number of extra axial slices that
+    a slab is read with, for the closing."""
+    information = image_information(image_path, series_uid)
+    # the axial axis of an image that is not stored axially is not known from
+    # the size alone, so assume the largest slices
+    slice_voxels = int(np.prod(sorted(information.size)[1:]))
+    n_slices = int(np.prod(information.size)) // slice_voxels
+    voxel_bytes = bytes_per_voxel(information, modality)
+    estimate = n_slices * slice_voxels * voxel_bytes
+    available = max(0, int(max_memory - _baseline_bytes() - REGISTRATION_BYTES))
+    if estimate <= available:
+        return MemoryPlan(estimate, available, 0)
+
+    if Path(image_path).is_dir():
+        logger.warning(
+            "A DICOM series can not be streamed, it needs about "
+            f"{estimate / 2**20:.0f} MB of the {available / 2**20:.0f} MB left"
+        )
+        return MemoryPlan(estimate, available, 0)
+
+    # the sampled slices, and the image that is made of them
+    sample_bytes = (
+        2
+        * min(THRESHOLD_SAMPLE_SIZE, n_slices)
+        * slice_voxels
+        * information.pixel_bytes
+    )
+    slab_size = (available - sample_bytes) // (slice_voxels * voxel_bytes) - 2 * halo
+    if slab_size < 2 * halo + 1:
+        # thinner slabs read more halo than slab, which is far slower than the
+        # whole image, and still might not fit
+        logger.warning(
+            f"The {available / 2**20:.0f} MB left of the memory budget are too "
+            f"little for slabs of more than {2 * halo} slices, reading the whole "
+            f"image, which needs about {estimate / 2**20:.0f} MB"
+        )
+        return MemoryPlan(estimate, available, 0)
+    return MemoryPlan(estimate, available, int(min(slab_size, n_slices)))
+
+
+def compact_intensities(image: sitk.Image) -> sitk.Image:
+    """The image as int16 when that holds all its values exactly, and float64
+    as float32. Other images are returned as they are."""
+    pixel_id = image.GetPixelID()
+    if pixel_id in (sitk.sitkUInt8, sitk.sitkInt8, sitk.sitkInt16):
+        return image
+    if pixel_id not in INTEGER_PIXEL_TYPES | {sitk.sitkFloat32, sitk.sitkFloat64}:
+        return image
+    array = sitk.GetArrayViewFromImage(image)
+    fits = array.size > 0 and _INT16.min <= array.min() and array.max() <= _INT16.max
+    if fits and pixel_id not in INTEGER_PIXEL_TYPES:
+        # slice by slice, to not make a rounded copy of the whole image
+        fits = all(np.array_equal(plane, np.rint(plane)) for plane in array)
+    if fits:
+        return sitk.Cast(image, sitk.sitkInt16)
+    if pixel_id == sitk.sitkFloat64:
+        return sitk.Cast(image, sitk.sitkFloat32)
+    return image
@@ -0,0 +1,216 @@
+"""Synthetic images of a frame with a known pose, for testing and benchmarks.
+
+The fiducial bars are rods around the edges of the frame, inside a field of
+view that is centered on the frame, together with an ellipsoidal head. The
+volume is built slice by slice and rod by rod, so that phantoms of the size of
+clinical CTs fit in memory next to the image itself."""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import numpy as np
+import SimpleITK as sitk
+
+from stereotacticframe.frame_protocol import FrameProtocol
+from stereotacticframe.frames import LeksellFrame
+
+
+class Appearance(NamedTuple):
+    background: float
+    head: float
+    bar: float
+    bar_radius: float  # [mm]
+    pixel_type: type
+
+
+_appearance_map: dict[str, Appearance] = {
+    "CT": Appearance(-1000.0, 40.0, 2000.0, 1.5, np.int16),
+    "MR": Appearance(0.0, 40.0, 200.0, 2.0, np.float32),
+}
+
+
+class PhantomSpec(NamedTuple):
+    modality: str = "MR"
+    size: tuple[int, int, int] = (256, 256, 90)  # columns, rows, slices
+    spacing: tuple[float, float, float] = (1.0, 1.0, 2.0)  # [mm]
+    noise: float = 5.0  # standard deviation of the gaussian noise
+    rotation: tuple[float, float, float] = (0.02, -0.03, 0.015)  # [rad] x, y, z
+    translation: tuple[float, float, float] = (-95.0, 60.0, -60.0)  # [mm]
+    seed: int = 0
+
+
+class Phantom(NamedTuple):
+    image: sitk.Image
+    # 4x4 matrix that maps frame coordinates onto image coordinates
+    frame_to_image: np.ndarray
+
+
+def rotation_matrix(angles: tuple[float, float, float]) -> np.ndarray:
+    """Rotation about x, then y, then z"""
+    cx, cy, cz = np.cos(angles)
+    sx, sy, sz = np.sin(angles)
+    rotation_x = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    rotation_y = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rotation_z = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    return rotation_z @ rotation_y @ rotation_x
+
+
+def _pose(spec: PhantomSpec) -> np.ndarray:
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotation_matrix(spec.rotation)
+    matrix[:3, 3] = spec.translation
+    return matrix
+
+
+def _distances_to_segment(
+    points: np.ndarray, start: np.ndarray, end: np.ndarray
+) -> np.ndarray:
+    direction = end - start
+    fractions = np.clip((points - start) @ direction / (direction @ direction), 0, 1)
+    return np.linalg.norm(
+        points - (start + fractions[:, np.newaxis] * direction), axis=1
+    )
+
+
+def _paint_head(
+    array: np.ndarray,
+    origin: np.ndarray,
+    spacing: np.ndarray,
+    image_to_frame: np.ndarray,
+    frame: FrameProtocol,
+    appearance: Appearance,
+) -> None:
+    """Ellipsoid between the fiducial plates, painted one slice at a time"""
+    center = np.asarray(frame.nodes).mean(axis=0)
+    radii = np.array([0.4, 0.75, 0.65]) * np.asarray(frame.dimensions)
+    n_slices, n_rows, n_columns = array.shape
+    rows, columns = np.meshgrid(np.arange(n_rows), np.arange(n_columns), indexing="ij")
+    for k in range(n_slices):
+        points = np.column_stack(
+            (
+                origin[0] + columns.ravel() * spacing[0],
+                origin[1] + rows.ravel() * spacing[1],
+                np.full(rows.size, origin[2] + k * spacing[2]),
+            )
+        )
+        frame_points = points @ image_to_frame[:3, :3].T + image_to_frame[:3, 3]
+        inside = (((frame_points - center) / radii) ** 2).sum(axis=1) < 1
+        array[k].ravel()[inside] = appearance.head
+
+
+def _paint_bars(
+    array: np.ndarray,
+    origin: np.ndarray,
+    spacing: np.ndarray,
+    frame_to_image: np.ndarray,
+    frame: FrameProtocol,
+    modality: str,
+    appearance: Appearance,
+) -> None:
+    """Rods around the edges, each only evaluated in its own bounding box"""
+    nodes = np.asarray(frame.nodes, dtype=np.float64)
+    image_nodes = nodes @ frame_to_image[:3, :3].T + frame_to_image[:3, 3]
+    shape_xyz = np.array(array.shape[::-1])
+    margin = appearance.bar_radius + spacing
+    for start_node, end_node in frame.get_edges(modality):
+        start, end = image_nodes[start_node], image_nodes[end_node]
+        lower = np.floor((np.minimum(start, end) - margin - origin) / spacing)
+        upper = np.ceil((np.maximum(start, end) + margin - origin) / spacing) + 1
+        lower = np.clip(lower, 0, shape_xyz).astype(int)
+        upper = np.clip(upper, 0, shape_xyz).astype(int)
+        if np.any(upper <= lower):
+            continue  # outside the field of view
+        k, j, i = np.meshgrid(
+            *[np.arange(lower[axis], upper[axis]) for axis in (2, 1, 0)],
+            indexing="ij",
+        )
+        points = np.column_stack((i.ravel(), j.ravel(), k.ravel())) * spacing + origin
+        on_bar = _distances_to_segment(points, start, end) < appearance.bar_radius
+        array[k.ravel()[on_bar], j.ravel()[on_bar], i.ravel()[on_bar]] = appearance.bar
+
+
+def make_phantom(
+    spec: PhantomSpec = PhantomSpec(), frame: Optional[FrameProtocol] = None
+) -> Phantom:
+    """Axial image of the frame in the pose of spec, in LPS orientation"""
+    if frame is None:
+        frame = LeksellFrame()
+    appearance = _appearance_map[spec.modality]
+    frame_to_image = _pose(spec)
+    image_to_frame = np.linalg.inv(frame_to_image)
+
+    spacing = np.asarray(spec.spacing, dtype=np.float64)
+    size = np.asarray(spec.size)
+    frame_center = np.asarray(frame.nodes).mean(axis=0)
+    image_center = frame_to_image[:3, :3] @ frame_center + frame_to_image[:3, 3]
+    origin = image_center - (size - 1) * spacing / 2
+
+    array = np.full(size[::-1], appearance.background, dtype=appearance.pixel_type)
+    _paint_head(array, origin, spacing, image_to_frame, frame, appearance)
+    _paint_bars(
+        array, origin, spacing, frame_to_image, frame, spec.modality, appearance
+    )
+    rng = np.random.default_rng(spec.seed)
+    for k in range(len(array)):
+        array[k] = array[k] + rng.normal(0.0, spec.noise, array.shape[1:])
+
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing(tuple(spacing))
+    image.SetOrigin(tuple(origin))
+    return Phantom(image, frame_to_image)
+
+
+def pose_error(
+    transform: sitk.Transform,
+    frame_to_image: np.ndarray,
+    frame: Optional[FrameProtocol] = None,
+) -> float:
+    """Largest distance [mm] between the frame nodes mapped by the calculated
+    transform, which maps frame to image space, and by the true pose"""
+    if frame is None:
+        frame = LeksellFrame()
+    nodes = np.asarray(frame.nodes, dtype=np.float64)
+    true_nodes = nodes @ frame_to_image[:3, :3].T + frame_to_image[:3, 3]
+    calculated_nodes = np.array(
+        [transform.TransformPoint(node) for node in frame.nodes]
+    )
+    return float(np.linalg.norm(calculated_nodes - true_nodes, axis=1).max())
+
+
+def write_dicom_series(
+    image: sitk.Image, directory: Path, series_uid: str, modality: str = "MR"
+) -> list[Path]:
+    """Writes the axial slices of image as a DICOM series, one file per slice"""
+    directory.mkdir(parents=True, exist_ok=True)
+    if image.GetPixelID() not in (sitk.sitkInt16, sitk.sitkUInt16):
+        # DICOM stores integers, the rounding is fine for a phantom
+        image = sitk.Cast(sitk.Round(image), sitk.sitkInt16)
+    direction = image.GetDirection()
+    orientation = "\\".join(
+        f"{value:.10g}" for value in (*direction[0:7:3], *direction[1:8:3])
+    )
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    paths = []
+    for k in range(image.GetDepth()):
+        axial_slice = image[:, :, k]
+        position = image.TransformIndexToPhysicalPoint((0, 0, k))
+        tags = {
+            "0008|0060": modality,
+            "0020|000d": series_uid.rsplit(".", 1)[0],  # study instance uid
+            "0020|000e": series_uid,
+            "0008|0018": f"{series_uid}.{k + 1}",  # sop instance uid
+            "0020|0013": str(k + 1),  # instance number
+            "0020|0032": "\\".join(f"{value:.10g}" for value in position),
+            "0020|0037": orientation,
+            "0018|0050": f"{image.GetSpacing()[2]:.10g}",  # slice thickness
+        }
+        for tag, value in tags.items():
+            axial_slice.SetMetaData(tag, value)
+        path = directory.joinpath(f"{series_uid}.{k + 1}.dcm")
+        writer.SetFileName(str(path))
+        writer.Execute(axial_slice)
+        paths.append(path)
+    return paths
@@ -0,0 +1,202 @@
+from functools import partial
+import logging
+from pathlib import Path
+from typing import NamedTuple, Optional
+import SimpleITK as sitk
+
+from stereotacticframe import profiling
+from stereotacticframe.alignment import DEFAULT_SCHEDULE, with_tolerance
+from stereotacticframe.cache import ResultCache
+from stereotacticframe.dicom import ZRange, read_image
+from stereotacticframe.frames import LeksellFrame
+from stereotacticframe.frame_detector import FrameDetector
+from stereotacticframe.frame_protocol import FrameProtocol
+from stereotacticframe.memory import plan_memory
+from stereotacticframe.slice_provider import (
+    AxialSliceProvider,
+    StreamingAxialSliceProvider,
+)
+from stereotacticframe.blob_detection import ArrayBlobDetector
+from stereotacticframe.preprocessor import Preprocessor
+from stereotacticframe.profiling import Profile
+from stereotacticframe.sampling import SliceSampling
+
+logger = logging.getLogger(__name__)
+
+
+class RegistrationOptions(NamedTuple):
+    visualization: bool = False
+    slab_size: int = 0  # 0 reads the whole image at once
+    n_workers: int = 1
+    icp_engine: str = "vtk"
+    crop_to_frame: bool = False
+    threshold_shrink: int = 1  # >1 estimates the threshold on a strided sample
+    closing_shrink: int = 1  # >1 closes the mask at a coarser resolution
+    slice_closing: bool = False  # close within axial slices, lazily per slice
+    icp_tolerance: Optional[float] = None  # [mm] stop the ICP stages on convergence
+    series_uid: Optional[str] = None  # series to read from a DICOM directory
+    z_range: Optional[ZRange] = None  # only read the DICOM slices in this range
+    z_stride: float = 0.0  # [mm] scan every so many mm for blobs, 0 scans all
+    points_per_bar: int = 0  # >0 sets z_stride to give about so many points
+    # transform of an earlier registration of the same frame, to start from
+    init_transform: Optional[Path] = None
+    initial_pose: str = "icp"  # "bars" fits the bars instead of the coarse stages
+    # [bytes] >0 keeps compact pixel types and streams slabs when needed
+    max_memory: int = 0
+
+
+class RegistrationResult(NamedTuple):
+    transform: sitk.Transform
+    mean_error: float
+    max_error: float
+    cached: bool = False
+    warm_started: bool = False
+
+
+def _cache_key_options(options: RegistrationOptions) -> RegistrationOptions:
+    # These do not change the result, so they should not cause a cache miss
+    options = options._replace(visualization=False, n_workers=1)
+    if options.init_transform is not None:
+        # the result depends on the initial transform, not on where it is stored
+        options = options._replace(
+            init_transform=Path(options.init_transform).read_text()  # type: ignore
+        )
+    return options
+
+
+def _detect_and_align(
+    image_path: Path,
+    modality: str,
+    options: RegistrationOptions,
+    frame: FrameProtocol,
+    profile: Optional[Profile],
+) -> RegistrationResult:
+    compact = options.max_memory > 0
+    preprocessor = Preprocessor(
+        modality,
+        roi_frame=frame if options.crop_to_frame else None,
+        threshold_shrink=options.threshold_shrink,
+        closing_shrink=options.closing_shrink,
+        slice_closing=options.slice_closing,
+        compact=compact,
+    )
+
+    if compact and options.slab_size == 0:
+        with profiling.stage("plan memory") as record:
+            plan = plan_memory(
+                image_path,
+                modality,
+                options.max_memory,
+                2 * preprocessor.closing_radius[2],
+                options.series_uid,
+            )
+            record.set(**plan._asdict())
+        if plan.slab_size > 0:
+            logger.info(
+                f"The image needs about {plan.estimate / 2**20:.0f} MB, more than "
+                f"the {plan.available / 2**20:.0f} MB left of the memory budget, "
+                f"streaming slabs of {plan.slab_size} slices"
+            )
+            options = options._replace(slab_size=plan.slab_size)
+
+    if options.slab_size > 0:
+        if Path(image_path).is_dir():
+            raise ValueError("A DICOM series can not be streamed in slabs")
+        # Keeps only slab_size axial slices in memory at a time
+        provider = StreamingAxialSliceProvider(
+            image_path, preprocessor, options.slab_size
+        )
+    else:
+        provider = AxialSliceProvider(
+            image_path,
+            preprocessor,
+            # the frame regions are closed while preprocessing
+            lazy_closing=options.slice_closing and not options.crop_to_frame,
+            # slices of a DICOM series are decoded by the workers
+            reader=partial(
+                read_image,
+                series_uid=options.series_uid,
+                z_range=options.z_range,
+                n_workers=options.n_workers,
+            ),
+            compact=compact,
+        )
+
+    # bit anoying that I have to give modality as input for preprocessor and for framedetector
+    detector = FrameDetector(
+        frame,
+        provider,
+        ArrayBlobDetector(),
+        modality,
+        options.visualization,
+        options.n_workers,
+        options.icp_engine,
+        DEFAULT_SCHEDULE
+        if options.icp_tolerance is None
+        else with_tolerance(DEFAULT_SCHEDULE, options.icp_tolerance),
+        profile,
+        SliceSampling(options.z_stride, options.points_per_bar),
+        None
+        if options.init_transform is None
+        else sitk.ReadTransform(str(options.init_transform)),
+        options.initial_pose,
+    )
+
+    detector.detect_frame()
+
+    transform = detector.get_transform_to_frame_space()
+    return RegistrationResult(
+        transform,
+        detector.mean_error,
+        detector.max_error,
+        warm_started=detector.warm_started,
+    )
+
+
+def calculate_frame_transform(
+    image_path: Path,
+    modality: str,
+    options: RegistrationOptions = RegistrationOptions(),
+    frame: Optional[FrameProtocol] = None,
+    cache: Optional[ResultCache] = None,
+    profile: Optional[Profile] = None,
+) -> RegistrationResult:
+    """Detect the frame in the image and calculate the transform to frame space.
+
+    With a cache, a result that was calculated before for the same image
+    content, modality, frame and options is returned without detecting. With a
+    profile, the timing of the stages is recorded in it."""
+    # This could be generalized to any frame with a frame option
+    if frame is None:
+        frame = LeksellFrame()
+
+    with profiling.activate(profile):
+        if cache is not None:
+            with profiling.stage("cache lookup") as record:
+                key = cache.key(
+                    image_path, modality, frame, _cache_key_options(options)
+                )
+                hit = cache.get(key)
+                record.set(hit=hit is not None)
+            if hit is not None:
+                transform, metrics = hit
+                return RegistrationResult(
+                    transform, metrics["mean_error"], metrics["max_error"], cached=True
+                )
+
+        result = _detect_and_align(image_path, modality, options, frame, profile)
+
+        if cache is not None:
+            try:
+                cache.put(
+                    key,
+                    result.transform,
+                    {
+                        "mean_error": float(result.mean_error),
+                        "max_error": float(result.max_error),
+                    },
+                )
+            except (OSError, RuntimeError, ValueError):
+                # the result is fine, it only is not cached
+                logger.exception("Could not store the result in the cache")
+    return result
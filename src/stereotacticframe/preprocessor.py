@@ -1,8 +1,28 @@
 import SimpleITK as sitk
 from functools import partial, reduce
-from typing import Callable
+import math
+from typing import Callable, Optional
+import logging
+
+from stereotacticframe import profiling
+from stereotacticframe.frame_protocol import FrameProtocol
+from stereotacticframe.geometry import dominant_axis
+from stereotacticframe.memory import INTEGER_PIXEL_TYPES
+from stereotacticframe.roi import (
+    ROI_SPACING,
+    find_bar_regions,
+    process_regions,
+    shrink_factors_for,
+)
+
+logger = logging.getLogger(__name__)
 
 ImageToImageCallable = Callable[[sitk.Image], sitk.Image]
+ImageToThresholdCallable = Callable[[sitk.Image], float]
+
+CLOSING_RADIUS: tuple[int, int, int] = (5, 5, 5)
+# The blobs are detected per axial slice, so closing within slices suffices
+SLICE_CLOSING_RADIUS: tuple[int, int, int] = (5, 5, 0)
 
 
 def _compose_two_functions(f: Callable, g: Callable):
@@ -13,22 +33,34 @@ def _compose(*fs):
     return reduce(_compose_two_functions, fs)
 
 
-def _li_threshold() -> ImageToImageCallable:
+def _li_threshold_filter() -> sitk.LiThresholdImageFilter:
     li = sitk.LiThresholdImageFilter()
     li.SetInsideValue(0)
     li.SetOutsideValue(1)
     li.SetNumberOfHistogramBins(256)
-    return li.Execute
+    return li
+
+
+def _li_threshold() -> ImageToImageCallable:
+    return _li_threshold_filter().Execute
+
 
+def _ct_clamp(ct_image: sitk.Image, compact: bool = False) -> sitk.Image:
+    # the clamped range fits int16, but only integers stay the same in it
+    if compact and ct_image.GetPixelID() in INTEGER_PIXEL_TYPES:
+        return sitk.Clamp(ct_image, sitk.sitkInt16, 512, 3072)
+    return sitk.Clamp(ct_image, sitk.sitkFloat32, 512, 3072)
 
-def _ct_pipeline(ct_image: sitk.Image) -> sitk.Image:
-    clamped = sitk.Clamp(ct_image, sitk.sitkFloat32, 512, 3072)
-    frame = sitk.OtsuThreshold(clamped, 0, 1, 256)
-    return sitk.BinaryMorphologicalClosing(frame, (5, 5, 5))
+
+def _ct_pipeline(ct_image: sitk.Image, compact: bool = False) -> sitk.Image:
+    # the clamped copy is freed before the closing allocates its buffers
+    frame = sitk.OtsuThreshold(_ct_clamp(ct_image, compact), 0, 1, 256)
+    return sitk.BinaryMorphologicalClosing(frame, CLOSING_RADIUS)
 
 
 _mr_pipeline = _compose(
-    partial(sitk.BinaryMorphologicalClosing, kernelRadius=(5, 5, 5)), _li_threshold()
+    partial(sitk.BinaryMorphologicalClosing, kernelRadius=CLOSING_RADIUS),
+    _li_threshold(),
 )
 
 _threshold_map: dict[str, ImageToImageCallable] = {
@@ -37,10 +69,180 @@ _threshold_map: dict[str, ImageToImageCallable] = {
 }
 
 
+def _ct_threshold_value(ct_image: sitk.Image, compact: bool = False) -> float:
+    otsu = sitk.OtsuThresholdImageFilter()
+    otsu.SetInsideValue(0)
+    otsu.SetOutsideValue(1)
+    otsu.SetNumberOfHistogramBins(256)
+    otsu.Execute(_ct_clamp(ct_image, compact))
+    return otsu.GetThreshold()
+
+
+def _mr_threshold_value(mr_image: sitk.Image) -> float:
+    li = _li_threshold_filter()
+    li.Execute(mr_image)
+    return li.GetThreshold()
+
+
+_threshold_value_map: dict[str, ImageToThresholdCallable] = {
+    "CT": _ct_threshold_value,
+    "MR": _mr_threshold_value,
+}
+
+# The same, with the CT clamped to int16, see Preprocessor
+_compact_threshold_map: dict[str, ImageToImageCallable] = {
+    "CT": partial(_ct_pipeline, compact=True),
+    "MR": _mr_pipeline,
+}
+
+_compact_threshold_value_map: dict[str, ImageToThresholdCallable] = {
+    "CT": partial(_ct_threshold_value, compact=True),
+    "MR": _mr_threshold_value,
+}
+
+
 class Preprocessor:
-    def __init__(self, modality):
+    """Segments the frame from an image.
+
+    When roi_frame is given, the image is only thresholded and closed inside
+    boxes around the fiducial plates of that frame, which are found on an
+    image shrunk to about roi_spacing [mm]. The threshold is then estimated on
+    that shrunken image too. If no plates that fit the frame are found, the
+    whole image is processed.
+
+    With threshold_shrink > 1 the threshold is estimated on every
+    threshold_shrink-th voxel along each axis only, and then applied at full
+    resolution. With closing_shrink > 1 the gaps are closed on a mask that is
+    closing_shrink times coarser, see _coarse_close.
+
+    With slice_closing the closing stays within axial slices, so it can also
+    be done per slice, as the slices are requested. closing_radius is in RAI
+    order, for other images the axial radius goes to their axial index axis.
+
+    With compact an integer CT is clamped to int16 instead of float32, which
+    can move the Otsu threshold by a fraction of a histogram bin.
+    """
+
+    def __init__(
+        self,
+        modality,
+        roi_frame: Optional[FrameProtocol] = None,
+        roi_spacing: float = ROI_SPACING,
+        threshold_shrink: int = 1,
+        closing_shrink: int = 1,
+        slice_closing: bool = False,
+        compact: bool = False,
+    ):
         self._modality: str = modality
-        self._thresholder: ImageToImageCallable = _threshold_map[self._modality]
+        self._thresholder: ImageToImageCallable = (
+            _compact_threshold_map if compact else _threshold_map
+        )[self._modality]
+        self._threshold_value: ImageToThresholdCallable = (
+            _compact_threshold_value_map if compact else _threshold_value_map
+        )[self._modality]
+        self.closing_radius: tuple[int, int, int] = (
+            SLICE_CLOSING_RADIUS if slice_closing else CLOSING_RADIUS
+        )
+        self._roi_frame: Optional[FrameProtocol] = roi_frame
+        self._roi_spacing: float = roi_spacing
+        self._threshold_shrink: int = max(1, threshold_shrink)
+        self._closing_shrink: int = max(1, closing_shrink)
 
     def process(self, image: sitk.Image) -> sitk.Image:
-        return self._thresholder(image)
+        if self._roi_frame is not None:
+            return self._process_frame_regions(image, self._roi_frame)
+        if (
+            self._threshold_shrink > 1
+            or self._closing_shrink > 1
+            or self.closing_radius != CLOSING_RADIUS
+        ):
+            return self._process_in_steps(image)
+        with profiling.stage("threshold and close"):
+            return self._thresholder(image)
+
+    def _process_in_steps(self, image: sitk.Image) -> sitk.Image:
+        shrink_factors = [min(self._threshold_shrink, size) for size in image.GetSize()]
+        threshold = self.estimate_threshold(sitk.Shrink(image, shrink_factors))
+        return self.close(self.apply_threshold(image, threshold))
+
+    def _process_frame_regions(
+        self, image: sitk.Image, frame: FrameProtocol
+    ) -> sitk.Image:
+        shrink_factors = shrink_factors_for(image, self._roi_spacing)
+        threshold = self.estimate_threshold(sitk.Shrink(image, shrink_factors))
+        with profiling.stage("find frame regions") as record:
+            regions = find_bar_regions(
+                image,
+                frame,
+                threshold,
+                shrink_factors,
+                halo=tuple(2 * radius for radius in self._radius_for(image)),  # type: ignore
+            )
+            record.set(regions=0 if regions is None else len(regions))
+        if regions is None:
+            logger.info("Could not find the frame plates, processing the whole image")
+            with profiling.stage("threshold and close"):
+                return self._thresholder(image)
+
+        return process_regions(
+            image,
+            regions,
+            lambda region: self.close(self.apply_threshold(region, threshold)),
+        )
+
+    # The steps below split process up, so that the threshold can be estimated
+    # on other voxels than the ones it is applied to, e.g. when streaming slabs.
+    def estimate_threshold(self, image: sitk.Image) -> float:
+        with profiling.stage("estimate threshold", accumulate=True):
+            return self._threshold_value(image)
+
+    def apply_threshold(self, image: sitk.Image, threshold: float) -> sitk.Image:
+        with profiling.stage("apply threshold", accumulate=True):
+            # The threshold filters label everything above the threshold as frame
+            return image > threshold
+
+    def close(self, mask: sitk.Image) -> sitk.Image:
+        """Closes a 3D mask, or a 2D axial slice of it"""
+        with profiling.stage("close", accumulate=True):
+            if self._closing_shrink > 1:
+                return self._coarse_close(mask)
+            return sitk.BinaryMorphologicalClosing(mask, self._radius_for(mask))
+
+    def _radius_for(self, image: sitk.Image) -> list[int]:
+        """Closing radius in the index order of image, a 2D image is axial"""
+        if image.GetDimension() == 2:
+            return list(self.closing_radius[:2])
+        axial_axis = dominant_axis(image.GetDirection(), 2)
+        # the in plane radii are the same, so their order does not matter
+        in_plane = iter(self.closing_radius[:2])
+        return [
+            self.closing_radius[2] if axis == axial_axis else next(in_plane)
+            for axis in range(3)
+        ]
+
+    def _coarse_close(self, mask: sitk.Image) -> sitk.Image:
+        """Closing of a coarse copy of the mask, only used to fill the gaps.
+
+        A coarse voxel is set when any of its voxels is, so structures do not
+        disappear. The coarse voxels that the closing adds are added to the full
+        resolution mask, which keeps its own detail everywhere else."""
+        radius = self._radius_for(mask)
+        shrink_factors = [
+            min(self._closing_shrink, size) if axis_radius > 0 else 1
+            for size, axis_radius in zip(mask.GetSize(), radius)
+        ]
+        coarse = sitk.BinShrink(sitk.Cast(mask, sitk.sitkFloat32), shrink_factors) > 0
+        coarse_radius = [
+            math.ceil(axis_radius / factor)
+            for axis_radius, factor in zip(radius, shrink_factors)
+        ]
+        closed = sitk.BinaryMorphologicalClosing(coarse, coarse_radius)
+        filled = sitk.Resample(
+            closed - coarse,
+            mask,
+            sitk.Transform(),
+            sitk.sitkNearestNeighbor,
+            0,
+            sitk.sitkUInt8,
+        )
+        return sitk.Cast(mask, sitk.sitkUInt8) | filled
@@ -0,0 +1,173 @@
+"""Lightweight timing of the stages of a frame registration.
+
+Code marks its stages with
+
+    with profiling.stage("preprocess") as record:
+        ...
+        record.set(slices=n_slices)
+
+which only records anything while a Profile is active. Otherwise stage
+returns a shared no-op record, so the instrumentation costs about a
+function call."""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import sys
+import threading
+import time
+from typing import Any, ContextManager, Iterator, Optional
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None  # type: ignore
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident memory of this process so far [MB]"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def current_rss_mb() -> Optional[float]:
+    """Resident memory of this process now [MB], only known on Linux"""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+    except OSError:
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+# What the memory fields of the json mean, written along with them
+MEMORY_FIELDS: dict[str, str] = {
+    "rss_mb_at_start": "resident memory [MB] when the stage first started",
+    "rss_mb_at_end": "resident memory [MB] when the stage last ended",
+    "peak_rss_growth_mb": (
+        "how much the peak resident memory of the process [MB] grew during the "
+        "stage, summed over its calls, 0 when the stage stayed below an "
+        "earlier peak"
+    ),
+    "peak_rss_mb": "peak resident memory of the process [MB] over the profile",
+}
+
+
+class StageRecord:
+    def __init__(self, name: str):
+        self.name: str = name
+        self.seconds: float = 0.0
+        self.calls: int = 0
+        self.rss_mb_at_start: Optional[float] = None
+        self.rss_mb_at_end: Optional[float] = None
+        self.peak_rss_growth_mb: Optional[float] = None
+        self.counts: dict[str, Any] = {}
+
+    def set(self, **counts: Any) -> None:
+        """Attach counts, like slices, points or iterations, to the stage"""
+        self.counts.update(counts)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "seconds": self.seconds,
+            "calls": self.calls,
+            "rss_mb_at_start": self.rss_mb_at_start,
+            "rss_mb_at_end": self.rss_mb_at_end,
+            "peak_rss_growth_mb": self.peak_rss_growth_mb,
+            **self.counts,
+        }
+
+
+class _NullRecord:
+    def set(self, **counts: Any) -> None:
+        pass
+
+    def __enter__(self) -> _NullRecord:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        pass
+
+
+_NULL_RECORD = _NullRecord()
+
+
+class Profile:
+    """Records of the stages, in the order in which they started.
+
+    Stages that run many times, like the blob detection per slice, can
+    accumulate into one record."""
+
+    def __init__(self) -> None:
+        self.stages: list[StageRecord] = []
+        self._accumulated: dict[str, StageRecord] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, accumulate: bool = False) -> Iterator[StageRecord]:
+        with self._lock:
+            record = self._accumulated.get(name) if accumulate else None
+            if record is None:
+                record = StageRecord(name)
+                self.stages.append(record)
+                if accumulate:
+                    self._accumulated[name] = record
+                record.rss_mb_at_start = current_rss_mb()
+        peak_at_start = peak_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            peak_at_end = peak_rss_mb()
+            with self._lock:
+                record.seconds += seconds
+                record.calls += 1
+                record.rss_mb_at_end = current_rss_mb()
+                if peak_at_start is not None and peak_at_end is not None:
+                    record.peak_rss_growth_mb = (record.peak_rss_growth_mb or 0.0) + (
+                        peak_at_end - peak_at_start
+                    )
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "stages": [record.to_dict() for record in self.stages],
+            "peak_rss_mb": peak_rss_mb(),
+            "memory_fields": MEMORY_FIELDS,
+        }
+
+    def write_json(self, path: Path) -> None:
+        with open(path, "w") as profile_file:
+            json.dump(self.to_dict(), profile_file, indent=2)
+
+
+_active_profile: Optional[Profile] = None
+
+
+@contextmanager
+def activate(profile: Optional[Profile]) -> Iterator[Optional[Profile]]:
+    """Record the stages in profile, None leaves the active profile as it is"""
+    global _active_profile
+    if profile is None:
+        yield _active_profile
+        return
+    previous, _active_profile = _active_profile, profile
+    try:
+        yield profile
+    finally:
+        _active_profile = previous
+
+
+def stage(name: str, accumulate: bool = False) -> ContextManager[Any]:
+    """Context manager that times the stage and gives its StageRecord"""
+    profile = _active_profile
+    if profile is None:
+        return _NULL_RECORD
+    return profile.stage(name, accumulate)
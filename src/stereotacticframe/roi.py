@@ -0,0 +1,135 @@
+"""Regions of interest around the lateral fiducial plates of a frame.
+
+A cheap pass over a shrunken copy of the image finds the outermost bright
+structures along the left-right axis. When they are about as far apart as the
+frame is wide, only boxes around them have to be preprocessed at full
+resolution."""
+
+from __future__ import annotations
+
+import logging
+from typing import Callable, Optional
+import SimpleITK as sitk
+import numpy as np
+
+from stereotacticframe.frame_protocol import FrameProtocol
+from stereotacticframe.geometry import dominant_axis
+
+logger = logging.getLogger(__name__)
+
+# Same distance from the fiducial plates as the liberal crop of the first alignment
+ROI_DEPTH = 40.0  # [mm]
+# Coarse enough to be cheap, fine enough not to step over the bars
+ROI_SPACING = 2.0  # [mm]
+
+Region = tuple[list[int], list[int]]  # index and size in itk order
+ImageToImageCallable = Callable[[sitk.Image], sitk.Image]
+
+
+def _bounding_range(
+    columns: np.ndarray, margin: int, size: int
+) -> Optional[tuple[int, int]]:
+    """[start, stop) around the nonzero entries of columns, padded by margin"""
+    nonzero = np.flatnonzero(columns)
+    if len(nonzero) == 0:
+        return None
+    return max(0, int(nonzero[0]) - margin), min(size, int(nonzero[-1]) + 1 + margin)
+
+
+def shrink_factors_for(
+    image: sitk.Image, coarse_spacing: float = ROI_SPACING
+) -> list[int]:
+    return [max(1, int(coarse_spacing / spacing)) for spacing in image.GetSpacing()]
+
+
+def find_bar_regions(
+    image: sitk.Image,
+    frame: FrameProtocol,
+    threshold: float,
+    shrink_factors: list[int],
+    halo: tuple[int, int, int] = (0, 0, 0),
+) -> Optional[list[Region]]:
+    """Boxes around the left and right fiducial plates of the frame.
+
+    The boxes are found on the image shrunk by shrink_factors, thresholded at
+    threshold, and padded by halo voxels. Returns None when the outermost
+    structures do not match the width of the frame."""
+    coarse = sitk.Shrink(image, shrink_factors)
+    # numpy (z, y, x) order, so itk axis a is numpy axis 2 - a
+    coarse_mask = sitk.GetArrayViewFromImage(coarse) > threshold
+    lateral_axis = dominant_axis(image.GetDirection(), 0)
+    axial_axis = dominant_axis(image.GetDirection(), 2)
+    numpy_lateral_axis = 2 - lateral_axis
+    other_axes = tuple(axis for axis in range(3) if axis != numpy_lateral_axis)
+    spacing = np.asarray(image.GetSpacing())
+    coarse_spacing = spacing * np.asarray(shrink_factors)
+
+    # The cranio-caudal bars fill a column over a large part of the frame
+    # height, isolated noise voxels above the threshold do not.
+    minimum_count = max(1, int(0.5 * frame.dimensions[2] / coarse_spacing[axial_axis]))
+    columns = np.flatnonzero(coarse_mask.sum(axis=other_axes) >= minimum_count)
+    if len(columns) == 0:
+        logger.debug("No structures above the threshold, can not crop to frame")
+        return None
+
+    margin = abs(frame.offset[0])
+    separation = (columns[-1] - columns[0]) * coarse_spacing[lateral_axis]
+    if abs(separation - frame.dimensions[0]) > 2 * margin:
+        logger.debug(
+            f"Outermost structures are {separation:.1f} mm apart, "
+            f"which does not match the frame width of {frame.dimensions[0]} mm"
+        )
+        return None
+
+    depth = int(np.ceil(ROI_DEPTH / coarse_spacing[lateral_axis]))
+    margins = np.ceil(margin / coarse_spacing).astype(int)
+    coarse_size = coarse.GetSize()
+    lateral_ranges = [
+        (int(columns[0]) - margins[lateral_axis], int(columns[0]) + depth + 1),
+        (int(columns[-1]) - depth, int(columns[-1]) + margins[lateral_axis] + 1),
+    ]
+
+    size = image.GetSize()
+    regions = []
+    for lateral_start, lateral_stop in lateral_ranges:
+        lateral_start = max(0, lateral_start)
+        lateral_stop = min(coarse_size[lateral_axis], lateral_stop)
+        plate_mask = np.take(
+            coarse_mask, range(lateral_start, lateral_stop), axis=numpy_lateral_axis
+        )
+        index, stop = [0, 0, 0], [0, 0, 0]
+        for axis in range(3):
+            if axis == lateral_axis:
+                coarse_range = (lateral_start, lateral_stop)
+            else:
+                bounding_range = _bounding_range(
+                    plate_mask.any(axis=tuple(a for a in range(3) if a != 2 - axis)),
+                    margins[axis],
+                    coarse_size[axis],
+                )
+                if bounding_range is None:
+                    return None
+                coarse_range = bounding_range
+            # back to full resolution, a coarse voxel covers shrink_factor voxels
+            shrink_factor = shrink_factors[axis]
+            index[axis] = int(max(0, coarse_range[0] * shrink_factor - halo[axis]))
+            stop[axis] = int(
+                min(size[axis], (coarse_range[1] + 1) * shrink_factor + halo[axis])
+            )
+        regions.append((index, [stop[axis] - index[axis] for axis in range(3)]))
+
+    return regions
+
+
+def process_regions(
+    image: sitk.Image, regions: list[Region], process: ImageToImageCallable
+) -> sitk.Image:
+    """Mask of the size of image, with process applied inside the regions only"""
+    mask = sitk.Image(image.GetSize(), sitk.sitkUInt8)
+    mask.CopyInformation(image)
+    for index, size in regions:
+        region_mask = sitk.Cast(
+            process(sitk.RegionOfInterest(image, size, index)), sitk.sitkUInt8
+        )
+        mask = sitk.Paste(mask, region_mask, size, [0, 0, 0], index)
+    return mask
@@ -0,0 +1,51 @@
+"""Scanning a subset of the axial slices for the fiducial bars.
+
+The bars are straight, so a thin slice CT gives many more points along them
+than the registration needs. A sparse scan first detects the blobs in every
+stride-th slice. Where two consecutive scanned slices have a different
+number of blobs, e.g. where a bar ends, a blob is missed or noise is
+detected, all slices in between are scanned too."""
+
+from __future__ import annotations
+
+from typing import Callable, Iterable, Iterator, NamedTuple
+
+import numpy as np
+
+SliceDetector = Callable[[int], np.ndarray]  # (N, 3) blobs of slice index
+MapCallable = Callable[[SliceDetector, Iterable[int]], Iterator[np.ndarray]]
+
+
+class SliceSampling(NamedTuple):
+    z_stride: float = 0.0  # [mm] distance between scanned slices, 0 scans all
+    points_per_bar: int = 0  # >0 sets z_stride from the height of the frame
+
+    def stride(self, slice_spacing: float, frame_height: float) -> int:
+        """Stride in slices, at least 1"""
+        z_stride = self.z_stride
+        if self.points_per_bar > 0:
+            z_stride = frame_height / self.points_per_bar
+        return max(1, int(z_stride / slice_spacing))
+
+
+def sparse_scan(
+    n_slices: int, stride: int, detect: SliceDetector, map_slices: MapCallable = map
+) -> tuple[np.ndarray, int]:
+    """Blobs of the scanned slices in slice order, and the number scanned"""
+    if n_slices == 0:
+        return np.empty((0, 3)), 0
+    indices = sorted(set(range(0, n_slices, stride)) | {n_slices - 1})
+    blobs = dict(zip(indices, map_slices(detect, indices)))
+
+    densify = [
+        index
+        for start, stop in zip(indices, indices[1:])
+        if len(blobs[start]) != len(blobs[stop])
+        for index in range(start + 1, stop)
+    ]
+    blobs.update(zip(densify, map_slices(detect, densify)))
+
+    return (
+        np.concatenate([np.empty((0, 3)), *(blobs[k] for k in sorted(blobs))]),
+        len(blobs),
+    )
@@ -0,0 +1,353 @@
+"""Run registration jobs in a process that stays warm.
+
+Every call of the command line interface imports SimpleITK, VTK and pyvista
+and builds the frame models before it does any work. The server pays for
+that once, and then runs the jobs that it gets as json objects, either one
+per line over a Unix socket, or as job files in a spool directory:
+
+    {"command": "calculate", "image": "t1.nii.gz", "modality": "MR",
+     "output": "t1.txt", "options": {"icp_engine": "numpy"}}
+    {"command": "apply", "image": "t1.nii.gz", "transform": "t1.txt",
+     "output": "t1_frame.nii.gz"}
+
+Every job gets a json result with its status, its metrics and its time.
+The jobs run one at a time in the server, or on a pool of processes that
+were warmed up when the server started."""
+
+from __future__ import annotations
+
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import json
+import logging
+import os
+from pathlib import Path
+import socket
+import socketserver
+import threading
+import time
+import traceback
+from typing import Any, Optional
+
+import SimpleITK as sitk
+
+from stereotacticframe.alignment import ICP_ENGINES, INITIAL_POSES
+from stereotacticframe.cache import ResultCache
+from stereotacticframe.dicom import read_image
+from stereotacticframe.frame_models import frame_model
+from stereotacticframe.frames import LeksellFrame
+from stereotacticframe.memory import parse_size
+from stereotacticframe.pipeline import RegistrationOptions, calculate_frame_transform
+from stereotacticframe.profiling import Profile
+from stereotacticframe.transforms import apply_transform, apply_transform_streamed
+
+logger = logging.getLogger(__name__)
+
+Job = dict[str, Any]
+JobResult = dict[str, Any]
+
+RESULT_SUFFIX = ".result.json"
+RUNNING_SUFFIX = ".running"
+
+# made once per process and shared by all of its jobs
+_FRAME = LeksellFrame()
+
+
+def _warm_up() -> None:
+    """Build the frame models before the first job needs them"""
+    for modality in ("CT", "MR"):
+        frame_model(_FRAME, modality)
+
+
+def _options(values: dict[str, Any]) -> RegistrationOptions:
+    """Options from json, which has no tuples or paths, and which can give
+    the memory budget as a size like 1GiB. The choices are checked here, so a
+    job with a wrong one fails before its image is read."""
+    options = RegistrationOptions(**values)
+    if options.icp_engine not in ICP_ENGINES:
+        raise ValueError(f"icp_engine should be one of {ICP_ENGINES}")
+    if options.initial_pose not in INITIAL_POSES:
+        raise ValueError(f"initial_pose should be one of {INITIAL_POSES}")
+    if isinstance(options.max_memory, str):
+        options = options._replace(max_memory=parse_size(options.max_memory))
+    if options.z_range is not None:
+        options = options._replace(z_range=tuple(options.z_range))
+    if options.init_transform is not None:
+        options = options._replace(init_transform=Path(options.init_transform))
+    return options
+
+
+def _calculate(job: Job, cache: Optional[ResultCache]) -> JobResult:
+    profile = Profile() if job.get("profile") else None
+    result = calculate_frame_transform(
+        Path(job["image"]),
+        job["modality"],
+        _options(job.get("options", {})),
+        frame=_FRAME,
+        cache=cache,
+        profile=profile,
+    )
+    output = Path(job["output"])
+    output.parent.mkdir(parents=True, exist_ok=True)
+    sitk.WriteTransform(result.transform, str(output))
+    metrics = {
+        "transform": str(output),
+        "mean_error": float(result.mean_error),
+        "max_error": float(result.max_error),
+        "cached": result.cached,
+        "warm_started": result.warm_started,
+    }
+    if profile is not None:
+        metrics["profile"] = profile.to_dict()
+    return metrics
+
+
+def _apply(job: Job, cache: Optional[ResultCache]) -> JobResult:
+    image_path = Path(job["image"])
+    slab_size = int(job.get("slab_size", 0))
+    if slab_size > 0 and (job.get("series_uid") is not None or image_path.is_dir()):
+        raise ValueError("A DICOM series can not be streamed, leave out slab_size")
+    transform = sitk.ReadTransform(str(job["transform"]))
+    output = Path(job["output"])
+    output.parent.mkdir(parents=True, exist_ok=True)
+    if slab_size > 0:
+        apply_transform_streamed(
+            image_path, transform, output, _FRAME, slab_size=slab_size
+        )
+    else:
+        image = read_image(image_path, job.get("series_uid"))
+        sitk.WriteImage(apply_transform(image, transform, _FRAME), str(output))
+    return {"output": str(output)}
+
+
+_command_map = {
+    "calculate": _calculate,
+    "apply": _apply,
+}
+
+
+def run_job(job: Job, cache: Optional[ResultCache] = None) -> JobResult:
+    """Run one job and return its result, never raises"""
+    start = time.perf_counter()
+    result: JobResult = {"id": job.get("id"), "command": job.get("command")}
+    try:
+        if job.get("command") not in _command_map:
+            raise ValueError(f"The command should be one of {list(_command_map)}")
+        result.update(_command_map[job["command"]](job, cache))
+        result.update(status="ok", error=None)
+    except Exception:
+        result.update(status="failed", error=traceback.format_exc())
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+class _WarmProcessPool(Executor):
+    """Pool of warmed up processes, which is replaced by a new pool when one
+    of its workers dies, e.g. of a segfault or of running out of memory, as
+    that breaks a process pool for good"""
+
+    def __init__(self, n_processes: int):
+        self._n_processes: int = n_processes
+        self._lock = threading.Lock()
+        self._pool: ProcessPoolExecutor = self._new_pool()
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self._n_processes, initializer=_warm_up)
+
+    def submit(self, fn, /, *args, **kwargs):  # type: ignore[override]
+        with self._lock:
+            pool = self._pool
+            try:
+                future = pool.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                pool = self._replace(pool)
+                future = pool.submit(fn, *args, **kwargs)
+        # added first, so the pool is replaced before other callbacks run
+        future.add_done_callback(lambda done: self._replace_if_broken(pool, done))
+        return future
+
+    def _replace_if_broken(self, pool: ProcessPoolExecutor, future: Future) -> None:
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            with self._lock:
+                self._replace(pool)
+
+    def _replace(self, broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+        """Replace the pool, unless another job of it replaced it already"""
+        if self._pool is broken:
+            logger.warning("A worker process died, starting a new pool")
+            broken.shutdown(wait=False)
+            self._pool = self._new_pool()
+        return self._pool
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        with self._lock:
+            self._pool.shutdown(wait, cancel_futures=cancel_futures)
+
+
+def job_executor(n_processes: int = 1) -> Executor:
+    """One worker thread in this process, or a pool of warmed up processes"""
+    if n_processes <= 1:
+        _warm_up()
+        # a single thread, since a registration is not thread safe
+        return ThreadPoolExecutor(max_workers=1)
+    return _WarmProcessPool(n_processes)
+
+
+def _submit(
+    executor: Executor, job: Job, cache: Optional[ResultCache]
+) -> Future[JobResult]:
+    """Future of the result of the job, which is a failed result when the job
+    could not run, e.g. when the process that ran it died. The other jobs that
+    were running in a pool then fail too, as it can not be told which job
+    killed the process."""
+    result: Future[JobResult] = Future()
+
+    def fail() -> None:
+        result.set_result(
+            {
+                "id": job.get("id"),
+                "command": job.get("command"),
+                "status": "failed",
+                "error": traceback.format_exc(),
+                "seconds": None,
+            }
+        )
+
+    def done(future: Future[JobResult]) -> None:
+        try:
+            job_result = future.result()
+        except BaseException:
+            # e.g. a broken pool, or a job that was cancelled at shutdown;
+            # the result has to be set, or its handler waits forever
+            fail()
+        else:
+            result.set_result(job_result)
+
+    try:
+        executor.submit(run_job, job, cache).add_done_callback(done)
+    except Exception:  # e.g. after the executor was shut down
+        fail()
+    return result
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as error:
+                result: JobResult = {"status": "failed", "error": str(error)}
+            else:
+                if job.get("command") == "ping":
+                    result = {"id": job.get("id"), "status": "ok"}
+                else:
+                    server: JobServer = self.server  # type: ignore
+                    result = _submit(server.executor, job, server.cache).result()
+            self.wfile.write((json.dumps(result) + "\n").encode())
+            self.wfile.flush()
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server, a connection can send any number of jobs"""
+
+    daemon_threads = True
+
+    def __init__(
+        self, socket_path: Path, executor: Executor, cache: Optional[ResultCache]
+    ):
+        if socket_path.exists():
+            socket_path.unlink()  # left behind by a server that was killed
+        self.executor = executor
+        self.cache = cache
+        super().__init__(str(socket_path), _JobHandler)
+
+
+def submit(socket_path: Path, job: Job, timeout: Optional[float] = None) -> JobResult:
+    """Send a job to a server and wait for its result"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(str(socket_path))
+        with connection.makefile("rwb") as stream:
+            stream.write((json.dumps(job) + "\n").encode())
+            stream.flush()
+            return json.loads(stream.readline())
+
+
+def _write_result(job_path: Path, result: JobResult) -> None:
+    result_path = job_path.with_name(job_path.stem + RESULT_SUFFIX)
+    temporary_path = result_path.with_name(result_path.name + ".tmp")
+    with open(temporary_path, "w") as result_file:
+        json.dump(result, result_file, indent=2)
+    os.replace(temporary_path, result_path)  # readers never see half a result
+
+
+def _claim(job_path: Path) -> Optional[Path]:
+    """Rename the job file, so no other server runs the job too"""
+    running_path = job_path.with_name(job_path.name + RUNNING_SUFFIX)
+    try:
+        job_path.rename(running_path)
+    except FileNotFoundError:
+        return None
+    return running_path
+
+
+def _run_spooled(
+    executor: Executor,
+    job_path: Path,
+    running_path: Path,
+    cache: Optional[ResultCache],
+) -> None:
+    try:
+        with open(running_path) as job_file:
+            job = json.load(job_file)
+    except (OSError, json.JSONDecodeError):
+        result = {"status": "failed", "error": traceback.format_exc()}
+        _write_result(job_path, result)
+        running_path.unlink(missing_ok=True)
+        return
+
+    def finish(future: Future[JobResult]) -> None:
+        try:
+            _write_result(job_path, future.result())
+        except Exception:
+            # a done callback would swallow the error
+            logger.exception(f"Could not write the result of {job_path.name}")
+        running_path.unlink(missing_ok=True)
+
+    _submit(executor, job, cache).add_done_callback(finish)
+
+
+def _pending_jobs(directory: Path) -> list[Path]:
+    """Job files, oldest first. Other servers on the same directory can claim
+    any of them in the meantime, those are left out."""
+    modified: list[tuple[float, Path]] = []
+    for path in directory.glob("*.json"):
+        if path.name.endswith(RESULT_SUFFIX):
+            continue
+        try:
+            modified.append((path.stat().st_mtime, path))
+        except FileNotFoundError:
+            continue
+    return [path for _, path in sorted(modified)]
+
+
+def serve_spool(
+    directory: Path,
+    executor: Executor,
+    cache: Optional[ResultCache] = None,
+    poll_interval: float = 0.5,
+    stop: Optional[threading.Event] = None,
+) -> None:
+    """Run every job file <name>.json that appears in directory, and write its
+    result to <name>.result.json, until stop is set"""
+    directory.mkdir(parents=True, exist_ok=True)
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        for job_path in _pending_jobs(directory):
+            running_path = _claim(job_path)
+            if running_path is not None:
+                logger.info(f"Running {job_path.name}")
+                _run_spooled(executor, job_path, running_path, cache)
+        stop.wait(poll_interval)
@@ -1,30 +1,327 @@
+from __future__ import annotations
+
 from pathlib import Path
 import SimpleITK as sitk
-from typing import Protocol
+import numpy as np
+from typing import Callable, NamedTuple, Optional, Protocol, cast
+
+from stereotacticframe import profiling
+from stereotacticframe.dicom import read_image
+from stereotacticframe.geometry import ImageGeometry
+from stereotacticframe.memory import compact_intensities
 
 
 def _reorient_rai(img):
     return sitk.DICOMOrient(img, "RAI")
 
 
+def _axial_axis(direction: tuple[float, ...]) -> tuple[int, bool]:
+    """Index axis that runs cranio-caudal, and whether it runs towards superior.
+
+    In RAI the axial slices go from superior to inferior, so an axis pointing
+    superior has to be read back to front."""
+    direction_matrix = np.asarray(direction).reshape(3, 3)
+    axis = int(np.argmax(np.abs(direction_matrix[2])))
+    return axis, bool(direction_matrix[2, axis] > 0)
+
+
+# Below this cosine between an index axis and the physical axis it is closest
+# to, the image is too oblique to tell which RAI axis an index axis belongs to.
+DOMINANT_COSINE = 0.75
+
+
+class AxisRemap(NamedTuple):
+    """How the RAI axes of an image map onto its index axes"""
+
+    axes: tuple[int, int, int]  # index axis of each RAI axis
+    flipped: tuple[bool, bool, bool]  # whether that index axis runs against RAI
+
+
+_IDENTITY = AxisRemap((0, 1, 2), (False, False, False))
+
+
+def _rai_remap(direction: tuple[float, ...]) -> Optional[AxisRemap]:
+    """The remap that DICOMOrient applies, or None for oblique images.
+
+    In RAI every axis runs against its physical axis of LPS space."""
+    direction_matrix = np.asarray(direction).reshape(3, 3)
+    axes = tuple(int(np.argmax(np.abs(row))) for row in direction_matrix)
+    cosines = [abs(direction_matrix[p, axes[p]]) for p in range(3)]
+    if len(set(axes)) < 3 or min(cosines) < DOMINANT_COSINE:
+        return None
+    flipped = tuple(bool(direction_matrix[p, axes[p]] > 0) for p in range(3))
+    return AxisRemap(axes, flipped)  # type: ignore
+
+
+def _remapped_geometry(image: sitk.Image, remap: AxisRemap) -> ImageGeometry:
+    size, spacing = image.GetSize(), image.GetSpacing()
+    direction_matrix = np.asarray(image.GetDirection()).reshape(3, 3)
+    first_index = [0, 0, 0]
+    for axis, flipped in zip(remap.axes, remap.flipped):
+        first_index[axis] = size[axis] - 1 if flipped else 0
+    signs = np.where(remap.flipped, -1.0, 1.0)
+    return ImageGeometry(
+        image.TransformIndexToPhysicalPoint(first_index),
+        tuple(spacing[axis] for axis in remap.axes),  # type: ignore
+        tuple((direction_matrix[:, list(remap.axes)] * signs).ravel()),
+    )
+
+
+def _remapped_view(array: np.ndarray, remap: AxisRemap) -> np.ndarray:
+    """View of a numpy (k, j, i) array in RAI (z, y, x) order"""
+    view = array.transpose([2 - axis for axis in reversed(remap.axes)])
+    flips = tuple(
+        slice(None, None, -1) if flipped else slice(None)
+        for flipped in reversed(remap.flipped)
+    )
+    return view[flips]
+
+
+ImageReader = Callable[[Path], sitk.Image]
+
+
 class Processor(Protocol):
     def process(self, image: sitk.Image) -> sitk.Image: ...
 
 
+class StreamingProcessor(Protocol):
+    closing_radius: tuple[int, int, int]
+
+    def estimate_threshold(self, image: sitk.Image) -> float: ...
+
+    def apply_threshold(self, image: sitk.Image, threshold: float) -> sitk.Image: ...
+
+    def close(self, mask: sitk.Image) -> sitk.Image: ...
+
+
 class AxialSliceProvider:
-    def __init__(self, image_path: Path, preprocessor: Processor):
+    """Axial slices of the image and its preprocessed mask, in RAI order.
+
+    With lazy_closing the volume is only thresholded up front, and each mask
+    slice is closed when it is requested. This needs a preprocessor that
+    closes within axial slices.
+
+    The image_path can also be a directory with a DICOM series, which reader
+    reads, see stereotacticframe.dicom.
+
+    With compact the intensities are kept as int16 when that is lossless, see
+    stereotacticframe.memory."""
+
+    def __init__(
+        self,
+        image_path: Path,
+        preprocessor: Processor,
+        lazy_closing: bool = False,
+        reader: ImageReader = read_image,
+        compact: bool = False,
+    ):
+        self._image_path: Path = image_path
+        with profiling.stage("read image") as record:
+            self._image: sitk.Image = reader(self._image_path)
+            record.set(size=list(self._image.GetSize()))
+        if compact:
+            with profiling.stage("compact intensities") as record:
+                self._image = compact_intensities(self._image)
+                record.set(pixel_type=self._image.GetPixelIDTypeAsString())
+        # The slices are taken from the image as it is stored, only an oblique
+        # image is reoriented to RAI.
+        with profiling.stage("reorient") as record:
+            remap = _rai_remap(self._image.GetDirection())
+            record.set(remapped=remap is not None)
+            if remap is None:
+                self._image = _reorient_rai(self._image)
+                remap = _IDENTITY
+        self._remap: AxisRemap = remap
+        self._geometry: ImageGeometry = _remapped_geometry(self._image, remap)
+        self._closer: StreamingProcessor | None = None
+        with profiling.stage("preprocess"):
+            if lazy_closing:
+                steps = cast(StreamingProcessor, preprocessor)
+                if steps.closing_radius[2] != 0:
+                    raise ValueError("Lazy closing needs a closing within axial slices")
+                self._closer = steps
+                self._mask: sitk.Image = steps.apply_threshold(
+                    self._image, steps.estimate_threshold(self._image)
+                )
+            else:
+                self._mask = preprocessor.process(self._image)
+        self._counter: int = 0
+        self._n_axial_slices: int = self._image.GetSize()[remap.axes[2]]
+        # made once, the views of single slices are taken from these
+        self._image_view: np.ndarray | None = None
+        self._mask_view: np.ndarray | None = None
+
+    def next_image_mask_pair(self) -> tuple[sitk.Image, sitk.Image]:
+        self._counter += 1
+        return self.get_image_mask_pair(self._counter - 1)
+
+    def is_empty(self) -> bool:
+        if self._counter >= self._n_axial_slices:
+            return True
+        return False
+
+    def get_current_z_coordinate(self) -> float:
+        return self.get_z_coordinate(self._counter - 1)
+
+    # Random access to the slices, which does not touch the counter
+    def get_number_of_slices(self) -> int:
+        return self._n_axial_slices
+
+    def _axial_slice(self, image: sitk.Image, index: int) -> sitk.Image:
+        """Axial slice index, in RAI order, with the geometry of a RAI slice"""
+        axes, flipped = self._remap
+        region: list[int | slice] = [slice(None)] * 3
+        region[axes[2]] = self._n_axial_slices - 1 - index if flipped[2] else index
+        for axis, axis_flipped in zip(axes[:2], flipped[:2]):
+            region[axis] = slice(None, None, -1) if axis_flipped else slice(None)
+        axial_slice = image[tuple(region)]
+        if axes[0] > axes[1]:
+            axial_slice = sitk.PermuteAxes(axial_slice, [1, 0])
+        origin = self._geometry.index_to_physical(np.array([[0.0, 0.0, index]]))[0]
+        axial_slice.SetOrigin(tuple(origin[:2]))
+        axial_slice.SetSpacing(self._geometry.spacing[:2])
+        direction = self._geometry.direction_matrix()
+        axial_slice.SetDirection(tuple(direction[:2, :2].ravel()))
+        return axial_slice
+
+    def get_image_mask_pair(self, index: int) -> tuple[sitk.Image, sitk.Image]:
+        image_slice = self._axial_slice(self._image, index)
+        mask_slice = self._axial_slice(self._mask, index)
+        if self._closer is not None:
+            return image_slice, self._closer.close(mask_slice)
+        return image_slice, mask_slice
+
+    def get_z_coordinate(self, index: int) -> float:
+        return float(
+            self._geometry.index_to_physical(np.array([[0.0, 0.0, index]]))[0, 2]
+        )
+
+    def get_array_pair(
+        self, index: int
+    ) -> tuple[np.ndarray, np.ndarray, ImageGeometry]:
+        """Views on axial slice index of the image and mask, in numpy (y, x)
+        order, with the geometry of the volume moved to that slice"""
+        if self._image_view is None:
+            self._image_view = _remapped_view(
+                sitk.GetArrayViewFromImage(self._image), self._remap
+            )
+        if self._closer is not None:
+            mask_slice = self._closer.close(self._axial_slice(self._mask, index))
+            mask_array = sitk.GetArrayFromImage(mask_slice)
+        else:
+            if self._mask_view is None:
+                self._mask_view = _remapped_view(
+                    sitk.GetArrayViewFromImage(self._mask), self._remap
+                )
+            mask_array = self._mask_view[index]
+        origin = self._geometry.index_to_physical(np.array([[0.0, 0.0, index]]))[0]
+        return (
+            self._image_view[index],
+            mask_array,
+            self._geometry._replace(origin=tuple(origin)),
+        )
+
+    def get_volume_arrays(self) -> tuple[np.ndarray, np.ndarray, ImageGeometry]:
+        """Views on the image and mask buffers, in RAI numpy (z, y, x) order."""
+        if self._closer is not None:
+            # the whole volume is needed anyway, so close it at once
+            self._mask = self._closer.close(self._mask)
+            self._closer = None
+            self._mask_view = None
+        return (
+            _remapped_view(sitk.GetArrayViewFromImage(self._image), self._remap),
+            _remapped_view(sitk.GetArrayViewFromImage(self._mask), self._remap),
+            self._geometry,
+        )
+
+
+class StreamingAxialSliceProvider:
+    """Axial slice provider that reads and preprocesses the image in slabs.
+
+    Only one slab of slab_size axial slices, plus a halo for the closing, is
+    in memory at a time. The threshold is estimated on at most
+    threshold_sample_size evenly spaced axial slices."""
+
+    def __init__(
+        self,
+        image_path: Path,
+        preprocessor: StreamingProcessor,
+        slab_size: int = 32,
+        threshold_sample_size: int = 64,
+    ):
         self._image_path: Path = image_path
-        self._image: sitk.Image = sitk.ReadImage(self._image_path)
-        self._rai_image: sitk.Image = _reorient_rai(self._image)
-        self._rai_mask: sitk.Image = preprocessor.process(self._rai_image)
+        self._preprocessor: StreamingProcessor = preprocessor
+        self._reader = sitk.ImageFileReader()
+        self._reader.SetFileName(str(image_path))
+        with profiling.stage("read image information"):
+            self._reader.ReadImageInformation()
+        self._size: tuple[int, ...] = self._reader.GetSize()
+        self._axial_axis, self._superior_first_in_file = _axial_axis(
+            self._reader.GetDirection()
+        )
+        self._n_axial_slices: int = self._size[self._axial_axis]
+        self._slab_size: int = max(1, slab_size)
+        # closing is a dilation followed by an erosion, each reaching a radius
+        self._halo: int = 2 * preprocessor.closing_radius[2]
+        with profiling.stage("read threshold sample"):
+            threshold_sample = self._read_threshold_sample(threshold_sample_size)
+        self._threshold: float = preprocessor.estimate_threshold(threshold_sample)
         self._counter: int = 0
-        self._n_axial_slices: int = self._rai_image.GetSize()[-1]
+        self._slab_image: sitk.Image | None = None
+        self._slab_mask: sitk.Image | None = None
+        self._slab_start: int = 0  # rai index of the first slice of the slab
+        self._slab_stop: int = 0
+
+    def _read_rai_slab(self, start: int, stop: int) -> sitk.Image:
+        """Read axial slices [start, stop) in RAI slice order"""
+        if self._superior_first_in_file:
+            start, stop = self._n_axial_slices - stop, self._n_axial_slices - start
+        extract_index = [0, 0, 0]
+        extract_size = list(self._size)
+        extract_index[self._axial_axis] = start
+        extract_size[self._axial_axis] = stop - start
+        self._reader.SetExtractIndex(extract_index)
+        self._reader.SetExtractSize(extract_size)
+        return _reorient_rai(self._reader.Execute())
+
+    def _read_threshold_sample(self, sample_size: int) -> sitk.Image:
+        slice_indices = np.unique(
+            np.linspace(0, self._n_axial_slices - 1, max(1, sample_size)).astype(int)
+        ).tolist()
+        sample: np.ndarray | None = None
+        for row, k in enumerate(slice_indices):
+            values = sitk.GetArrayViewFromImage(self._read_rai_slab(k, k + 1)).ravel()
+            if sample is None:
+                # filled slice by slice, without a list of all the slices
+                sample = np.empty((len(slice_indices), values.size), values.dtype)
+            sample[row] = values
+        return sitk.GetImageFromArray(sample)
+
+    def _load_slab(self, start: int) -> None:
+        stop = min(start + self._slab_size, self._n_axial_slices)
+        halo_start = max(0, start - self._halo)
+        halo_stop = min(stop + self._halo, self._n_axial_slices)
+        # free the previous slab before reading the next one
+        self._slab_image, self._slab_mask = None, None
+
+        with profiling.stage("read slab", accumulate=True) as record:
+            image = self._read_rai_slab(halo_start, halo_stop)
+            record.set(slab_size=self._slab_size, halo=self._halo)
+        mask = self._preprocessor.close(
+            self._preprocessor.apply_threshold(image, self._threshold)
+        )
+        self._slab_image = image[..., start - halo_start : stop - halo_start]
+        self._slab_mask = mask[..., start - halo_start : stop - halo_start]
+        self._slab_start, self._slab_stop = start, stop
 
     def next_image_mask_pair(self) -> tuple[sitk.Image, sitk.Image]:
+        if self._slab_image is None or not (
+            self._slab_start <= self._counter < self._slab_stop
+        ):
+            self._load_slab(self._counter)
         self._counter += 1
-        return self._rai_image[..., self._counter - 1], self._rai_mask[
-            ..., self._counter - 1
-        ]
+        k = self._counter - 1 - self._slab_start
+        return self._slab_image[..., k], self._slab_mask[..., k]  # type: ignore
 
     def is_empty(self) -> bool:
         if self._counter >= self._n_axial_slices:
@@ -32,5 +329,7 @@ class AxialSliceProvider:
         return False
 
     def get_current_z_coordinate(self) -> float:
-        point = self._rai_image.TransformIndexToPhysicalPoint([0, 0, self._counter - 1])
+        point = self._slab_image.TransformIndexToPhysicalPoint(  # type: ignore
+            [0, 0, self._counter - 1 - self._slab_start]
+        )
         return point[2]
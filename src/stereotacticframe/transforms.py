@@ -1,20 +1,252 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, NamedTuple, Sequence
 import SimpleITK as sitk
+import numpy as np
 
 from stereotacticframe.frame_protocol import FrameProtocol
 
 
-def apply_transform(
+class FrameGrid(NamedTuple):
+    """Output grid in frame space, which only depends on the input spacing"""
+
+    size: tuple[int, int, int]
+    origin: tuple[float, float, float]
+    spacing: tuple[float, ...]
+    direction: tuple[float, ...]
+
+
+def frame_grid(spacing: tuple[float, ...], frame: FrameProtocol) -> FrameGrid:
+    return FrameGrid(
+        frame.get_size_based_on(spacing),  # type: ignore
+        frame.offset,
+        spacing,
+        frame.direction,
+    )
+
+
+def _resample(
     image: sitk.Image,
-    transform: sitk.AffineTransform,
-    frame: FrameProtocol,
-    interpolator=sitk.sitkLinear,
+    transform: sitk.Transform,
+    grid: FrameGrid,
+    interpolator: int,
 ) -> sitk.Image:
     return sitk.Resample(
         image,
-        frame.get_size_based_on(image.GetSpacing()),
+        grid.size,
         transform,
         interpolator,
-        frame.offset,
-        image.GetSpacing(),
-        frame.direction,
+        grid.origin,
+        grid.spacing,
+        grid.direction,
     )
+
+
+def apply_transform(
+    image: sitk.Image,
+    transform: sitk.AffineTransform,
+    frame: FrameProtocol,
+    interpolator=sitk.sitkLinear,
+) -> sitk.Image:
+    return _resample(
+        image, transform, frame_grid(image.GetSpacing(), frame), interpolator
+    )
+
+
+def apply_transform_to_images(
+    images: Sequence[sitk.Image],
+    transform: sitk.Transform,
+    frame: FrameProtocol,
+    interpolator=sitk.sitkLinear,
+    n_workers: int = 1,
+) -> list[sitk.Image]:
+    """apply_transform for many images, resampled concurrently on n_workers threads.
+
+    Images with the same spacing share one frame space grid. The mapping of an
+    affine transform is cheap to evaluate per voxel, so it is not cached."""
+    grids: dict[tuple[float, ...], FrameGrid] = {}
+    for image in images:
+        spacing = image.GetSpacing()
+        if spacing not in grids:
+            grids[spacing] = frame_grid(spacing, frame)
+
+    def resample(image: sitk.Image) -> sitk.Image:
+        return _resample(image, transform, grids[image.GetSpacing()], interpolator)
+
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        return list(executor.map(resample, images))
+
+
+def apply_transform_to_files(
+    image_paths: Sequence[Path],
+    transform: sitk.Transform,
+    output_paths: Sequence[Path],
+    frame: FrameProtocol,
+    interpolator=sitk.sitkLinear,
+    n_workers: int = 1,
+) -> None:
+    """Read, resample and write every image on one of n_workers threads.
+
+    Only the images that are being worked on are in memory, and reading and
+    writing overlap with resampling. SimpleITK releases the GIL meanwhile."""
+    grids: dict[tuple[float, ...], FrameGrid] = {}
+
+    def apply(image_path: Path, output_path: Path) -> None:
+        image = sitk.ReadImage(image_path)
+        spacing = image.GetSpacing()
+        if spacing not in grids:
+            # a race only computes the same grid twice
+            grids[spacing] = frame_grid(spacing, frame)
+        grid = grids[spacing]
+        sitk.WriteImage(_resample(image, transform, grid, interpolator), output_path)
+
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        # list raises the first error, if any
+        list(executor.map(apply, image_paths, output_paths))
+
+
+_meta_element_types: dict[int, str] = {
+    sitk.sitkUInt8: "MET_UCHAR",
+    sitk.sitkInt8: "MET_CHAR",
+    sitk.sitkUInt16: "MET_USHORT",
+    sitk.sitkInt16: "MET_SHORT",
+    sitk.sitkUInt32: "MET_UINT",
+    sitk.sitkInt32: "MET_INT",
+    sitk.sitkFloat32: "MET_FLOAT",
+    sitk.sitkFloat64: "MET_DOUBLE",
+}
+
+# Interpolators that only look at the neighbouring voxels, so that they give
+# the same values on a region of the input that is INPUT_MARGIN voxels larger
+# than the region that is sampled. B-splines are fitted to the whole image.
+_LOCAL_INTERPOLATORS = (sitk.sitkNearestNeighbor, sitk.sitkLinear)
+INPUT_MARGIN = 2
+
+
+def _numbers(values: Sequence[float]) -> str:
+    return " ".join(f"{value:.17g}" for value in values)
+
+
+def _write_meta_header(
+    output_file: BinaryIO,
+    grid: FrameGrid,
+    pixel_id: int,
+) -> None:
+    """Header of an uncompressed MetaImage, the voxels follow it"""
+    if pixel_id not in _meta_element_types:
+        raise ValueError(
+            f"Can not stream images of pixel type {sitk.GetPixelIDValueAsString(pixel_id)}"
+        )
+    # MetaImage stores the direction column by column
+    transform_matrix = np.asarray(grid.direction).reshape(3, 3).T.ravel()
+    lines = [
+        "ObjectType = Image",
+        "NDims = 3",
+        "BinaryData = True",
+        "BinaryDataByteOrderMSB = False",
+        "CompressedData = False",
+        f"TransformMatrix = {_numbers(transform_matrix)}",
+        f"Offset = {_numbers(grid.origin)}",
+        "CenterOfRotation = 0 0 0",
+        f"ElementSpacing = {_numbers(grid.spacing)}",
+        f"DimSize = {' '.join(str(size) for size in grid.size)}",
+    ]
+    lines += [
+        f"ElementType = {_meta_element_types[pixel_id]}",
+        "ElementDataFile = LOCAL",
+    ]
+    output_file.write(("\n".join(lines) + "\n").encode("ascii"))
+
+
+def _slab_grid(grid: FrameGrid, start: int, stop: int) -> FrameGrid:
+    direction = np.asarray(grid.direction).reshape(3, 3)
+    origin = np.asarray(grid.origin) + direction[:, 2] * grid.spacing[2] * start
+    return grid._replace(
+        size=(grid.size[0], grid.size[1], stop - start), origin=tuple(origin)
+    )
+
+
+def _input_region(
+    reader: sitk.ImageFileReader, transform: sitk.Transform, grid: FrameGrid
+) -> tuple[list[int], list[int]] | None:
+    """Index and size of the input voxels that the grid samples, None if none"""
+    direction = np.asarray(grid.direction).reshape(3, 3)
+    corners = np.array(
+        [
+            [i, j, k]
+            for i in (0, grid.size[0] - 1)
+            for j in (0, grid.size[1] - 1)
+            for k in (0, grid.size[2] - 1)
+        ],
+        dtype=np.float64,
+    )
+    points = np.asarray(grid.origin) + (corners * grid.spacing) @ direction.T
+    # the transform maps output points onto input points, for an affine
+    # transform the corners of the grid bound the sampled input region
+    input_points = np.array([transform.TransformPoint(point) for point in points])
+    input_direction = np.asarray(reader.GetDirection()).reshape(3, 3)
+    continuous_indices = (
+        (input_points - reader.GetOrigin()) @ np.linalg.inv(input_direction).T
+    ) / reader.GetSpacing()
+    size = np.asarray(reader.GetSize())
+    lower = np.maximum(np.floor(continuous_indices.min(axis=0)) - INPUT_MARGIN, 0)
+    upper = np.minimum(np.ceil(continuous_indices.max(axis=0)) + INPUT_MARGIN + 1, size)
+    if np.any(upper <= lower):
+        return None
+    return lower.astype(int).tolist(), (upper - lower).astype(int).tolist()
+
+
+def apply_transform_streamed(
+    image_path: Path,
+    transform: sitk.Transform,
+    output_path: Path,
+    frame: FrameProtocol,
+    interpolator=sitk.sitkLinear,
+    slab_size: int = 16,
+) -> None:
+    """apply_transform that resamples and writes slab_size slices at a time.
+
+    The output is written as an uncompressed MetaImage (.mha), one slab after
+    the other, and for every slab only the input region it samples is read.
+    The voxels are those of apply_transform; as the region has another origin
+    than the whole input, a floating point value can differ in its last bits."""
+    if Path(output_path).suffix != ".mha":
+        raise ValueError("A streamed output has to be a .mha file")
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(image_path))
+    reader.ReadImageInformation()
+    grid = frame_grid(reader.GetSpacing(), frame)
+    # compressed files can not be read in parts, and for non-linear transforms
+    # and global interpolators the sampled region is not known: read once
+    whole_image = None
+    if (
+        str(image_path).endswith(".gz")
+        or not transform.IsLinear()
+        or interpolator not in _LOCAL_INTERPOLATORS
+    ):
+        whole_image = reader.Execute()
+
+    with open(output_path, "wb") as output_file:
+        _write_meta_header(output_file, grid, reader.GetPixelID())
+        slab_size = max(1, slab_size)
+        for start in range(0, grid.size[2], slab_size):
+            slab_grid = _slab_grid(grid, start, min(start + slab_size, grid.size[2]))
+            if whole_image is not None:
+                slab = _resample(whole_image, transform, slab_grid, interpolator)
+            else:
+                region = _input_region(reader, transform, slab_grid)
+                if region is None:
+                    # the slab lies outside the input, where resampling gives zeros
+                    slab = sitk.Image(list(slab_grid.size), reader.GetPixelID())
+                else:
+                    reader.SetExtractIndex(region[0])
+                    reader.SetExtractSize(region[1])
+                    slab = _resample(
+                        reader.Execute(), transform, slab_grid, interpolator
+                    )
+            array = sitk.GetArrayViewFromImage(slab)
+            output_file.write(
+                np.asarray(array, dtype=array.dtype.newbyteorder("<")).tobytes()
+            )
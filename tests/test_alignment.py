@@ -0,0 +1,187 @@
+from stereotacticframe.alignment import (
+    DEFAULT_SCHEDULE,
+    AlignmentStage,
+    CropBox,
+    refinement,
+    select_points,
+    with_tolerance,
+)
+from stereotacticframe.frame_detector import FrameDetector
+from stereotacticframe.frames import LeksellFrame
+import numpy as np
+import SimpleITK as sitk
+import pytest
+
+
+def test_select_points_keeps_box_order() -> None:
+    points = np.array([[200.0, 0, 0], [0.0, 0, 0], [100.0, 0, 0], [190.0, 0, -200]])
+    stage = AlignmentStage(
+        "test",
+        iterations=1,
+        crop_boxes=(
+            CropBox(maximum=(40, np.inf, np.inf)),
+            CropBox(minimum=(150, -np.inf, -150)),
+        ),
+    )
+
+    assert select_points(points, stage).tolist() == [1, 0]
+
+
+def test_select_points_by_distance() -> None:
+    points = np.zeros((3, 3))
+    stage = AlignmentStage("test", iterations=1, max_distance=3.0)
+
+    assert select_points(points, stage, np.array([1.0, 4.0, 2.0])).tolist() == [0, 2]
+    with pytest.raises(ValueError):
+        select_points(points, stage)
+
+
+@pytest.fixture
+def frame_points() -> np.ndarray:
+    """Points on the MR frame edges, moved by a small rigid transform"""
+    frame = LeksellFrame()
+    nodes = np.asarray(frame.nodes)
+    fractions = np.linspace(0.0, 1.0, 40)[:, np.newaxis]
+    points = np.concatenate(
+        [
+            nodes[start] + fractions * (nodes[end] - nodes[start])
+            for start, end in frame.get_edges("MR")
+        ]
+    )
+    angle = 0.02
+    rotation = np.array(
+        [
+            [np.cos(angle), -np.sin(angle), 0.0],
+            [np.sin(angle), np.cos(angle), 0.0],
+            [0.0, 0.0, 1.0],
+        ]
+    )
+    return points @ rotation.T + np.array([-95.0, 60.0, -60.0])
+
+
+@pytest.mark.parametrize("icp_engine", ["vtk", "numpy"])
+def test_stages_stop_on_convergence(frame_points, icp_engine) -> None:
+    detector = FrameDetector(
+        LeksellFrame(),
+        None,  # type: ignore
+        None,  # type: ignore
+        modality="MR",
+        icp_engine=icp_engine,
+        schedule=with_tolerance(DEFAULT_SCHEDULE, 1e-6),
+    )
+    detector._points = frame_points
+
+    detector.get_transform_to_frame_space()
+
+    assert [name for name, _ in detector.stage_iterations] == [
+        stage.name for stage in DEFAULT_SCHEDULE
+    ]
+    assert all(
+        iterations < stage.iterations
+        for (_, iterations), stage in zip(
+            detector.stage_iterations[1:], DEFAULT_SCHEDULE[1:]
+        )
+    )
+    assert detector.max_error < 1e-3
+
+
+def _frame_to_image(angle: float, translation: tuple[float, float, float]):
+    transform = sitk.Euler3DTransform()
+    transform.SetRotation(0.0, 0.0, angle)
+    transform.SetTranslation(translation)
+    return transform
+
+
+@pytest.mark.parametrize("icp_engine", ["vtk", "numpy"])
+def test_warm_start_runs_refinement_only(frame_points, icp_engine) -> None:
+    # a bit off from the pose of frame_points
+    initial_transform = _frame_to_image(0.03, (-93.0, 61.0, -58.0))
+    detector = FrameDetector(
+        LeksellFrame(),
+        None,  # type: ignore
+        None,  # type: ignore
+        modality="MR",
+        icp_engine=icp_engine,
+        initial_transform=initial_transform,
+    )
+    detector._points = frame_points
+
+    transform = detector.get_transform_to_frame_space()
+
+    assert detector.warm_started
+    assert [name for name, _ in detector.stage_iterations] == [
+        stage.name for stage in refinement(DEFAULT_SCHEDULE)
+    ]
+    assert detector.max_error < 1e-3
+    assert transform.TransformPoint((0.0, 0.0, 0.0)) == pytest.approx(
+        (-95.0, 60.0, -60.0), abs=1e-3
+    )
+
+
+def test_warm_start_falls_back_to_full_schedule(frame_points) -> None:
+    # upside down, the refinement alone can not recover from this
+    initial_transform = _frame_to_image(np.pi, (95.0, -60.0, 60.0))
+    detector = FrameDetector(
+        LeksellFrame(),
+        None,  # type: ignore
+        None,  # type: ignore
+        modality="MR",
+        icp_engine="numpy",
+        initial_transform=initial_transform,
+    )
+    detector._points = frame_points
+
+    detector.get_transform_to_frame_space()
+
+    assert not detector.warm_started
+    assert [name for name, _ in detector.stage_iterations] == [
+        stage.name for stage in DEFAULT_SCHEDULE
+    ]
+    assert detector.max_error < 1e-3
+
+
+@pytest.mark.parametrize("icp_engine", ["vtk", "numpy"])
+def test_fitted_bars_replace_coarse_stages(frame_points, icp_engine) -> None:
+    detector = FrameDetector(
+        LeksellFrame(),
+        None,  # type: ignore
+        None,  # type: ignore
+        modality="MR",
+        icp_engine=icp_engine,
+        initial_pose="bars",
+    )
+    detector._points = frame_points
+
+    transform = detector.get_transform_to_frame_space()
+
+    assert detector.warm_started
+    assert [name for name, _ in detector.stage_iterations] == [
+        stage.name for stage in refinement(DEFAULT_SCHEDULE)
+    ]
+    assert detector.max_error < 1e-3
+    assert transform.TransformPoint((0.0, 0.0, 0.0)) == pytest.approx(
+        (-95.0, 60.0, -60.0), abs=1e-3
+    )
+
+
+def test_unfitted_bars_fall_back_to_full_schedule(frame_points, monkeypatch) -> None:
+    monkeypatch.setattr(
+        "stereotacticframe.frame_detector.fit_frame_pose", lambda *args: None
+    )
+    detector = FrameDetector(
+        LeksellFrame(),
+        None,  # type: ignore
+        None,  # type: ignore
+        modality="MR",
+        icp_engine="numpy",
+        initial_pose="bars",
+    )
+    detector._points = frame_points
+
+    detector.get_transform_to_frame_space()
+
+    assert not detector.warm_started
+    assert [name for name, _ in detector.stage_iterations] == [
+        stage.name for stage in DEFAULT_SCHEDULE
+    ]
+    assert detector.max_error < 1e-3
@@ -0,0 +1,46 @@
+from stereotacticframe.bar_fit import fit_frame_pose
+from stereotacticframe.frames import LeksellFrame
+from stereotacticframe.icp import transform_points
+from stereotacticframe.phantoms import rotation_matrix
+import numpy as np
+import pytest
+
+
+def _bar_points(modality: str, frame_to_image: np.ndarray) -> np.ndarray:
+    """Noisy points along the edges in image space, and some outliers"""
+    frame = LeksellFrame()
+    nodes = np.asarray(frame.nodes)
+    fractions = np.linspace(0.0, 1.0, 30)[:, np.newaxis]
+    points = np.concatenate(
+        [
+            nodes[start] + fractions * (nodes[end] - nodes[start])
+            for start, end in frame.get_edges(modality)
+        ]
+    )
+    rng = np.random.default_rng(0)
+    points += rng.normal(0.0, 0.3, points.shape)
+    outliers = rng.uniform((0.0, -120.0, -120.0), (190.0, 0.0, 0.0), (40, 3))
+    return transform_points(frame_to_image, np.concatenate((points, outliers)))
+
+
+@pytest.mark.parametrize("modality", ["CT", "MR"])
+def test_fit_recovers_pose(modality) -> None:
+    frame_to_image = np.eye(4)
+    frame_to_image[:3, :3] = rotation_matrix((0.1, -0.15, 0.2))
+    frame_to_image[:3, 3] = (-95.0, 60.0, -60.0)
+    nodes = np.asarray(LeksellFrame().nodes)
+
+    matrix = fit_frame_pose(
+        _bar_points(modality, frame_to_image), LeksellFrame(), modality
+    )
+
+    assert matrix is not None
+    assert transform_points(matrix @ frame_to_image, nodes) == pytest.approx(
+        nodes, abs=1.0
+    )
+
+
+def test_fit_fails_without_bars() -> None:
+    points = np.random.default_rng(0).uniform(-100.0, 100.0, (300, 3))
+
+    assert fit_frame_pose(points, LeksellFrame(), "CT") is None
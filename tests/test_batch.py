@@ -0,0 +1,89 @@
+from stereotacticframe import batch
+from stereotacticframe.batch import BatchCase, read_manifest, run_batch
+from stereotacticframe.pipeline import RegistrationResult
+import SimpleITK as sitk
+import json
+import os
+import pytest
+from pathlib import Path
+
+
+@pytest.fixture
+def image_dir(tmp_path) -> Path:
+    image_dir = tmp_path.joinpath("images")
+    image_dir.mkdir()
+    for name in ["b.nii.gz", "a.nii", "notes.txt"]:
+        image_dir.joinpath(name).write_text("not an image")
+    return image_dir
+
+
+def test_reads_directory_manifest(image_dir, tmp_path) -> None:
+    cases = read_manifest(image_dir, tmp_path.joinpath("out"), "MR")
+
+    assert cases == [
+        BatchCase(image_dir.joinpath("a.nii"), "MR", tmp_path.joinpath("out/a.txt")),
+        BatchCase(image_dir.joinpath("b.nii.gz"), "MR", tmp_path.joinpath("out/b.txt")),
+    ]
+
+
+def test_directory_manifest_needs_modality(image_dir, tmp_path) -> None:
+    with pytest.raises(ValueError):
+        read_manifest(image_dir, tmp_path)
+
+
+def test_reads_csv_manifest(tmp_path) -> None:
+    manifest = tmp_path.joinpath("manifest.csv")
+    manifest.write_text(
+        "image,modality,output\nimages/a.nii,CT,transforms/a.txt\nimages/b.nii,MR,\n"
+    )
+
+    cases = read_manifest(manifest, tmp_path.joinpath("out"))
+
+    assert cases == [
+        BatchCase(
+            tmp_path.joinpath("images/a.nii"),
+            "CT",
+            tmp_path.joinpath("transforms/a.txt"),
+        ),
+        BatchCase(
+            tmp_path.joinpath("images/b.nii"), "MR", tmp_path.joinpath("out/b.txt")
+        ),
+    ]
+
+
+@pytest.mark.parametrize("n_processes", [1, 2])
+def test_failing_cases_do_not_abort_batch(image_dir, tmp_path, n_processes) -> None:
+    cases = read_manifest(image_dir, tmp_path.joinpath("out"), "MR")
+
+    summaries = run_batch(cases, n_processes=n_processes)
+
+    assert [summary["status"] for summary in summaries] == ["failed", "failed"]
+    with open(tmp_path.joinpath("out/b.json")) as summary_file:
+        summary = json.load(summary_file)
+    assert summary["image"] == str(image_dir.joinpath("b.nii.gz"))
+    assert summary["error"]
+
+
+def _register_or_crash(image_path, modality, options, cache=None):
+    if image_path.name.startswith("crash"):
+        os._exit(1)
+    return RegistrationResult(sitk.Euler3DTransform(), 0.1, 0.2)
+
+
+def test_crashing_case_does_not_fail_other_cases(tmp_path, monkeypatch) -> None:
+    # the worker processes are forked after this, so they use it too
+    monkeypatch.setattr(batch, "calculate_frame_transform", _register_or_crash)
+    names = ["a", "crash", "b", "c", "d", "e", "f"]
+    cases = [
+        BatchCase(
+            tmp_path.joinpath(f"{name}.nii"), "CT", tmp_path.joinpath(f"{name}.txt")
+        )
+        for name in names
+    ]
+
+    summaries = run_batch(cases, n_processes=2)
+
+    assert [summary["status"] for summary in summaries] == [
+        "failed" if name == "crash" else "ok" for name in names
+    ]
+    assert "BrokenProcessPool" in summaries[1]["error"]
@@ -1,6 +1,12 @@
 from typing import Tuple
 
-from stereotacticframe.blob_detection import detect_blobs
+from stereotacticframe.blob_detection import (
+    detect_blobs,
+    detect_blobs_in_volume,
+    ArrayBlobDetector,
+    VolumeBlobDetector,
+)
+from stereotacticframe.geometry import ImageGeometry
 import pytest
 import numpy as np
 import SimpleITK as sitk
@@ -102,3 +108,58 @@ def test_finds_small_blobs_ignores_big_blob(six_small_blobs_one_big_blob) -> Non
     assert len(blob_list) == 6
     assert (blob_list[0][0], blob_list[0][1]) == pytest.approx((175 * 1.1, 50 * 1.1))
     assert (blob_list[5][0], blob_list[5][1]) == pytest.approx((25 * 1.1, 150 * 1.1))
+
+
+@pytest.fixture(scope="module")
+def blob_volume(two_blobs, six_small_blobs_one_big_blob):
+    """Three axial slices with the same blob in consecutive slices"""
+    blob_slice = sitk.GetArrayFromImage(six_small_blobs_one_big_blob)
+    other_slice = np.zeros_like(blob_slice)
+    other_slice[:100, :100] = sitk.GetArrayFromImage(two_blobs)
+    sitk_image = sitk.GetImageFromArray(np.stack([blob_slice, other_slice, blob_slice]))
+    sitk_image.SetSpacing((1.1, 1.1, 2.0))
+    sitk_image.SetOrigin((-10.0, 5.0, 20.0))
+    sitk_image.SetDirection((-1.0, 0.0, 0.0, 0.0, -1.0, 0.0, 0.0, 0.0, -1.0))
+    return sitk_image
+
+
+def test_volume_blobs_match_slice_blobs(blob_volume) -> None:
+    mask = blob_volume > 60
+    expected = []
+    for k in range(blob_volume.GetSize()[2]):
+        z = blob_volume.TransformIndexToPhysicalPoint((0, 0, k))[2]
+        expected += [
+            blob + (z,)
+            for blob in detect_blobs(blob_volume[..., k], mask[..., k], "MR")
+        ]
+
+    blobs = detect_blobs_in_volume(blob_volume, mask, "MR")
+
+    assert blobs.shape == (14, 3)
+    assert blobs == pytest.approx(np.asarray(expected))
+
+
+def test_volume_blob_detector_is_drop_in(two_blobs) -> None:
+    blob_list = VolumeBlobDetector()(two_blobs, two_blobs > 60, "MR")
+    assert blob_list == detect_blobs(two_blobs, two_blobs > 60, "MR")
+
+
+def test_array_blobs_match_slice_blobs(blob_volume) -> None:
+    mask = blob_volume > 60
+    image_array = sitk.GetArrayViewFromImage(blob_volume)
+    mask_array = sitk.GetArrayViewFromImage(mask)
+    detector = ArrayBlobDetector()
+
+    for k in range(blob_volume.GetSize()[2]):
+        z = blob_volume.TransformIndexToPhysicalPoint((0, 0, k))[2]
+        expected = [
+            blob + (z,)
+            for blob in detect_blobs(blob_volume[..., k], mask[..., k], "MR")
+        ]
+        geometry = ImageGeometry.from_image(blob_volume)._replace(
+            origin=blob_volume.TransformIndexToPhysicalPoint((0, 0, k))
+        )
+
+        blobs = detector.detect_arrays(image_array[k], mask_array[k], geometry, "MR")
+
+        assert blobs == pytest.approx(np.asarray(expected))
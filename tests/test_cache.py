@@ -0,0 +1,131 @@
+from stereotacticframe.cache import ResultCache
+from stereotacticframe.frames import LeksellFrame
+from stereotacticframe.phantoms import PhantomSpec, make_phantom
+from stereotacticframe.pipeline import RegistrationOptions, calculate_frame_transform
+import SimpleITK as sitk
+import os
+import pytest
+from pathlib import Path
+
+
+@pytest.fixture
+def image_path(tmp_path) -> Path:
+    image_path = tmp_path.joinpath("image.nii")
+    image_path.write_bytes(b"not really an image")
+    return image_path
+
+
+def _transform(translation: float) -> sitk.Transform:
+    transform = sitk.AffineTransform(3)
+    transform.SetTranslation((translation, 0.0, 0.0))
+    return transform
+
+
+def test_key_depends_on_content_and_modality(image_path, tmp_path) -> None:
+    cache = ResultCache(tmp_path.joinpath("cache"))
+    key = cache.key(image_path, "MR", LeksellFrame())
+
+    assert cache.key(image_path, "MR", LeksellFrame()) == key
+    assert cache.key(image_path, "CT", LeksellFrame()) != key
+    image_path.write_bytes(b"another image")
+    assert cache.key(image_path, "MR", LeksellFrame()) != key
+
+
+def test_round_trip(image_path, tmp_path) -> None:
+    cache = ResultCache(tmp_path.joinpath("cache"))
+    key = cache.key(image_path, "MR", LeksellFrame())
+    assert cache.get(key) is None
+
+    cache.put(key, _transform(3.0), {"mean_error": 0.1, "max_error": 0.2})
+
+    hit = cache.get(key)
+    assert hit is not None
+    transform, metrics = hit
+    assert transform.TransformPoint((0.0, 0.0, 0.0)) == pytest.approx((3.0, 0, 0))
+    assert metrics == {"mean_error": 0.1, "max_error": 0.2}
+
+    cache.clear()
+    assert cache.get(key) is None
+    assert cache.size() == 0
+
+
+def _set_last_used(cache_dir: Path, key: str, timestamp: float) -> None:
+    for path in cache_dir.glob(key + ".*"):
+        os.utime(path, (timestamp, timestamp))
+
+
+def test_evicts_least_recently_used(tmp_path) -> None:
+    cache_dir = tmp_path.joinpath("cache")
+    metrics = {"mean_error": 0.0, "max_error": 0.0}
+    keys = [f"{i:064x}" for i in range(3)]
+    ResultCache(cache_dir).put(keys[0], _transform(0.0), metrics)
+    entry_size = ResultCache(cache_dir).size()
+    cache = ResultCache(cache_dir, max_bytes=2 * entry_size)
+    cache.put(keys[1], _transform(1.0), metrics)
+    _set_last_used(cache_dir, keys[0], 1_000)
+    _set_last_used(cache_dir, keys[1], 2_000)
+
+    # a hit makes the oldest entry the most recently used one
+    cache.get(keys[0])
+    cache.put(keys[2], _transform(2.0), metrics)
+
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) is not None
+
+
+def test_ignores_entries_that_other_processes_removed(tmp_path, monkeypatch) -> None:
+    cache_dir = tmp_path.joinpath("cache")
+    metrics = {"mean_error": 0.0, "max_error": 0.0}
+    keys = [f"{i:064x}" for i in range(3)]
+    ResultCache(cache_dir).put(keys[0], _transform(0.0), metrics)
+    cache = ResultCache(cache_dir, max_bytes=ResultCache(cache_dir).size())
+    entry_files = ResultCache._entry_files
+
+    def listed_then_removed(self) -> list[Path]:
+        # another process evicts this entry after it was listed
+        return [*entry_files(self), cache_dir.joinpath(keys[1] + ".txt")]
+
+    monkeypatch.setattr(ResultCache, "_entry_files", listed_then_removed)
+
+    cache.put(keys[2], _transform(2.0), metrics)
+
+    assert cache.get(keys[2]) is not None
+    assert cache.size() > 0
+
+
+def test_pipeline_is_not_failed_by_the_cache(tmp_path, monkeypatch) -> None:
+    spec = PhantomSpec("MR", size=(180, 180, 45), spacing=(1.4, 1.4, 3.0))
+    image_path = tmp_path.joinpath("phantom.mha")
+    sitk.WriteImage(make_phantom(spec).image, image_path)
+    cache = ResultCache(tmp_path.joinpath("cache"))
+
+    def fail(*args) -> None:
+        raise FileNotFoundError("removed by another process")
+
+    monkeypatch.setattr(cache, "put", fail)
+
+    result = calculate_frame_transform(
+        image_path, "MR", RegistrationOptions(icp_engine="numpy"), cache=cache
+    )
+
+    assert not result.cached
+    assert result.max_error < 1.0
+
+
+def test_pipeline_returns_cached_result(image_path, tmp_path) -> None:
+    cache = ResultCache(tmp_path.joinpath("cache"))
+    options = RegistrationOptions(icp_engine="numpy")
+    key = cache.key(image_path, "MR", LeksellFrame(), options)
+    cache.put(key, _transform(5.0), {"mean_error": 0.1, "max_error": 0.2})
+
+    # The image is not readable, so this only works without detecting the frame
+    result = calculate_frame_transform(
+        image_path, "MR", options._replace(n_workers=4), cache=cache
+    )
+
+    assert result.cached
+    assert result.max_error == 0.2
+    assert result.transform.TransformPoint((0.0, 0.0, 0.0)) == pytest.approx(
+        (5.0, 0, 0)
+    )
@@ -0,0 +1,160 @@
+from stereotacticframe.cli import app
+from stereotacticframe.frames import LeksellFrame
+from stereotacticframe.transforms import apply_transform
+from typer.testing import CliRunner
+import SimpleITK as sitk
+import json
+import numpy as np
+import pytest
+import subprocess
+import sys
+
+runner = CliRunner()
+
+
+def test_calculate_batch_reports_failed_cases(tmp_path) -> None:
+    image_dir = tmp_path.joinpath("images")
+    image_dir.mkdir()
+    image_dir.joinpath("broken.nii.gz").write_text("not an image")
+    output_dir = tmp_path.joinpath("out")
+
+    result = runner.invoke(
+        app, ["calculate-batch", str(image_dir), str(output_dir), "--modality", "CT"]
+    )
+
+    assert result.exit_code == 1
+    with open(output_dir.joinpath("summary.json")) as summary_file:
+        summaries = json.load(summary_file)
+    assert [summary["status"] for summary in summaries] == ["failed"]
+
+
+def test_calculate_rejects_a_memory_budget_that_is_not_a_size(tmp_path) -> None:
+    result = runner.invoke(
+        app,
+        [
+            "calculate",
+            str(tmp_path.joinpath("image.nii.gz")),
+            "CT",
+            str(tmp_path.joinpath("transform.txt")),
+            str(tmp_path.joinpath("log.txt")),
+            "--max-memory",
+            "a lot",
+        ],
+    )
+
+    assert result.exit_code == 2
+    assert not tmp_path.joinpath("transform.txt").exists()
+
+
+@pytest.mark.parametrize(
+    "option", [["--initial-pose", "closed-form"], ["--icp-engine", "scipy"]]
+)
+def test_calculate_batch_rejects_unknown_choices(tmp_path, option) -> None:
+    image_dir = tmp_path.joinpath("images")
+    image_dir.mkdir()
+    output_dir = tmp_path.joinpath("out")
+
+    result = runner.invoke(
+        app,
+        ["calculate-batch", str(image_dir), str(output_dir), "--modality", "CT"]
+        + option,
+    )
+
+    assert result.exit_code == 2
+    assert not output_dir.exists()
+
+
+def test_apply_many_writes_every_image(tmp_path) -> None:
+    transform = sitk.Euler3DTransform()
+    transform.SetTranslation((-95.0, 10.0, -60.0))
+    transform_path = tmp_path.joinpath("transform.txt")
+    sitk.WriteTransform(transform, transform_path)
+    image_paths = []
+    for name, spacing in [("ct.mha", 4.0), ("t1.mha", 5.0)]:
+        image = sitk.Image([60, 40, 70], sitk.sitkFloat32) + 1.0
+        image.SetSpacing([spacing] * 3)
+        image.SetOrigin((-110.0, 30.0, -240.0))
+        image_paths.append(tmp_path.joinpath(name))
+        sitk.WriteImage(image, image_paths[-1])
+    output_dir = tmp_path.joinpath("frame_space")
+
+    result = runner.invoke(
+        app,
+        ["apply-many", str(transform_path), str(output_dir)]
+        + [str(path) for path in image_paths],
+    )
+
+    assert result.exit_code == 0
+    for image_path in image_paths:
+        expected = apply_transform(
+            sitk.ReadImage(image_path), transform, LeksellFrame()
+        )
+        written = sitk.ReadImage(output_dir.joinpath(image_path.name))
+        assert sitk.GetArrayViewFromImage(written).max() == 1.0
+        assert np.array_equal(
+            sitk.GetArrayFromImage(written), sitk.GetArrayFromImage(expected)
+        )
+
+
+HEAVY_MODULES = ("vtk", "pyvista")
+
+
+@pytest.mark.parametrize("source", ["directory", "series_uid"])
+def test_apply_does_not_stream_a_dicom_series(tmp_path, source) -> None:
+    transform_path = tmp_path.joinpath("transform.txt")
+    sitk.WriteTransform(sitk.Euler3DTransform(), transform_path)
+    image_path = tmp_path.joinpath("image.mha")
+    sitk.WriteImage(sitk.Image([8, 8, 8], sitk.sitkFloat32), image_path)
+    output_path = tmp_path.joinpath("frame.mha")
+    arguments = [str(image_path), str(transform_path), str(output_path)]
+    if source == "directory":
+        arguments[0] = str(tmp_path)
+    else:
+        arguments += ["--series-uid", "1.2.3"]
+
+    result = runner.invoke(app, ["apply", *arguments, "--slab-size", "4"])
+
+    assert result.exit_code == 2
+    assert not output_path.exists()
+
+
+def _imported_modules(arguments: list[str]) -> set[str]:
+    """Heavy modules imported by running the CLI with arguments in a new process"""
+    code = (
+        "import sys\n"
+        "from stereotacticframe.cli import app\n"
+        "try:\n"
+        f"    app({arguments!r})\n"
+        "except SystemExit as exit:\n"
+        "    assert not exit.code, exit.code\n"
+        f"print('imported:', *(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    return set(result.stdout.splitlines()[-1].split()[1:])
+
+
+@pytest.mark.parametrize(
+    "command", [None, "calculate", "calculate-batch", "apply", "apply-many", "serve"]
+)
+def test_help_does_not_import_registration(command) -> None:
+    arguments = [command, "--help"] if command else ["--help"]
+
+    assert _imported_modules(arguments) == set()
+
+
+def test_apply_does_not_import_registration(tmp_path) -> None:
+    transform_path = tmp_path.joinpath("transform.txt")
+    sitk.WriteTransform(sitk.Euler3DTransform(), transform_path)
+    image_path = tmp_path.joinpath("image.mha")
+    sitk.WriteImage(sitk.Image([8, 8, 8], sitk.sitkFloat32), image_path)
+    arguments = ["apply", str(image_path), str(transform_path)]
+
+    assert _imported_modules(arguments + [str(tmp_path.joinpath("a.mha"))]) == set()
+    assert (
+        _imported_modules(
+            arguments + [str(tmp_path.joinpath("b.mha")), "--slab-size", "4"]
+        )
+        == set()
+    )
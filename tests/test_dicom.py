@@ -0,0 +1,73 @@
+from stereotacticframe.dicom import read_image, read_series
+from stereotacticframe.phantoms import PhantomSpec, make_phantom, write_dicom_series
+from stereotacticframe.pipeline import RegistrationOptions, calculate_frame_transform
+import SimpleITK as sitk
+import numpy as np
+import pytest
+
+SERIES_UID = "1.2.826.0.1.3680043.2.1125.7.1"
+OTHER_SERIES_UID = "1.2.826.0.1.3680043.2.1125.7.2"
+
+
+@pytest.fixture(scope="module")
+def phantom():
+    spec = PhantomSpec("CT", size=(180, 180, 45), spacing=(1.4, 1.4, 3.0), noise=20)
+    return make_phantom(spec)
+
+
+@pytest.fixture(scope="module")
+def dicom_directory(tmp_path_factory, phantom):
+    directory = tmp_path_factory.mktemp("dicom")
+    write_dicom_series(phantom.image, directory, SERIES_UID, "CT")
+    return directory
+
+
+@pytest.mark.parametrize("n_workers", [1, 3])
+def test_series_matches_the_image(dicom_directory, phantom, n_workers) -> None:
+    image = read_series(dicom_directory, n_workers=n_workers)
+
+    assert np.array_equal(
+        sitk.GetArrayViewFromImage(image), sitk.GetArrayViewFromImage(phantom.image)
+    )
+    assert np.allclose(image.GetOrigin(), phantom.image.GetOrigin(), atol=1e-4)
+    assert np.allclose(image.GetSpacing(), phantom.image.GetSpacing())
+    assert np.allclose(image.GetDirection(), phantom.image.GetDirection())
+
+
+@pytest.mark.parametrize("n_workers", [1, 3])
+def test_only_slices_in_z_range_are_read(dicom_directory, phantom, n_workers) -> None:
+    # slice k of the phantom is at origin z + 3 k
+    origin_z = phantom.image.GetOrigin()[2]
+    z_range = (origin_z + 10 * 3.0 - 0.5, origin_z + 19 * 3.0 + 0.5)
+
+    image = read_series(dicom_directory, z_range=z_range, n_workers=n_workers)
+
+    assert image.GetSize()[2] == 10
+    assert np.array_equal(
+        sitk.GetArrayViewFromImage(image),
+        sitk.GetArrayViewFromImage(phantom.image)[10:20],
+    )
+
+
+def test_series_has_to_be_selected(tmp_path, phantom) -> None:
+    write_dicom_series(phantom.image[:, :, :5], tmp_path, SERIES_UID, "CT")
+    write_dicom_series(phantom.image[:, :, 5:12], tmp_path, OTHER_SERIES_UID, "CT")
+
+    with pytest.raises(ValueError):
+        read_image(tmp_path)
+    assert read_image(tmp_path, OTHER_SERIES_UID).GetSize()[2] == 7
+
+
+def test_registration_of_dicom_directory(dicom_directory, phantom) -> None:
+    result = calculate_frame_transform(
+        dicom_directory, "CT", RegistrationOptions(n_workers=2, icp_engine="numpy")
+    )
+
+    reference_path = dicom_directory.parent.joinpath("phantom.mha")
+    sitk.WriteImage(phantom.image, reference_path)
+    reference = calculate_frame_transform(
+        reference_path, "CT", RegistrationOptions(icp_engine="numpy")
+    )
+    assert np.allclose(
+        result.transform.GetParameters(), reference.transform.GetParameters()
+    )
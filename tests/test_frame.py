@@ -1,11 +1,12 @@
 from pathlib import Path
 import pytest
+import numpy as np
 import SimpleITK as sitk
 
 from stereotacticframe.frames import LeksellFrame
 from stereotacticframe.frame_detector import FrameDetector
 from stereotacticframe.slice_provider import AxialSliceProvider
-from stereotacticframe.blob_detection import detect_blobs
+from stereotacticframe.blob_detection import detect_blobs, VolumeBlobDetector
 from stereotacticframe.preprocessor import Preprocessor
 
 TEST_MR_IMAGE_PATH = Path("tests/data/frame/t1_15T_test_volume.nii.gz")
@@ -52,6 +53,58 @@ def correct_ct_path(tmp_path) -> Path:
     return correct_ct_path
 
 
+@pytest.fixture(scope="module")
+def rods_image_path(tmp_path_factory) -> Path:
+    """Noisy volume with three thin bright rods running through all axial slices"""
+    rng = np.random.default_rng(0)
+    array = rng.normal(10.0, 2.0, size=(30, 60, 60)).astype(np.float32)
+    for row, column in [(10, 10), (10, 45), (40, 30)]:
+        array[:, row : row + 3, column : column + 3] = 200.0
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing((1.0, 1.0, 2.0))
+    path = tmp_path_factory.mktemp("frame").joinpath("rods.nii")
+    sitk.WriteImage(image, path)
+    return path
+
+
+@pytest.mark.parametrize(
+    "blob_detector, n_workers", [(detect_blobs, 4), (VolumeBlobDetector(), 1)]
+)
+def test_detect_frame_scan_modes_match_serial_scan(
+    rods_image_path, blob_detector, n_workers
+) -> None:
+    serial = FrameDetector(
+        LeksellFrame(),
+        AxialSliceProvider(rods_image_path, Preprocessor("MR")),
+        detect_blobs,
+        modality="MR",
+    )
+    detector = FrameDetector(
+        LeksellFrame(),
+        AxialSliceProvider(rods_image_path, Preprocessor("MR")),
+        blob_detector,
+        modality="MR",
+        n_workers=n_workers,
+    )
+
+    serial.detect_frame()
+    detector.detect_frame()
+
+    assert serial._points.shape == (3 * 30, 3)
+    assert detector._points == pytest.approx(serial._points)
+
+
+def test_unknown_icp_engine_raises(rods_image_path) -> None:
+    with pytest.raises(ValueError):
+        FrameDetector(
+            LeksellFrame(),
+            AxialSliceProvider(rods_image_path, Preprocessor("MR")),
+            detect_blobs,
+            modality="MR",
+            icp_engine="unknown",
+        )
+
+
 @pytest.mark.longrun
 def test_align_leksell_frame_mr() -> None:
     detector = FrameDetector(
@@ -0,0 +1,45 @@
+from stereotacticframe.frame_models import _create_lines, frame_model
+from stereotacticframe.frames import LeksellFrame
+from stereotacticframe.icp import closest_points_on_segments
+import numpy as np
+import pytest
+
+
+class SmallFrame(LeksellFrame):
+    nodes = [(0.0, 0.0, 0.0), (0.0, 0.0, -50.0), (80.0, 0.0, 0.0), (80.0, 0.0, -50.0)]
+    ct_edges = [(0, 1), (2, 3)]
+    mr_edges = [(0, 1), (2, 3), (1, 3)]
+
+
+@pytest.mark.parametrize("modality", ["CT", "MR"])
+def test_frame_mesh_has_a_line_per_edge(modality) -> None:
+    frame = LeksellFrame()
+    edges = frame.get_edges(modality)
+
+    mesh = _create_lines(edges, frame.nodes)
+
+    lines = mesh.lines.reshape(-1, 3)
+    assert (lines[:, 0] == 2).all()
+    assert mesh.points[lines[:, 1:]] == pytest.approx(
+        np.asarray(frame.nodes)[np.asarray(edges)]
+    )
+
+
+def test_models_are_shared_per_frame_class_and_modality() -> None:
+    model = frame_model(LeksellFrame(), "MR")
+
+    assert frame_model(LeksellFrame(), "MR") is model
+    assert frame_model(LeksellFrame(), "CT") is not model
+    assert len(frame_model(SmallFrame(), "MR").starts) == 3
+    with pytest.raises(ValueError):
+        model.starts[0, 0] = 1.0
+
+
+@pytest.mark.parametrize("frame", [LeksellFrame(), SmallFrame()])
+def test_locator_finds_closest_points_on_segments(frame) -> None:
+    model = frame_model(frame, "MR")
+    points = np.random.default_rng(0).uniform(-50.0, 250.0, (200, 3))
+
+    assert model.locate_closest_points(points) == pytest.approx(
+        closest_points_on_segments(points, model.starts, model.ends)
+    )
@@ -0,0 +1,82 @@
+from stereotacticframe.icp import (
+    closest_points_on_segments,
+    frame_segments,
+    iterative_closest_point,
+    rigid_transform,
+    transform_points,
+)
+from stereotacticframe.frames import LeksellFrame
+import numpy as np
+import pytest
+
+
+def _rotation_z(angle: float) -> np.ndarray:
+    matrix = np.eye(4)
+    matrix[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    return matrix
+
+
+@pytest.fixture
+def leksell_points() -> np.ndarray:
+    """Points sampled along the CT edges of the Leksell frame"""
+    starts, ends = frame_segments(LeksellFrame().ct_edges, LeksellFrame().nodes)
+    fractions = np.linspace(0.05, 0.95, 40)[:, np.newaxis, np.newaxis]
+    return (starts + fractions * (ends - starts)).reshape(-1, 3)
+
+
+def test_closest_points_on_segments() -> None:
+    starts = np.array([[0.0, 0.0, 0.0], [10.0, 0.0, 0.0]])
+    ends = np.array([[0.0, 0.0, 10.0], [10.0, 10.0, 0.0]])
+    points = np.array([[1.0, 0.0, 5.0], [0.0, 0.0, 12.0], [9.0, 4.0, 1.0]])
+
+    closest = closest_points_on_segments(points, starts, ends)
+
+    assert closest == pytest.approx(
+        np.array([[0.0, 0.0, 5.0], [0.0, 0.0, 10.0], [10.0, 4.0, 0.0]])
+    )
+
+
+def test_closest_points_match_segment_by_segment() -> None:
+    starts, ends = frame_segments(LeksellFrame().mr_edges, LeksellFrame().nodes)
+    points = np.random.default_rng(0).uniform(-50.0, 250.0, (500, 3))
+
+    closest = closest_points_on_segments(points, starts, ends)
+
+    per_segment = []
+    for start, end in zip(starts, ends):
+        fractions = np.clip(
+            (points - start) @ (end - start) / np.sum((end - start) ** 2), 0, 1
+        )
+        per_segment.append(start + fractions[:, np.newaxis] * (end - start))
+    distances = np.linalg.norm(np.stack(per_segment) - points, axis=2)
+    assert np.linalg.norm(closest - points, axis=1) == pytest.approx(
+        distances.min(axis=0)
+    )
+    assert closest == pytest.approx(
+        np.stack(per_segment)[distances.argmin(axis=0), np.arange(len(points))]
+    )
+
+
+def test_rigid_transform_recovers_rotation_and_translation(leksell_points) -> None:
+    matrix = _rotation_z(0.1)
+    matrix[:3, 3] = (5.0, -3.0, 2.0)
+
+    estimate = rigid_transform(leksell_points, transform_points(matrix, leksell_points))
+
+    assert estimate == pytest.approx(matrix)
+
+
+def test_icp_registers_points_to_frame(leksell_points) -> None:
+    misalignment = _rotation_z(0.02)
+    misalignment[:3, 3] = (2.0, 1.0, -1.5)
+    moved_points = transform_points(misalignment, leksell_points)
+    starts, ends = frame_segments(LeksellFrame().ct_edges, LeksellFrame().nodes)
+
+    matrix, iterations = iterative_closest_point(
+        moved_points, starts, ends, iterations=500, start_by_matching_centroids=False
+    )
+
+    assert iterations < 500
+    assert transform_points(matrix, moved_points) == pytest.approx(
+        leksell_points, abs=1e-3
+    )
@@ -0,0 +1,111 @@
+from stereotacticframe import memory
+from stereotacticframe.memory import compact_intensities, parse_size, plan_memory
+from stereotacticframe.phantoms import PhantomSpec, make_phantom, pose_error
+from stereotacticframe.pipeline import RegistrationOptions, calculate_frame_transform
+from stereotacticframe.profiling import Profile
+import SimpleITK as sitk
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize(
+    "text, size",
+    [
+        ("1GiB", 2**30),
+        ("512MB", 512 * 1000**2),
+        ("1.5g", 1_500_000_000),
+        ("4096", 4096),
+    ],
+)
+def test_parse_size(text, size) -> None:
+    assert parse_size(text) == size
+
+
+@pytest.mark.parametrize("text", ["", "GiB", "1 parsec", "-1GiB"])
+def test_parse_size_rejects_other_text(text) -> None:
+    with pytest.raises(ValueError):
+        parse_size(text)
+
+
+@pytest.mark.parametrize(
+    "values, pixel_type",
+    [
+        (np.array([-1000.0, 0.0, 3000.0], dtype=np.float32), sitk.sitkInt16),
+        (np.array([0, 40_000], dtype=np.uint16), sitk.sitkUInt16),
+        (np.array([0.5, 200.0], dtype=np.float32), sitk.sitkFloat32),
+        (np.array([0.5, 200.0], dtype=np.float64), sitk.sitkFloat32),
+    ],
+)
+def test_compact_intensities_keep_the_values(values, pixel_type) -> None:
+    image = sitk.GetImageFromArray(np.tile(values, (4, 3, 1)))
+
+    compact = compact_intensities(image)
+
+    assert compact.GetPixelID() == pixel_type
+    assert sitk.GetArrayViewFromImage(compact) == pytest.approx(
+        sitk.GetArrayViewFromImage(image)
+    )
+
+
+@pytest.fixture
+def ct_path(tmp_path):
+    spec = PhantomSpec("CT", size=(180, 180, 120), spacing=(1.4, 1.4, 1.2), noise=20.0)
+    phantom = make_phantom(spec)
+    path = tmp_path.joinpath("phantom.mha")
+    sitk.WriteImage(phantom.image, path)
+    return path, phantom
+
+
+def _budget_for_slabs(slab_size: int, halo: int = 10) -> int:
+    """Budget of the 180 x 180 x 120 int16 CT that fits slabs of slab_size"""
+    # int16, clamped to int16 with a mask and the closing
+    slice_bytes = 180 * 180 * (2 + 6)
+    # the 64 sampled slices for the threshold, and the image made of them
+    sample_bytes = 2 * 64 * 180 * 180 * 2
+    return sample_bytes + (slab_size + 2 * halo) * slice_bytes
+
+
+def test_plan_streams_only_what_does_not_fit(ct_path, monkeypatch, caplog) -> None:
+    monkeypatch.setattr(memory, "_baseline_bytes", lambda: 0)
+    monkeypatch.setattr(memory, "REGISTRATION_BYTES", 0)
+    path, _ = ct_path
+    image_bytes = 180 * 180 * 120 * (2 + 6)
+
+    assert plan_memory(path, "CT", 2 * image_bytes, halo=10).slab_size == 0
+    assert plan_memory(path, "CT", _budget_for_slabs(25), halo=10).slab_size == 25
+    # slabs thinner than their halo are far slower than the whole image
+    assert plan_memory(path, "CT", _budget_for_slabs(20), halo=10).slab_size == 0
+    assert "reading the whole image" in caplog.text
+
+
+def test_plan_does_not_shrink_as_the_process_grows(ct_path, monkeypatch) -> None:
+    monkeypatch.setattr(memory, "_baseline", None)
+    monkeypatch.setattr(memory, "REGISTRATION_BYTES", 0)
+    path, _ = ct_path
+    max_memory = int(memory._baseline_bytes()) + _budget_for_slabs(25)
+
+    first = plan_memory(path, "CT", max_memory, halo=10)
+    # like the memory that earlier cases of a server or batch worker leave
+    grown = np.ones(64 * 2**20, dtype=np.uint8)
+    second = plan_memory(path, "CT", max_memory, halo=10)
+
+    assert grown.all()
+    assert first.slab_size == second.slab_size == 25
+
+
+def test_registration_within_a_budget_streams_slabs(ct_path, monkeypatch) -> None:
+    monkeypatch.setattr(memory, "_baseline_bytes", lambda: 0)
+    monkeypatch.setattr(memory, "REGISTRATION_BYTES", 0)
+    path, phantom = ct_path
+    profile = Profile()
+
+    result = calculate_frame_transform(
+        path,
+        "CT",
+        RegistrationOptions(icp_engine="numpy", max_memory=_budget_for_slabs(25)),
+        profile=profile,
+    )
+
+    plan = next(stage for stage in profile.stages if stage.name == "plan memory")
+    assert plan.counts["slab_size"] == 25
+    assert pose_error(result.transform, phantom.frame_to_image) < 0.5
@@ -0,0 +1,32 @@
+from stereotacticframe.phantoms import PhantomSpec, make_phantom, pose_error
+from stereotacticframe.pipeline import RegistrationOptions, calculate_frame_transform
+import SimpleITK as sitk
+import numpy as np
+import pytest
+
+
+def test_bars_are_at_the_true_pose() -> None:
+    spec = PhantomSpec("CT", size=(128, 128, 80), spacing=(2.0, 2.0, 2.0), noise=0.0)
+    phantom = make_phantom(spec)
+
+    # halfway along the right posterior bar, from node (0, 0, 0) to (0, 0, -120)
+    bar_center = phantom.frame_to_image @ np.array([0.0, 0.0, -60.0, 1.0])
+    index = phantom.image.TransformPhysicalPointToIndex(tuple(bar_center[:3]))
+    assert phantom.image[index] == 2000
+    assert phantom.image[0, 0, 0] == -1000
+
+
+@pytest.mark.parametrize("modality, noise", [("MR", 5.0), ("CT", 20.0)])
+def test_registration_recovers_pose(tmp_path, modality, noise) -> None:
+    spec = PhantomSpec(
+        modality, size=(180, 180, 45), spacing=(1.4, 1.4, 3.0), noise=noise
+    )
+    phantom = make_phantom(spec)
+    image_path = tmp_path.joinpath("phantom.mha")
+    sitk.WriteImage(phantom.image, image_path)
+
+    result = calculate_frame_transform(
+        image_path, modality, RegistrationOptions(icp_engine="numpy")
+    )
+
+    assert pose_error(result.transform, phantom.frame_to_image) < 0.5
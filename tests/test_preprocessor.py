@@ -1,5 +1,7 @@
 from stereotacticframe.preprocessor import Preprocessor
+from stereotacticframe.frames import LeksellFrame
 import SimpleITK as sitk
+import numpy as np
 from pathlib import Path
 import pytest
 from typing import Callable
@@ -52,3 +54,88 @@ def test_mr_threshold_gives_seven_objects(mr_path, connected_component_filter) -
     cc = connected_component_filter(processed_img)
 
     assert sitk.GetArrayFromImage(cc).max() == 7
+
+
+@pytest.fixture
+def synthetic_image() -> sitk.Image:
+    rng = np.random.default_rng(0)
+    array = rng.normal(0.0, 20.0, size=(30, 40, 40))
+    array[:, 10:13, 10:13] += 2000.0
+    array[5:25, 25:30, 20:22] += 1500.0
+    return sitk.GetImageFromArray(array.astype(np.int16))
+
+
+@pytest.mark.parametrize("modality", ["CT", "MR"])
+def test_split_steps_equal_process(synthetic_image, modality) -> None:
+    preprocessor = Preprocessor(modality)
+
+    threshold = preprocessor.estimate_threshold(synthetic_image)
+    mask = preprocessor.close(preprocessor.apply_threshold(synthetic_image, threshold))
+
+    assert np.array_equal(
+        sitk.GetArrayFromImage(mask),
+        sitk.GetArrayFromImage(preprocessor.process(synthetic_image)),
+    )
+
+
+def _plates_and_head(plate_distance: float) -> sitk.Image:
+    """Two lateral plates with cranio-caudal bars plus a bright head in between"""
+    spacing = 2.0
+    array = np.zeros((70, 70, 140), dtype=np.float32)
+    right = 15
+    left = right + int(round(plate_distance / spacing))
+    for column in (right, left):
+        array[5:65, 20:22, column : column + 2] = 200.0
+        array[5:65, 50:52, column : column + 2] = 200.0
+    array[20:50, 20:50, 50:80] = 200.0
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing((spacing, spacing, spacing))
+    return image
+
+
+def test_frame_roi_only_processes_plates() -> None:
+    image = _plates_and_head(plate_distance=190.0)
+    full_mask = sitk.GetArrayFromImage(Preprocessor("MR").process(image))
+    roi_mask = sitk.GetArrayFromImage(
+        Preprocessor("MR", roi_frame=LeksellFrame()).process(image)
+    )
+
+    assert full_mask[30, 30, 60] == 1  # head
+    assert roi_mask[30, 30, 60] == 0
+    assert np.array_equal(roi_mask[..., :40], full_mask[..., :40])  # right plate
+    assert np.array_equal(roi_mask[..., 90:], full_mask[..., 90:])  # left plate
+
+
+def test_frame_roi_falls_back_to_whole_image() -> None:
+    image = _plates_and_head(plate_distance=240.0)
+    full_mask = sitk.GetArrayFromImage(Preprocessor("MR").process(image))
+    roi_mask = sitk.GetArrayFromImage(
+        Preprocessor("MR", roi_frame=LeksellFrame()).process(image)
+    )
+
+    assert np.array_equal(roi_mask, full_mask)
+
+
+@pytest.mark.parametrize("modality", ["CT", "MR"])
+def test_strided_threshold_keeps_the_structures(synthetic_image, modality) -> None:
+    full_mask = sitk.GetArrayFromImage(Preprocessor(modality).process(synthetic_image))
+    strided_mask = sitk.GetArrayFromImage(
+        Preprocessor(modality, threshold_shrink=4).process(synthetic_image)
+    )
+
+    assert np.array_equal(strided_mask, full_mask)
+
+
+def test_coarse_closing_fills_gaps_and_keeps_the_mask() -> None:
+    mask = np.zeros((20, 40, 40), dtype=np.uint8)
+    mask[5:15, 10:30, 10:16] = 1
+    mask[5:15, 10:30, 20:26] = 1  # 4 voxel gap between the two blocks
+    mask_image = sitk.GetImageFromArray(mask)
+
+    closed = sitk.GetArrayFromImage(
+        Preprocessor("MR", closing_shrink=2).close(mask_image)
+    )
+
+    assert np.all(closed[mask == 1] == 1)
+    assert np.all(closed[6:14, 12:28, 16:20] == 1)
+    assert closed[:, :, 30:].sum() == 0
@@ -0,0 +1,87 @@
+from stereotacticframe import profiling
+from stereotacticframe.blob_detection import detect_blobs
+from stereotacticframe.frame_detector import FrameDetector
+from stereotacticframe.frames import LeksellFrame
+from stereotacticframe.preprocessor import Preprocessor
+from stereotacticframe.slice_provider import AxialSliceProvider
+import SimpleITK as sitk
+import json
+import numpy as np
+import pytest
+from pathlib import Path
+
+
+def test_stage_records_nothing_without_profile() -> None:
+    with profiling.stage("unprofiled") as record:
+        record.set(points=3)
+
+    profile = profiling.Profile()
+    with profiling.activate(profile):
+        pass
+    assert profile.stages == []
+
+
+def test_accumulating_stages_share_a_record() -> None:
+    profile = profiling.Profile()
+    with profiling.activate(profile):
+        for _ in range(3):
+            with profiling.stage("per slice", accumulate=True):
+                pass
+        with profiling.stage("once") as record:
+            record.set(points=5)
+
+    assert [record.name for record in profile.stages] == ["per slice", "once"]
+    assert profile.stages[0].calls == 3
+    assert profile.stages[1].to_dict()["points"] == 5
+
+
+@pytest.mark.skipif(
+    profiling.current_rss_mb() is None, reason="resident memory is only known on Linux"
+)
+def test_stage_memory_is_of_the_stage() -> None:
+    profile = profiling.Profile()
+    with profiling.activate(profile):
+        with profiling.stage("allocate"):
+            grown = np.ones(256 * 2**20, dtype=np.uint8)
+        del grown
+        with profiling.stage("below the peak"):
+            pass
+
+    allocate, below = profile.stages
+    assert allocate.rss_mb_at_end - allocate.rss_mb_at_start > 200
+    assert allocate.peak_rss_growth_mb > 200
+    # the process peak stays high, but this stage did not add to it
+    assert below.peak_rss_growth_mb == 0
+    assert below.rss_mb_at_end < allocate.rss_mb_at_end - 200
+    assert "peak_rss_growth_mb" in profile.to_dict()["memory_fields"]
+
+
+@pytest.fixture
+def rods_image_path(tmp_path) -> Path:
+    rng = np.random.default_rng(0)
+    array = rng.normal(10.0, 2.0, size=(20, 60, 60)).astype(np.float32)
+    for row, column in [(10, 10), (10, 45), (40, 30)]:
+        array[:, row : row + 3, column : column + 3] = 200.0
+    path = tmp_path.joinpath("rods.nii")
+    sitk.WriteImage(sitk.GetImageFromArray(array), path)
+    return path
+
+
+def test_frame_detector_profile(rods_image_path, tmp_path) -> None:
+    profile = profiling.Profile()
+    with profiling.activate(profile):
+        provider = AxialSliceProvider(rods_image_path, Preprocessor("MR"))
+    detector = FrameDetector(
+        LeksellFrame(), provider, detect_blobs, modality="MR", profile=profile
+    )
+
+    detector.detect_frame()
+
+    assert detector.profile is profile
+    records = {record.name: record for record in profile.stages}
+    assert {"read image", "reorient", "preprocess", "detect frame"} <= set(records)
+    assert records["detect blobs in slice"].calls == 20
+    assert records["detect frame"].counts["points"] == 3 * 20
+    profile.write_json(tmp_path.joinpath("profile.json"))
+    with open(tmp_path.joinpath("profile.json")) as profile_file:
+        assert len(json.load(profile_file)["stages"]) == len(profile.stages)
@@ -0,0 +1,53 @@
+from stereotacticframe.phantoms import PhantomSpec, make_phantom, pose_error
+from stereotacticframe.pipeline import RegistrationOptions, calculate_frame_transform
+from stereotacticframe.sampling import SliceSampling, sparse_scan
+import SimpleITK as sitk
+import numpy as np
+
+
+def _blob_counts_detector(counts: list[int], scanned: list[int]):
+    def detect(index: int) -> np.ndarray:
+        scanned.append(index)
+        return np.full((counts[index], 3), float(index))
+
+    return detect
+
+
+def test_stride_from_points_per_bar() -> None:
+    assert SliceSampling().stride(0.5, 120) == 1
+    assert SliceSampling(z_stride=2.0).stride(0.5, 120) == 4
+    assert SliceSampling(points_per_bar=40).stride(0.5, 120) == 6
+    assert SliceSampling(points_per_bar=40).stride(5.0, 120) == 1
+
+
+def test_densifies_where_the_number_of_blobs_changes() -> None:
+    # six bars in slices 3 to 24, noise detected as a blob in slice 12
+    counts = [0] * 3 + [6] * 22 + [0] * 5
+    counts[12] = 7
+    scanned: list[int] = []
+
+    blobs, n_scanned = sparse_scan(
+        len(counts), 4, _blob_counts_detector(counts, scanned)
+    )
+
+    # every 4th and the last slice, the gaps next to 3, 12 and 25 densified
+    assert sorted(scanned) == (
+        [0, 1, 2, 3, 4, 8, 9, 10, 11, 12, 13, 14, 15, 16, 20, 24, 25, 26, 27, 28, 29]
+    )
+    assert n_scanned == len(scanned)
+    # in slice order
+    assert np.array_equal(blobs[:, 0], np.sort(blobs[:, 0]))
+    assert len(blobs) == sum(counts[k] for k in scanned)
+
+
+def test_sparse_sampling_recovers_pose(tmp_path) -> None:
+    spec = PhantomSpec("CT", size=(180, 180, 160), spacing=(1.4, 1.4, 0.8), noise=20)
+    phantom = make_phantom(spec)
+    image_path = tmp_path.joinpath("phantom.mha")
+    sitk.WriteImage(phantom.image, image_path)
+
+    result = calculate_frame_transform(
+        image_path, "CT", RegistrationOptions(icp_engine="numpy", points_per_bar=20)
+    )
+
+    assert pose_error(result.transform, phantom.frame_to_image) < 0.5
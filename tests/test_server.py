@@ -0,0 +1,307 @@
+from stereotacticframe import server
+from stereotacticframe.phantoms import PhantomSpec, make_phantom, pose_error
+from stereotacticframe.server import JobServer, job_executor, serve_spool, submit
+import SimpleITK as sitk
+import json
+import os
+from pathlib import Path
+import pytest
+import threading
+import time
+
+
+@pytest.fixture(scope="module")
+def phantom_path(tmp_path_factory):
+    spec = PhantomSpec("CT", size=(180, 180, 45), spacing=(1.4, 1.4, 3.0), noise=20)
+    phantom = make_phantom(spec)
+    image_path = tmp_path_factory.mktemp("phantom").joinpath("phantom.mha")
+    sitk.WriteImage(phantom.image, image_path)
+    return image_path, phantom.frame_to_image
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    socket_path = tmp_path.joinpath("server.sock")
+    with job_executor() as executor, JobServer(socket_path, executor, None) as server:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield socket_path
+        server.shutdown()
+
+
+def test_server_answers_ping(socket_path) -> None:
+    assert submit(socket_path, {"command": "ping", "id": 1}) == {
+        "id": 1,
+        "status": "ok",
+    }
+
+
+def test_server_runs_jobs(socket_path, phantom_path, tmp_path) -> None:
+    image_path, frame_to_image = phantom_path
+    transform_path = tmp_path.joinpath("transform.txt")
+
+    calculated = submit(
+        socket_path,
+        {
+            "command": "calculate",
+            "image": str(image_path),
+            "modality": "CT",
+            "output": str(transform_path),
+            "options": {"icp_engine": "numpy"},
+        },
+    )
+    applied = submit(
+        socket_path,
+        {
+            "command": "apply",
+            "image": str(image_path),
+            "transform": str(transform_path),
+            "output": str(tmp_path.joinpath("frame.mha")),
+        },
+    )
+
+    assert calculated["status"] == "ok"
+    transform = sitk.ReadTransform(str(transform_path))
+    assert pose_error(transform, frame_to_image) < 0.5
+    assert applied["status"] == "ok"
+    assert tmp_path.joinpath("frame.mha").exists()
+
+
+def test_server_reports_failed_job(socket_path, tmp_path) -> None:
+    result = submit(
+        socket_path,
+        {
+            "command": "calculate",
+            "image": str(tmp_path.joinpath("missing.mha")),
+            "modality": "CT",
+            "output": str(tmp_path.joinpath("transform.txt")),
+        },
+    )
+
+    assert result["status"] == "failed"
+    assert result["error"]
+    # the server keeps running after a failed job
+    assert submit(socket_path, {"command": "ping"})["status"] == "ok"
+
+
+def test_server_rejects_unknown_choices(socket_path, tmp_path) -> None:
+    result = submit(
+        socket_path,
+        {
+            "command": "calculate",
+            "image": str(tmp_path.joinpath("missing.mha")),
+            "modality": "CT",
+            "output": str(tmp_path.joinpath("transform.txt")),
+            "options": {"initial_pose": "closed-form"},
+        },
+    )
+
+    assert result["status"] == "failed"
+    # before the image is read
+    assert "initial_pose should be one of" in result["error"]
+
+
+def test_server_does_not_stream_a_dicom_series(socket_path, tmp_path) -> None:
+    result = submit(
+        socket_path,
+        {
+            "command": "apply",
+            "image": str(tmp_path),
+            "transform": str(tmp_path.joinpath("transform.txt")),
+            "output": str(tmp_path.joinpath("frame.mha")),
+            "slab_size": 16,
+        },
+    )
+
+    assert result["status"] == "failed"
+    assert "can not be streamed" in result["error"]
+
+
+@pytest.fixture
+def test_commands(monkeypatch):
+    """Commands that kill the worker or just answer, the worker processes are
+    forked after this, so they have them too"""
+    monkeypatch.setitem(server._command_map, "crash", lambda job, cache: os._exit(1))
+    monkeypatch.setitem(server._command_map, "echo", lambda job, cache: {})
+    monkeypatch.setitem(server._command_map, "sleep", _sleep)
+
+
+def _sleep(job, cache):
+    time.sleep(job["seconds"])
+    return {}
+
+
+def _wait_for(path, seconds=60) -> None:
+    deadline = time.monotonic() + seconds
+    while not path.exists() and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def test_server_survives_a_crashed_worker(test_commands, tmp_path) -> None:
+    socket_path = tmp_path.joinpath("server.sock")
+    with job_executor(2) as executor, JobServer(socket_path, executor, None) as s:
+        thread = threading.Thread(target=s.serve_forever, daemon=True)
+        thread.start()
+        crashed = submit(socket_path, {"command": "crash", "id": 1}, timeout=60)
+        after = submit(socket_path, {"command": "echo", "id": 2}, timeout=60)
+        s.shutdown()
+
+    assert crashed["status"] == "failed"
+    assert "BrokenProcessPool" in crashed["error"]
+    assert after["status"] == "ok"
+
+
+def test_a_crash_replaces_the_pool_once(test_commands, monkeypatch) -> None:
+    with job_executor(4) as executor:
+        new_pools = []
+        new_pool = executor._new_pool
+        monkeypatch.setattr(
+            executor, "_new_pool", lambda: new_pools.append(1) or new_pool()
+        )
+        jobs = [{"command": "sleep", "seconds": 1.0} for _ in range(3)]
+        futures = [server._submit(executor, job, None) for job in jobs]
+        time.sleep(0.5)  # the sleeping jobs run when the crash breaks the pool
+        futures.append(server._submit(executor, {"command": "crash"}, None))
+        results = [future.result(timeout=60) for future in futures]
+        after = server._submit(executor, {"command": "echo"}, None).result(60)
+
+    assert [result["status"] for result in results] == ["failed"] * 4
+    assert len(new_pools) == 1
+    assert after["status"] == "ok"
+
+
+def test_cancelled_jobs_get_a_result(test_commands) -> None:
+    executor = job_executor()
+    running = server._submit(executor, {"command": "sleep", "seconds": 0.5}, None)
+    waiting = server._submit(executor, {"command": "echo"}, None)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    assert waiting.result(timeout=10)["status"] == "failed"
+    assert "CancelledError" in waiting.result()["error"]
+    assert running.result(timeout=10)["status"] == "ok"
+
+
+def test_spool_survives_a_crashed_worker(test_commands, tmp_path) -> None:
+    spool_dir = tmp_path.joinpath("spool")
+    spool_dir.mkdir()
+    spool_dir.joinpath("crash.json").write_text(json.dumps({"command": "crash"}))
+    stop = threading.Event()
+
+    with job_executor(2) as executor:
+        thread = threading.Thread(
+            target=serve_spool, args=(spool_dir, executor, None, 0.05, stop)
+        )
+        thread.start()
+        _wait_for(spool_dir.joinpath("crash.result.json"))
+        spool_dir.joinpath("echo.json").write_text(json.dumps({"command": "echo"}))
+        _wait_for(spool_dir.joinpath("echo.result.json"))
+        stop.set()
+        thread.join()
+
+    crashed = json.loads(spool_dir.joinpath("crash.result.json").read_text())
+    after = json.loads(spool_dir.joinpath("echo.result.json").read_text())
+    assert crashed["status"] == "failed"
+    assert after["status"] == "ok"
+    assert sorted(path.name for path in spool_dir.iterdir()) == [
+        "crash.result.json",
+        "echo.result.json",
+    ]
+
+
+def test_servers_can_share_a_spool(test_commands, tmp_path) -> None:
+    spool_dir = tmp_path.joinpath("spool")
+    spool_dir.mkdir()
+    n_jobs = 200
+    for index in range(n_jobs):
+        job = {"command": "echo", "id": index}
+        spool_dir.joinpath(f"{index}.json").write_text(json.dumps(job))
+    stop = threading.Event()
+
+    with job_executor() as first, job_executor() as second:
+        threads = [
+            threading.Thread(
+                target=serve_spool, args=(spool_dir, executor, None, 0.01, stop)
+            )
+            for executor in (first, second)
+        ]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 60
+        while (
+            len(list(spool_dir.glob("*.result.json"))) < n_jobs
+            and time.monotonic() < deadline
+        ):
+            time.sleep(0.05)
+        # both servers are still polling, neither stopped on a claimed file
+        assert all(thread.is_alive() for thread in threads)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    results = [json.loads(path.read_text()) for path in spool_dir.iterdir()]
+    assert sorted(result["id"] for result in results) == list(range(n_jobs))
+    assert all(result["status"] == "ok" for result in results)
+
+
+def test_spool_skips_jobs_claimed_after_listing(
+    test_commands, tmp_path, monkeypatch
+) -> None:
+    spool_dir = tmp_path.joinpath("spool")
+    spool_dir.mkdir()
+    for name in ("taken", "left"):
+        spool_dir.joinpath(f"{name}.json").write_text(json.dumps({"command": "echo"}))
+    glob = Path.glob
+
+    def glob_then_claim(path, pattern):
+        listed = list(glob(path, pattern))
+        # another server claims a job right after this one listed it
+        taken = spool_dir.joinpath("taken.json")
+        if taken.exists():
+            taken.rename(spool_dir.joinpath("taken.json.running"))
+        return iter(listed)
+
+    monkeypatch.setattr(Path, "glob", glob_then_claim)
+    stop = threading.Event()
+
+    with job_executor() as executor:
+        thread = threading.Thread(
+            target=serve_spool, args=(spool_dir, executor, None, 0.05, stop)
+        )
+        thread.start()
+        _wait_for(spool_dir.joinpath("left.result.json"))
+        assert thread.is_alive()
+        stop.set()
+        thread.join()
+
+    assert spool_dir.joinpath("left.result.json").exists()
+
+
+def test_spool_writes_results(phantom_path, tmp_path) -> None:
+    image_path, frame_to_image = phantom_path
+    spool_dir = tmp_path.joinpath("spool")
+    spool_dir.mkdir()
+    job = {
+        "command": "calculate",
+        "image": str(image_path),
+        "modality": "CT",
+        "output": str(tmp_path.joinpath("transform.txt")),
+        "options": {"icp_engine": "numpy", "points_per_bar": 10},
+    }
+    spool_dir.joinpath("case.json").write_text(json.dumps(job))
+    stop = threading.Event()
+
+    with job_executor() as executor:
+        thread = threading.Thread(
+            target=serve_spool, args=(spool_dir, executor, None, 0.05, stop)
+        )
+        thread.start()
+        result_path = spool_dir.joinpath("case.result.json")
+        deadline = time.monotonic() + 120
+        while not result_path.exists() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        stop.set()
+        thread.join()
+
+    result = json.loads(result_path.read_text())
+    assert result["status"] == "ok"
+    assert sorted(path.name for path in spool_dir.iterdir()) == ["case.result.json"]
@@ -1,4 +1,7 @@
-from stereotacticframe.slice_provider import AxialSliceProvider
+from stereotacticframe.slice_provider import (
+    AxialSliceProvider,
+    StreamingAxialSliceProvider,
+)
 from stereotacticframe.preprocessor import Preprocessor
 import pytest
 import numpy as np
@@ -56,11 +59,11 @@ def test_rai_image_in_correct_orientation(slice_provider) -> None:
     RAI in this context means left to Right, posterior towards Anterior
     and superior to Inferior.
 
-    The fixture provides slice_provider with a sagittal image"""
-    rai_img = slice_provider._rai_image
-    given_direction = rai_img.GetDirection()
+    The fixture provides slice_provider with a sagittal image, the provider
+    does not copy it but maps its index axes onto RAI"""
+    _, _, geometry = slice_provider.get_volume_arrays()
     assert np.allclose(
-        np.array(given_direction), np.array([-1, 0, 0, 0, -1, 0, 0, 0, -1])
+        np.array(geometry.direction), np.array([-1, 0, 0, 0, -1, 0, 0, 0, -1])
     )
 
 
@@ -91,3 +94,149 @@ def test_provides_all_slices(slice_provider) -> None:
         _ = slice_provider.next_image_mask_pair()
         slice_counter += 1
     assert slice_counter == TEST_SHAPE[0]
+
+
+@pytest.fixture(scope="module")
+def synthetic_image_path(tmp_path_factory):
+    """Small noisy volume with bright rods, stored superior slice last"""
+    rng = np.random.default_rng(0)
+    array = rng.normal(10.0, 2.0, size=(40, 30, 20)).astype(np.float32)
+    array[:, 5:8, 4:6] = 200.0
+    array[10:30, 20:23, 12:15] = 200.0
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing((1.0, 1.5, 2.0))
+    image.SetOrigin((-10.0, 20.0, -50.0))
+    path = tmp_path_factory.mktemp("slice_provider").joinpath("synthetic.nii")
+    sitk.WriteImage(image, path)
+    return path
+
+
+def test_streaming_provider_matches_full_provider(synthetic_image_path) -> None:
+    full_provider = AxialSliceProvider(synthetic_image_path, Preprocessor("MR"))
+    streaming_provider = StreamingAxialSliceProvider(
+        synthetic_image_path,
+        Preprocessor("MR"),
+        slab_size=7,
+        threshold_sample_size=40,  # all slices, so the threshold is identical
+    )
+
+    while not full_provider.is_empty():
+        assert not streaming_provider.is_empty()
+        img, mask = full_provider.next_image_mask_pair()
+        streamed_img, streamed_mask = streaming_provider.next_image_mask_pair()
+        assert np.array_equal(
+            sitk.GetArrayViewFromImage(img), sitk.GetArrayViewFromImage(streamed_img)
+        )
+        assert np.array_equal(
+            sitk.GetArrayViewFromImage(mask), sitk.GetArrayViewFromImage(streamed_mask)
+        )
+        assert (
+            full_provider.get_current_z_coordinate()
+            == streaming_provider.get_current_z_coordinate()
+        )
+    assert streaming_provider.is_empty()
+
+
+def test_lazy_slice_closing_matches_eager_closing(synthetic_image_path) -> None:
+    eager_provider = AxialSliceProvider(
+        synthetic_image_path, Preprocessor("MR", slice_closing=True)
+    )
+    lazy_provider = AxialSliceProvider(
+        synthetic_image_path,
+        Preprocessor("MR", slice_closing=True),
+        lazy_closing=True,
+    )
+
+    for index in range(eager_provider.get_number_of_slices()):
+        _, mask = eager_provider.get_image_mask_pair(index)
+        _, lazy_mask = lazy_provider.get_image_mask_pair(index)
+        assert np.array_equal(
+            sitk.GetArrayViewFromImage(mask), sitk.GetArrayViewFromImage(lazy_mask)
+        )
+    assert np.array_equal(
+        eager_provider.get_volume_arrays()[1], lazy_provider.get_volume_arrays()[1]
+    )
+
+
+def test_lazy_closing_needs_slice_closing(synthetic_image_path) -> None:
+    with pytest.raises(ValueError):
+        AxialSliceProvider(synthetic_image_path, Preprocessor("MR"), lazy_closing=True)
+
+
+@pytest.mark.parametrize(
+    "axes, flips",
+    [
+        ((0, 1, 2), (False, False, False)),
+        ((0, 1, 2), (True, False, True)),
+        ((1, 2, 0), (False, True, True)),  # sagittal
+        ((2, 0, 1), (True, True, False)),  # coronal
+    ],
+)
+@pytest.mark.parametrize("slice_closing", [False, True])
+def test_remapped_slices_match_reoriented_image(
+    synthetic_image_path, tmp_path, axes, flips, slice_closing
+) -> None:
+    image = sitk.Flip(
+        sitk.PermuteAxes(sitk.ReadImage(synthetic_image_path), axes), flips
+    )
+    image_path = tmp_path.joinpath("oriented.nii")
+    sitk.WriteImage(image, image_path)
+    preprocessor = Preprocessor("MR", slice_closing=slice_closing)
+    provider = AxialSliceProvider(image_path, preprocessor)
+
+    rai_image = sitk.DICOMOrient(image, "RAI")
+    rai_mask = preprocessor.process(rai_image)
+    assert provider.get_number_of_slices() == rai_image.GetSize()[2]
+    for index in range(provider.get_number_of_slices()):
+        img, mask = provider.get_image_mask_pair(index)
+        expected_img, expected_mask = rai_image[..., index], rai_mask[..., index]
+        assert np.array_equal(
+            sitk.GetArrayFromImage(img), sitk.GetArrayFromImage(expected_img)
+        )
+        assert np.array_equal(
+            sitk.GetArrayFromImage(mask), sitk.GetArrayFromImage(expected_mask)
+        )
+        assert np.allclose(img.GetOrigin(), expected_img.GetOrigin())
+        assert np.allclose(img.GetDirection(), expected_img.GetDirection())
+        assert provider.get_z_coordinate(index) == pytest.approx(
+            rai_image.TransformIndexToPhysicalPoint([0, 0, index])[2]
+        )
+    image_array, mask_array, geometry = provider.get_volume_arrays()
+    assert np.array_equal(image_array, sitk.GetArrayViewFromImage(rai_image))
+    assert np.array_equal(mask_array, sitk.GetArrayViewFromImage(rai_mask))
+    assert np.allclose(geometry.origin, rai_image.GetOrigin())
+
+
+def test_oblique_image_is_reoriented(synthetic_image_path, tmp_path) -> None:
+    image = sitk.ReadImage(synthetic_image_path)
+    angle = np.pi / 4  # about the axial axis, between left-right and anterior
+    image.SetDirection(
+        (np.cos(angle), -np.sin(angle), 0, np.sin(angle), np.cos(angle), 0, 0, 0, 1)
+    )
+    image_path = tmp_path.joinpath("oblique.nii")
+    sitk.WriteImage(image, image_path)
+    provider = AxialSliceProvider(image_path, Preprocessor("MR"))
+
+    rai_image = sitk.DICOMOrient(image, "RAI")
+    image_array, _, geometry = provider.get_volume_arrays()
+    assert np.array_equal(image_array, sitk.GetArrayViewFromImage(rai_image))
+    assert np.allclose(geometry.direction, rai_image.GetDirection())
+
+
+@pytest.mark.parametrize("slice_closing", [False, True])
+def test_array_pairs_match_image_mask_pairs(
+    synthetic_image_path, slice_closing
+) -> None:
+    provider = AxialSliceProvider(
+        synthetic_image_path,
+        Preprocessor("MR", slice_closing=slice_closing),
+        lazy_closing=slice_closing,
+    )
+
+    for index in range(provider.get_number_of_slices()):
+        img, mask = provider.get_image_mask_pair(index)
+        image_array, mask_array, geometry = provider.get_array_pair(index)
+        assert np.array_equal(image_array, sitk.GetArrayFromImage(img))
+        assert np.array_equal(mask_array, sitk.GetArrayFromImage(mask))
+        assert np.allclose(geometry.origin[:2], img.GetOrigin())
+        assert geometry.origin[2] == pytest.approx(provider.get_z_coordinate(index))
@@ -0,0 +1,81 @@
+from stereotacticframe.frames import LeksellFrame
+from stereotacticframe.transforms import (
+    apply_transform,
+    apply_transform_streamed,
+    apply_transform_to_images,
+)
+import SimpleITK as sitk
+import numpy as np
+import pytest
+
+
+def _image(spacing: tuple[float, float, float], seed: int) -> sitk.Image:
+    rng = np.random.default_rng(seed)
+    image = sitk.GetImageFromArray(rng.normal(size=(70, 40, 60)).astype(np.float32))
+    image.SetSpacing(spacing)
+    # covers the frame space grid after the transform below
+    image.SetOrigin((-110.0, 30.0, -240.0))
+    return image
+
+
+@pytest.fixture
+def transform() -> sitk.Transform:
+    transform = sitk.Euler3DTransform()
+    transform.SetRotation(0.01, -0.02, 0.03)
+    transform.SetTranslation((-95.0, 10.0, -60.0))
+    return transform
+
+
+def test_many_images_match_one_at_a_time(transform) -> None:
+    images = [
+        _image((4.0, 1.0, 4.0), 0),
+        _image((5.0, 1.5, 5.0), 1),
+        _image((4.0, 1.0, 4.0), 2),
+    ]
+    frame = LeksellFrame()
+
+    resampled = apply_transform_to_images(images, transform, frame, n_workers=3)
+
+    for image, frame_image in zip(images, resampled):
+        expected = apply_transform(image, transform, frame)
+        assert frame_image.GetSize() == expected.GetSize()
+        assert np.all(sitk.GetArrayViewFromImage(frame_image) != 0)
+        assert np.array_equal(
+            sitk.GetArrayFromImage(frame_image), sitk.GetArrayFromImage(expected)
+        )
+
+
+@pytest.mark.parametrize("slab_size", [1, 7, 100])
+def test_streamed_output_matches_apply_transform(
+    tmp_path, transform, slab_size
+) -> None:
+    image = sitk.Cast(_image((4.0, 1.0, 4.0), 0) * 100, sitk.sitkInt16)
+    # only part of the frame space is covered, so some slabs sample nothing
+    image = image[:, :, 35:]
+    image_path = tmp_path.joinpath("image.nii")
+    sitk.WriteImage(image, image_path)
+    output_path = tmp_path.joinpath("frame_image.mha")
+
+    apply_transform_streamed(
+        image_path, transform, output_path, LeksellFrame(), slab_size=slab_size
+    )
+
+    expected = apply_transform(image, transform, LeksellFrame())
+    streamed = sitk.ReadImage(output_path)
+    assert streamed.GetPixelID() == expected.GetPixelID()
+    assert streamed.GetOrigin() == expected.GetOrigin()
+    assert streamed.GetSpacing() == expected.GetSpacing()
+    assert streamed.GetDirection() == expected.GetDirection()
+    expected_array = sitk.GetArrayFromImage(expected)
+    assert np.any(expected_array != 0) and np.any(expected_array[0] == 0)
+    assert np.array_equal(sitk.GetArrayFromImage(streamed), expected_array)
+
+
+def test_streamed_output_has_to_be_mha(tmp_path, transform) -> None:
+    with pytest.raises(ValueError):
+        apply_transform_streamed(
+            tmp_path.joinpath("image.nii"),
+            transform,
+            tmp_path.joinpath("frame_image.nii"),
+            LeksellFrame(),
+        )